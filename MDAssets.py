@@ -0,0 +1,489 @@
+"""
+Map Displayer is a scene-based toolset for displaying Encounter Maps on a
+second screen for Tabletop RPGs
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Map Displayer.
+
+Map Displayer is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Map Displayer is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Map Displayer.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from PyQt5.QtGui import QImage, QImageReader, QPixmap, QTransform
+from PyQt5.QtCore import (QObject, QRunnable, QThreadPool, QSize, Qt,
+                          QFileSystemWatcher, QTimer, pyqtSignal)
+import os
+
+from MDCommon import getImageBytes
+from MDImageCache import imageCache
+from MDTokens import MDTokenAtlas
+
+
+# One image file on disk, shared by every SceneImage that uses it. Only the
+# header is read on creation, the full decode waits for the first getImage
+class MDImageAsset(QObject):
+    thumbnailLoaded = pyqtSignal()
+    # A scaled image asked for with requestScaledImage is in
+    scaledImageLoaded = pyqtSignal()
+
+    thumbnailSize = QSize(64, 64)
+    maxScaledImages = 4
+    assets = {}
+
+    def __init__(self, filePath):
+        super(MDImageAsset, self).__init__()
+        self.filePath = filePath
+        self.image = None
+        self.source = None
+        self.scaledImages = {}
+        self.thumbnail = None
+        # The last thumbnail task is held until the next one replaces it,
+        # so its signals object outlives the queued delivery
+        self.thumbnailTask = None
+        self.loadingThumbnail = False
+        # The file changed while a thumbnail was being made from it
+        self.thumbnailStale = False
+        # Scaled images being loaded on the pool, by the key they are kept
+        # under. Results made from the file before a reload are dropped.
+        self.scaleTasks = {}
+        self.reloadCount = 0
+        self.animations = {}
+        reader = QImageReader(filePath)
+        self.size = reader.size()
+        self.animated = reader.supportsAnimation() and \
+            reader.imageCount() != 1
+
+    @classmethod
+    def getAsset(cls, filePath):
+        asset = cls.assets.get(filePath)
+        if asset is None:
+            asset = cls(filePath)
+            cls.assets[filePath] = asset
+        return asset
+
+    def getFilePath(self):
+        return self.filePath
+
+    def getSize(self):
+        return (self.size.width(), self.size.height())
+
+    def isLoaded(self):
+        return self.image is not None
+
+    def getImage(self):
+        if self.image is None:
+            # source keeps the cache file mapped behind the pixmap
+            self.source = imageCache.loadImage(self.filePath)
+            self.image = QPixmap.fromImage(self.source)
+            self.size = self.image.size()
+        return self.image
+
+    def getScaledImage(self, width, height, rotation=0):
+        # Scaled and rotated copies are made once with smooth filtering and
+        # kept by (rotation, size), so painters only ever blit them. The
+        # scaled pixels come from the disk cache when possible, so the full
+        # image doesn't have to be decoded for them. width and height are
+        # the size after rotation.
+        key = (rotation, width, height)
+        scaled = self.scaledImages.get(key)
+        if scaled is None:
+            if width <= 0 or height <= 0:
+                return None
+            if rotation % 180 == 0:
+                size = QSize(width, height)
+            else:
+                size = QSize(height, width)
+            if rotation == 0 and self.image is not None and \
+                    (width, height) == self.getSize():
+                return self.image
+            if (size.width(), size.height()) == self.getSize():
+                if rotation == 0:
+                    return self.getImage()
+                self.getImage()
+                img = self.source
+            else:
+                # Copied out of the cache file's mapping: fromImage may share
+                # the pixels, and the mapping goes away with img
+                img = imageCache.loadImage(self.filePath, size).copy()
+            if rotation != 0:
+                # Quarter turns are exact, so no filtering is involved
+                img = img.transformed(QTransform().rotate(rotation))
+            scaled = QPixmap.fromImage(img)
+            self.storeScaledImage(key, scaled)
+        return scaled
+
+    def storeScaledImage(self, key, scaled):
+        if len(self.scaledImages) >= self.maxScaledImages:
+            self.scaledImages.pop(next(iter(self.scaledImages)))
+        self.scaledImages[key] = scaled
+
+    def requestScaledImage(self, width, height, rotation=0):
+        # getScaledImage for painting on the GUI thread, which can't wait
+        # for a decode. A miss is loaded on the pool and scaledImageLoaded
+        # is emitted when it is in. Until then this returns the image at
+        # another size to stretch in its place, or None.
+        key = (rotation, width, height)
+        scaled = self.scaledImages.get(key)
+        if scaled is not None or width <= 0 or height <= 0:
+            return scaled
+        if key not in self.scaleTasks:
+            if rotation % 180 == 0:
+                size = QSize(width, height)
+            else:
+                size = QSize(height, width)
+            if (size.width(), size.height()) == self.getSize():
+                size = None
+            task = MDScaledImageTask(self.filePath, size, key,
+                                     self.reloadCount)
+            task.signals.finished.connect(self.applyScaledImage)
+            self.scaleTasks[key] = task
+            QThreadPool.globalInstance().start(task)
+        others = [(abs(w - width), img)
+                  for (r, w, h), img in self.scaledImages.items()
+                  if r == rotation]
+        if len(others) > 0:
+            return min(others, key=lambda other: other[0])[1]
+        if rotation == 0 and self.image is not None:
+            return self.image
+        return None
+
+    def applyScaledImage(self, key, reloadCount, img):
+        self.scaleTasks.pop(key, None)
+        if reloadCount == self.reloadCount and not img.isNull():
+            self.storeScaledImage(key, QPixmap.fromImage(img))
+        self.scaledImageLoaded.emit()
+
+    def isAnimated(self):
+        return self.animated
+
+    def getCachedSizes(self):
+        # Sizes of the scaled variants held right now, as loaded from the
+        # image cache
+        return [QSize(w, h) if rotation % 180 == 0 else QSize(h, w)
+                for rotation, w, h in self.scaledImages]
+
+    def reload(self):
+        # Drops everything decoded from the old file. MDAssetReloadTask has
+        # already put the new pixels in the image cache, so drawing again
+        # only maps them.
+        for animation in self.animations.values():
+            animation.release()
+        self.animations = {}
+        self.image = None
+        self.source = None
+        self.scaledImages = {}
+        self.reloadCount += 1
+        reader = QImageReader(self.filePath)
+        self.size = reader.size()
+        self.animated = reader.supportsAnimation() and \
+            reader.imageCount() != 1
+        # The old thumbnail stays up until the new one is ready
+        if self.thumbnail is not None:
+            self.startThumbnailTask()
+
+    def getMemoryUsage(self):
+        # source is backed by the mapped cache file, so it is reported
+        # apart from memory the process allocated itself
+        return {
+            "image": getImageBytes(self.image),
+            "mapped": getImageBytes(self.source),
+            "scaled": sum(getImageBytes(img)
+                          for img in self.scaledImages.values()),
+            "thumbnail": getImageBytes(self.thumbnail),
+            "animation": sum(a.bytes for a in self.animations.values())
+        }
+
+    def getAnimation(self, width, height, rotation=0):
+        # Frames of an animated image at one display size and rotation.
+        # Still images (and everything but the display) use getImage.
+        if not self.animated or width <= 0 or height <= 0:
+            return None
+        key = (rotation, width, height)
+        animation = self.animations.get(key)
+        if animation is None:
+            if len(self.animations) >= self.maxScaledImages:
+                self.animations.pop(next(iter(self.animations))).release()
+            animation = MDAnimation(self.filePath, width, height, rotation)
+            self.animations[key] = animation
+        return animation
+
+    def getThumbnail(self):
+        return self.thumbnail
+
+    def loadThumbnail(self):
+        # Thumbnails are decoded on the global pool; the QPixmap itself
+        # has to be created back on the GUI thread in applyThumbnail
+        if self.thumbnail is None:
+            self.startThumbnailTask()
+
+    def startThumbnailTask(self):
+        if self.loadingThumbnail:
+            self.thumbnailStale = True
+        else:
+            self.loadingThumbnail = True
+            self.thumbnailTask = MDThumbnailTask(self.filePath,
+                                                 self.thumbnailSize)
+            self.thumbnailTask.signals.finished.connect(self.applyThumbnail)
+            QThreadPool.globalInstance().start(self.thumbnailTask)
+
+    def applyThumbnail(self, img):
+        self.loadingThumbnail = False
+        if not img.isNull():
+            self.thumbnail = QPixmap.fromImage(img)
+            self.thumbnailLoaded.emit()
+        if self.thumbnailStale:
+            self.thumbnailStale = False
+            self.startThumbnailTask()
+
+
+class MDAnimation:
+    # Frames are decoded in order, scaled and rotated for the display, and
+    # kept until all animations together hold maxBytes. Frames past that
+    # are decoded again every loop instead of growing the cache.
+    maxBytes = 256 * 1024 * 1024
+    cachedBytes = 0
+    defaultDelay = 100
+
+    def __init__(self, filePath, width, height, rotation=0):
+        self.filePath = filePath
+        self.width = width
+        self.height = height
+        self.rotation = rotation
+        self.frames = []
+        self.frameCount = None
+        self.reader = None
+        self.readerIndex = 0
+        self.bytes = 0
+
+    def openReader(self, index):
+        self.reader = QImageReader(self.filePath)
+        self.readerIndex = 0
+        if index > 0 and self.reader.jumpToImage(index):
+            self.readerIndex = index
+        while self.readerIndex < index and not self.reader.read().isNull():
+            self.readerIndex += 1
+
+    def getFrame(self, index):
+        # Returns (image, delay in ms) for frame index of the loop, or None
+        # when the file can't be decoded
+        if self.frameCount is not None:
+            index %= self.frameCount
+        if index < len(self.frames):
+            return self.frames[index]
+        if self.reader is None or self.readerIndex != index:
+            self.openReader(index)
+        img = self.reader.read()
+        if img.isNull():
+            if index == 0:
+                return None
+            # End of the loop
+            self.frameCount = index
+            self.reader = None
+            return self.getFrame(0)
+        delay = self.reader.nextImageDelay()
+        self.readerIndex += 1
+        frame = (self.transformFrame(img),
+                 delay if delay > 0 else self.defaultDelay)
+        n = frame[0].sizeInBytes()
+        if index == len(self.frames) and \
+                MDAnimation.cachedBytes + n <= self.maxBytes:
+            self.frames.append(frame)
+            self.bytes += n
+            MDAnimation.cachedBytes += n
+            if len(self.frames) == self.frameCount:
+                self.reader = None
+        return frame
+
+    def transformFrame(self, img):
+        if self.rotation % 180 == 0:
+            size = QSize(self.width, self.height)
+        else:
+            size = QSize(self.height, self.width)
+        img = img.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+        if img.size() != size:
+            img = img.scaled(size, Qt.IgnoreAspectRatio,
+                             Qt.SmoothTransformation)
+        if self.rotation != 0:
+            img = img.transformed(QTransform().rotate(self.rotation))
+        return img
+
+    def release(self):
+        MDAnimation.cachedBytes -= self.bytes
+        self.bytes = 0
+        self.frames = []
+        self.reader = None
+
+
+class MDThumbnailSignals(QObject):
+    finished = pyqtSignal(QImage)
+
+
+class MDThumbnailTask(QRunnable):
+    def __init__(self, filePath, maxSize):
+        super(MDThumbnailTask, self).__init__()
+        self.setAutoDelete(False)
+        self.filePath = filePath
+        self.maxSize = maxSize
+        self.signals = MDThumbnailSignals()
+
+    def run(self):
+        # The cached image is backed by a file mapping owned by this
+        # thread, so only a copy is handed back to the GUI thread
+        img = imageCache.loadThumbnail(self.filePath, self.maxSize)
+        self.signals.finished.emit(img.copy())
+
+
+class MDScaledImageSignals(QObject):
+    # key, reload count, image
+    finished = pyqtSignal(object, int, QImage)
+
+
+class MDScaledImageTask(QRunnable):
+    # size None is the full image
+    def __init__(self, filePath, size, key, reloadCount):
+        super(MDScaledImageTask, self).__init__()
+        self.setAutoDelete(False)
+        self.filePath = filePath
+        self.size = size
+        self.key = key
+        self.reloadCount = reloadCount
+        self.signals = MDScaledImageSignals()
+
+    def run(self):
+        # Like thumbnails, only a copy of the mapped image leaves the pool
+        img = imageCache.loadImage(self.filePath, self.size)
+        rotation = self.key[0]
+        if rotation != 0 and not img.isNull():
+            img = img.transformed(QTransform().rotate(rotation))
+        else:
+            img = img.copy()
+        self.signals.finished.emit(self.key, self.reloadCount, img)
+
+
+def getDirectory(filePath):
+    return os.path.dirname(os.path.abspath(filePath))
+
+
+class MDAssetReloadSignals(QObject):
+    finished = pyqtSignal(str)
+
+
+class MDAssetReloadTask(QRunnable):
+    # Decodes a changed file into the image cache at the sizes its asset
+    # and token cells use, so the GUI thread never decodes it
+    def __init__(self, filePath, full, sizes, cellSizes, thumbnail):
+        super(MDAssetReloadTask, self).__init__()
+        self.setAutoDelete(False)
+        self.filePath = filePath
+        self.full = full
+        self.sizes = sizes
+        self.cellSizes = cellSizes
+        self.thumbnail = thumbnail
+        self.signals = MDAssetReloadSignals()
+
+    def run(self):
+        if self.full:
+            imageCache.loadImage(self.filePath)
+        for size in self.sizes:
+            imageCache.loadImage(self.filePath, size)
+        for cellSize in self.cellSizes:
+            MDTokenAtlas.loadCellImage(self.filePath, cellSize)
+        if self.thumbnail:
+            imageCache.loadThumbnail(self.filePath, MDImageAsset.thumbnailSize)
+        self.signals.finished.emit(self.filePath)
+
+
+# Watches the image files a session uses and reloads the ones that change,
+# e.g. a map touched up in an image editor during prep. Editors write a
+# file in several steps or replace it, so changes are gathered for
+# debounceDelay ms before anything is reloaded.
+class MDAssetWatcher(QObject):
+    # An asset's pixels were replaced, everything drawn from it is stale
+    assetReloaded = pyqtSignal(str)
+
+    debounceDelay = 300
+
+    def __init__(self):
+        super(MDAssetWatcher, self).__init__()
+        self.watcher = QFileSystemWatcher()
+        self.watcher.fileChanged.connect(self.queueReload)
+        self.watcher.directoryChanged.connect(self.checkDirectory)
+        self.paths = set()
+        self.pending = set()
+        self.tasks = []
+        self.timer = QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(self.debounceDelay)
+        self.timer.timeout.connect(self.reloadPending)
+
+    def watchPaths(self, paths):
+        # Replaces the watched files with paths. Their directories are
+        # watched too, for files that were deleted and written again.
+        paths = set(p for p in paths if os.path.exists(p))
+        removed = self.paths - paths
+        added = paths - self.paths
+        self.paths = paths
+        directories = set(getDirectory(p) for p in paths)
+        oldDirectories = set(self.watcher.directories())
+        if len(removed) > 0:
+            watched = set(self.watcher.files())
+            self.watcher.removePaths([p for p in removed if p in watched])
+        if len(oldDirectories - directories) > 0:
+            self.watcher.removePaths(list(oldDirectories - directories))
+        if len(added) > 0:
+            self.watcher.addPaths(list(added))
+        if len(directories - oldDirectories) > 0:
+            self.watcher.addPaths(list(directories - oldDirectories))
+        self.pending &= self.paths
+
+    def queueReload(self, filePath):
+        if filePath in self.paths:
+            self.pending.add(filePath)
+            self.timer.start()
+
+    def checkDirectory(self, directory):
+        # A file replaced by rename or deleted drops out of the watch list,
+        # it is picked up again here once it exists
+        watched = set(self.watcher.files())
+        for filePath in self.paths - watched:
+            if getDirectory(filePath) == directory and \
+                    os.path.exists(filePath):
+                self.queueReload(filePath)
+
+    def reloadPending(self):
+        watched = set(self.watcher.files())
+        for filePath in self.pending:
+            if not os.path.exists(filePath):
+                # Still being replaced, checkDirectory sees it come back
+                continue
+            if filePath not in watched:
+                self.watcher.addPath(filePath)
+            asset = MDImageAsset.assets.get(filePath)
+            task = MDAssetReloadTask(
+                filePath, asset is not None and asset.isLoaded(),
+                [] if asset is None else asset.getCachedSizes(),
+                MDTokenAtlas.getCellSizes(filePath),
+                asset is not None and asset.getThumbnail() is not None)
+            task.signals.finished.connect(self.applyReload)
+            self.tasks.append(task)
+            QThreadPool.globalInstance().start(task)
+        self.pending = set()
+
+    def applyReload(self, filePath):
+        self.tasks = [t for t in self.tasks if t.signals is not self.sender()]
+        asset = MDImageAsset.assets.get(filePath)
+        if asset is not None:
+            asset.reload()
+        MDTokenAtlas.reload(filePath)
+        self.assetReloaded.emit(filePath)
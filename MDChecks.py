@@ -0,0 +1,176 @@
+"""
+Map Displayer is a scene-based toolset for displaying Encounter Maps on a
+second screen for Tabletop RPGs
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Map Displayer.
+
+Map Displayer is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Map Displayer is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Map Displayer.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import math
+import random
+import sys
+
+
+# Randomized checks of the geometry behind lighting and darkness against
+# slow but obviously right versions, run as "python MDChecks.py". Each
+# check returns (mismatches, samples).
+
+def castRay(ox, oy, angle, segments):
+    # Distance from (ox, oy) at angle to the nearest segment it hits
+    dx, dy = math.cos(angle), math.sin(angle)
+    nearest = math.inf
+    for x1, y1, x2, y2 in segments:
+        ex, ey = x2 - x1, y2 - y1
+        denom = dx * ey - dy * ex
+        if abs(denom) < 1e-12:
+            continue
+        t = ((x1 - ox) * ey - (y1 - oy) * ex) / denom
+        u = ((x1 - ox) * dy - (y1 - oy) * dx) / denom
+        if t > 1e-9 and -1e-9 <= u <= 1 + 1e-9:
+            nearest = min(nearest, t)
+    return nearest
+
+
+def getPolygonEdges(points):
+    return [points[i - 1] + points[i] for i in range(len(points))]
+
+
+def getBoxEdges(ox, oy, radius):
+    # The square getVisibilityPolygon stops at
+    r = radius + 1
+    return getPolygonEdges([(ox - r, oy - r), (ox + r, oy - r),
+                            (ox + r, oy + r), (ox - r, oy + r)])
+
+
+def getRandomGridWalls(rnd, count):
+    # Walls along grid lines that neither cross nor overlap each other
+    from MDVisibility import getCrossing
+    walls = []
+    for i in range(count):
+        x, y = rnd.randint(0, 20), rnd.randint(0, 20)
+        if rnd.random() < 0.5:
+            wall = (x, y, x + rnd.randint(1, 4), y)
+        else:
+            wall = (x, y, x, y + rnd.randint(1, 4))
+        if all(getCrossing(wall, other) is None and
+               getCrossing(other, wall) is None and
+               not (wall[0] == wall[2] == other[0] == other[2]) and
+               not (wall[1] == wall[3] == other[1] == other[3])
+               for other in walls):
+            walls.append(wall)
+    return walls
+
+
+def checkVisibility(rnd, trials, rays=90):
+    # The polygon of the angular sweep against rays cast at every wall,
+    # on its own with walls that don't cross and through MDVisibility
+    # with walls at any angle, which it cuts where they cross
+    from MDSceneData import SceneWall
+    from MDVisibility import MDVisibility, getVisibilityPolygon
+    mismatches = samples = 0
+    for trial in range(trials):
+        ox, oy = rnd.uniform(2, 18), rnd.uniform(2, 18)
+        radius = 8
+        walls = getRandomGridWalls(rnd, 30)
+        polygon = getPolygonEdges(
+            getVisibilityPolygon(ox, oy, walls, radius))
+        walls += getBoxEdges(ox, oy, radius)
+        for i in range(rays):
+            angle = rnd.uniform(-math.pi, math.pi)
+            samples += 1
+            if abs(castRay(ox, oy, angle, walls) -
+                   castRay(ox, oy, angle, polygon)) > 1e-6:
+                mismatches += 1
+
+        visibility = MDVisibility()
+        walls = []
+        for i in range(25):
+            x, y = rnd.uniform(0, 20), rnd.uniform(0, 20)
+            wall = SceneWall("wall", x, y, x + rnd.uniform(-5, 5),
+                             y + rnd.uniform(-5, 5))
+            visibility.updateWall(wall)
+            walls.append(wall.getSegment())
+        ox, oy = rnd.uniform(2, 18), rnd.uniform(2, 18)
+        polygon = getPolygonEdges(visibility.getVisibleArea(ox, oy, radius))
+        ox += visibility.nudge[0]
+        oy += visibility.nudge[1]
+        for i in range(rays):
+            # Walls past the radius are left out, so only what is within
+            # it has to agree
+            angle = rnd.uniform(-math.pi, math.pi)
+            samples += 1
+            if abs(min(castRay(ox, oy, angle, walls), radius) -
+                   min(castRay(ox, oy, angle, polygon), radius)) > 1e-6:
+                mismatches += 1
+    return mismatches, samples
+
+
+def checkSlabs(rnd, trials, points=200):
+    # Hit tests on darkness polygons against QPainterPath.contains, whose
+    # even-odd rule is what fills them. The polygons are random corners,
+    # so they cross themselves. Random points practically never land
+    # right on an edge, where the two may round either way.
+    from PyQt5.QtGui import QPainterPath, QPolygonF
+    from PyQt5.QtCore import QPointF
+    from MDSceneData import MDPolygonSlabs
+    mismatches = samples = 0
+    for trial in range(trials):
+        corners = [(rnd.randint(0, 20), rnd.randint(0, 12))
+                   for i in range(rnd.randint(3, 12))]
+        slabs = MDPolygonSlabs(corners)
+        path = QPainterPath()
+        path.addPolygon(QPolygonF([QPointF(x, y) for x, y in corners]))
+        path.closeSubpath()
+        for i in range(points):
+            x = rnd.uniform(-1, 21) + 0.0137
+            y = rnd.uniform(-1, 13) + 0.0071
+            samples += 1
+            if slabs.contains(x, y) != path.contains(QPointF(x, y)):
+                mismatches += 1
+    return mismatches, samples
+
+
+checks = {"visibility": checkVisibility, "slabs": checkSlabs}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Check the lighting and darkness geometry against "
+                    "brute force on random scenes")
+    parser.add_argument("checks", nargs="*",
+                        help="checks to run ({}), all of them by "
+                             "default".format(", ".join(sorted(checks))))
+    parser.add_argument("--trials", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    for name in args.checks:
+        if name not in checks:
+            parser.error("unknown check {}".format(name))
+
+    failed = False
+    for name in args.checks or sorted(checks):
+        mismatches, samples = checks[name](random.Random(args.seed),
+                                           args.trials)
+        print("{} {}: {} mismatches in {} samples".format(
+            "FAIL" if mismatches else "OK", name, mismatches, samples))
+        failed = failed or mismatches > 0
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,39 @@
+"""
+Map Displayer is a scene-based toolset for displaying Encounter Maps on a
+second screen for Tabletop RPGs
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Map Displayer.
+
+Map Displayer is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Map Displayer is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Map Displayer.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+class CommonValues:
+    intervalTime = 25
+    DisplayHeight = 1080
+    DisplayWidth = 1920
+    PPI = 72
+    SceneObjectTypes = ("Images", "Darkness", "Light")
+    SceneObjectTypeImage = "Images"
+    SceneObjectTypeDark = "Darkness"
+    SceneObjectTypeLight = "Light"
+
+
+def getImageBytes(img):
+    # Pixel memory of a QImage or QPixmap, 0 for None or a null image
+    if img is None or img.isNull():
+        return 0
+    return img.width() * img.height() * img.depth() // 8
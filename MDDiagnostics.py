@@ -0,0 +1,140 @@
+"""
+Map Displayer is a scene-based toolset for displaying Encounter Maps on a
+second screen for Tabletop RPGs
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Map Displayer.
+
+Map Displayer is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Map Displayer is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Map Displayer.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from PyQt5.QtWidgets import (QDialog, QTreeWidget, QTreeWidgetItem,
+                             QPushButton, QVBoxLayout)
+from PyQt5.QtCore import QObject
+import gc
+
+from MDAssets import MDImageAsset, MDAnimation
+from MDRender import MDSceneFrame
+from MDTokens import MDTokenAtlas
+
+
+def getQObjectCounts():
+    # Python side QObjects by class, the quickest way to spot a leak
+    counts = {}
+    for obj in gc.get_objects():
+        if isinstance(obj, QObject):
+            name = type(obj).__name__
+            counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+def getMemoryReport(session, compositor=None):
+    # Byte counts for everything the editor keeps around. Assets are
+    # shared between scenes, so their pixels are reported once, per asset,
+    # and each scene lists the assets it uses.
+    report = {"scenes": [], "assets": {}}
+    for scene in session.getScenes():
+        usage = scene.getMemoryUsage()
+        frame = scene.findChild(MDSceneFrame)
+        usage["name"] = scene.getName()
+        usage["frames"] = 0 if frame is None else frame.getMemoryUsage()
+        usage["assets"] = sorted(set(
+            so.getFilepath() for so in scene.getSceneObjects()["images"]))
+        usage["bytes"] = usage["fog"] + usage["frames"]
+        report["scenes"].append(usage)
+
+    for filePath, asset in MDImageAsset.assets.items():
+        usage = asset.getMemoryUsage()
+        usage["bytes"] = usage["image"] + usage["scaled"] + \
+            usage["thumbnail"] + usage["animation"]
+        report["assets"][filePath] = usage
+
+    report["animationCache"] = MDAnimation.cachedBytes
+    report["tokenAtlases"] = MDTokenAtlas.getMemoryUsage()
+    if compositor is not None:
+        report["display"] = compositor.getMemoryUsage()
+    report["qobjects"] = getQObjectCounts()
+    report["bytes"] = sum(s["bytes"] for s in report["scenes"]) + \
+        sum(a["bytes"] for a in report["assets"].values()) + \
+        sum(report.get("display", {}).values()) + report["tokenAtlases"]
+    return report
+
+
+def formatBytes(n):
+    for unit in ("B", "KB", "MB"):
+        if abs(n) < 1024:
+            return "{:.0f} {}".format(n, unit)
+        n /= 1024
+    return "{:.1f} GB".format(n)
+
+
+class MDDiagnosticsDialog(QDialog):
+    def __init__(self, getReport):
+        super(MDDiagnosticsDialog, self).__init__()
+        self.setWindowTitle("Diagnostics")
+        self.getReport = getReport
+        self.tree = QTreeWidget()
+        self.tree.setHeaderLabels(("Item", "Value"))
+        refreshBtn = QPushButton("Refresh")
+        refreshBtn.clicked.connect(self.refresh)
+        layout = QVBoxLayout()
+        layout.addWidget(self.tree)
+        layout.addWidget(refreshBtn)
+        self.setLayout(layout)
+        self.resize(520, 600)
+        self.refresh()
+
+    def addItem(self, parent, name, value=""):
+        return QTreeWidgetItem(parent, (name, str(value)))
+
+    def refresh(self):
+        report = self.getReport()
+        self.tree.clear()
+        self.addItem(self.tree, "Total", formatBytes(report["bytes"]))
+        self.addItem(self.tree, "Animation frame cache",
+                     formatBytes(report["animationCache"]))
+        self.addItem(self.tree, "Token atlases",
+                     formatBytes(report["tokenAtlases"]))
+
+        if "display" in report:
+            display = self.addItem(self.tree, "Display")
+            for key, value in report["display"].items():
+                self.addItem(display, key, formatBytes(value))
+
+        scenes = self.addItem(self.tree, "Scenes", len(report["scenes"]))
+        for scene in report["scenes"]:
+            item = self.addItem(scenes, scene["name"],
+                                formatBytes(scene["bytes"]))
+            self.addItem(item, "rendered frames",
+                         formatBytes(scene["frames"]))
+            self.addItem(item, "fog", formatBytes(scene["fog"]))
+            for key, count in scene["objects"].items():
+                self.addItem(item, key, count)
+            self.addItem(item, "signal connections", scene["connections"])
+            self.addItem(item, "assets", len(scene["assets"]))
+
+        assets = self.addItem(self.tree, "Assets", len(report["assets"]))
+        for filePath, usage in report["assets"].items():
+            item = self.addItem(assets, filePath, formatBytes(usage["bytes"]))
+            for key in ("image", "mapped", "scaled", "thumbnail",
+                        "animation"):
+                self.addItem(item, key, formatBytes(usage[key]))
+
+        qobjects = self.addItem(self.tree, "QObjects",
+                                sum(report["qobjects"].values()))
+        for name, count in sorted(report["qobjects"].items(),
+                                  key=lambda c: -c[1]):
+            self.addItem(qobjects, name, count)
+        self.tree.resizeColumnToContents(0)
@@ -0,0 +1,464 @@
+"""
+Map Displayer is a scene-based toolset for displaying Encounter Maps on a
+second screen for Tabletop RPGs
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Map Displayer.
+
+Map Displayer is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Map Displayer is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Map Displayer.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from PyQt5.QtWidgets import QWidget, QAction
+from PyQt5.QtGui import QPixmap, QPainter, QImage, QTransform
+from PyQt5 import QtCore
+from PyQt5.QtCore import (QObject, QTimer, QElapsedTimer, QEasingCurve, QRect,
+                          QPoint, Qt, pyqtSignal)
+
+from MDAssets import MDImageAsset
+from MDCommon import CommonValues, getImageBytes
+
+
+# Owns the composed display frame and the animation clock. Every output
+# (MapWindow, web display) draws from the same frame, so another screen
+# costs a blit instead of another render and another timer.
+class MDDisplayCompositor(QObject):
+    # Area of frame that changed
+    frameUpdated = pyqtSignal(QRect)
+
+    fadeTime = 1000
+    regionFadeTime = 400
+
+    def __init__(self):
+        super(MDDisplayCompositor, self).__init__()
+        self.backgroundPM = QPixmap("display_bkg.png")
+
+        # frame is the back buffer that outputs blit. Fades blend into
+        # it from frames that are already composed with the background, so
+        # each step is a single blend. targetFrame is what frame will show
+        # once every running fade is done.
+        self.targetFrame = self.composeFrame(None)
+        self.frame = QPixmap(self.targetFrame)
+        self.fromFrame = None
+        self.toFrame = None
+        self.regionFades = {}
+        self.regionCount = 0
+
+        self.timeline = MDTimeline()
+
+        # Animated images play on their own timer, each at its own frame
+        # rate, and only repaint their own rect
+        self.animations = []
+        self.animationClock = QElapsedTimer()
+        self.animationClock.start()
+        self.animationTimer = QTimer()
+        self.animationTimer.setSingleShot(True)
+        self.animationTimer.setTimerType(Qt.PreciseTimer)
+        self.animationTimer.timeout.connect(self.advanceAnimations)
+
+    def composeFrame(self, pm):
+        frame = QPixmap(CommonValues.DisplayWidth, CommonValues.DisplayHeight)
+        frame.fill(Qt.black)
+        painter = QPainter(frame)
+        painter.drawPixmap(0, 0, self.backgroundPM)
+        if pm is not None:
+            drawSource(painter, QPoint(0, 0), pm)
+        painter.end()
+        return frame
+
+    def hideScene(self):
+        self.setAnimations([])
+        self.targetFrame = self.composeFrame(None)
+        self.fadeTo(self.targetFrame)
+
+    def updateScene(self, pm):
+        if pm is not None:
+            self.setAnimations([])
+            self.targetFrame = self.composeFrame(pm)
+            self.fadeTo(self.targetFrame)
+
+    def transitionScene(self, pm):
+        # Fade out to the background, then in to the new scene. Clicking
+        # again mid-way replaces both halves, starting from what is on
+        # screen at that moment.
+        if pm is not None:
+            self.setAnimations([])
+            self.targetFrame = self.composeFrame(pm)
+            self.fadeTo(self.composeFrame(None),
+                        onFinished=lambda: self.fadeTo(self.targetFrame))
+
+    def updateRegion(self, pm, rect):
+        # Replaces only rect of the current scene with pm, which was
+        # rendered for just that rect, and fades that area on its own
+        origin = rect.topLeft()
+        rect = rect.intersected(self.targetFrame.rect())
+        if rect.isEmpty():
+            return
+        painter = QPainter(self.targetFrame)
+        painter.setClipRect(rect)
+        painter.drawPixmap(rect, self.backgroundPM, rect)
+        drawSource(painter, origin, pm)
+        painter.end()
+        if self.timeline.isActive("scene"):
+            # The running fade already ends on targetFrame
+            return
+
+        # Overlapping region fades are merged into one, starting from what
+        # is on screen now
+        for track, fade in list(self.regionFades.items()):
+            if fade[0].intersects(rect):
+                rect = rect.united(fade[0])
+                self.timeline.cancel(track)
+                del self.regionFades[track]
+        self.regionCount += 1
+        track = "region{}".format(self.regionCount)
+        self.regionFades[track] = (rect, self.frame.copy(rect),
+                                   self.targetFrame.copy(rect))
+        self.timeline.play(
+            track, MDTween(0, 1, self.regionFadeTime, QEasingCurve.InOutQuad),
+            lambda value: self.blendRegion(track, value),
+            lambda: self.regionFades.pop(track, None))
+
+    def setImage(self, img, tween=None):
+        if tween is None:
+            tween = MDTween(1, 1, 0)
+        self.targetFrame = self.composeFrame(img)
+        self.fadeTo(self.targetFrame, tween=tween)
+
+    def fadeTo(self, frame, onFinished=None, tween=None):
+        if tween is None:
+            tween = MDTween(0, 1, self.fadeTime, QEasingCurve.InOutQuad)
+        for track in self.regionFades:
+            self.timeline.cancel(track)
+        self.regionFades = {}
+        # Whatever is on screen now, even halfway through another fade,
+        # becomes the starting point
+        self.fromFrame = QPixmap(self.frame)
+        self.toFrame = frame
+        self.timeline.play("scene", tween, self.blendFrame,
+                           lambda: self.finishFade(onFinished))
+
+    def blendFrame(self, value):
+        painter = QPainter(self.frame)
+        painter.drawPixmap(0, 0, self.fromFrame)
+        painter.setOpacity(max(0, min(1, value)))
+        painter.drawPixmap(0, 0, self.toFrame)
+        painter.end()
+        self.frameUpdated.emit(self.frame.rect())
+
+    def blendRegion(self, track, value):
+        rect, fromPM, toPM = self.regionFades[track]
+        painter = QPainter(self.frame)
+        painter.drawPixmap(rect.topLeft(), fromPM)
+        painter.setOpacity(max(0, min(1, value)))
+        painter.drawPixmap(rect.topLeft(), toPM)
+        painter.end()
+        self.frameUpdated.emit(rect)
+
+    def finishFade(self, onFinished):
+        self.frame = QPixmap(self.toFrame)
+        self.fromFrame = None
+        self.toFrame = None
+        self.frameUpdated.emit(self.frame.rect())
+        if onFinished is not None:
+            onFinished()
+
+    def getFrame(self):
+        return self.frame
+
+    def getMemoryUsage(self):
+        frames = [self.backgroundPM, self.targetFrame, self.frame,
+                  self.fromFrame, self.toFrame]
+        for fade in self.regionFades.values():
+            frames.extend(fade[1:])
+        layers = []
+        for animation in self.animations:
+            layers.extend(animation[2:4])
+        return {
+            "frames": sum(getImageBytes(pm) for pm in frames),
+            "animationLayers": sum(getImageBytes(pm) for pm in layers)
+        }
+
+    def setAnimations(self, animations):
+        # animations are (filePath, rect, rotation, under, over), see
+        # MDRender.getSceneAnimations. One that is already playing keeps
+        # its place in the loop, so refreshing the layers after an edit
+        # doesn't restart it.
+        playing = {}
+        for animation in self.animations:
+            playing[(id(animation[0]), animation[1].getRect())] = animation
+        self.animations = []
+        now = self.animationClock.elapsed()
+        for filePath, rect, rotation, under, over in animations:
+            frames = MDImageAsset.getAsset(filePath).getAnimation(
+                rect.width(), rect.height(), rotation)
+            if frames is None:
+                continue
+            old = playing.get((id(frames), rect.getRect()))
+            index, due = (old[4], old[5]) if old is not None else (0, now)
+            self.animations.append([frames, rect, under, over, index, due])
+        self.scheduleAnimations()
+
+    def scheduleAnimations(self):
+        if len(self.animations) == 0:
+            self.animationTimer.stop()
+            return
+        due = min(animation[5] for animation in self.animations)
+        self.animationTimer.start(
+            max(0, due - self.animationClock.elapsed()))
+
+    def advanceAnimations(self):
+        now = self.animationClock.elapsed()
+        for animation in self.animations:
+            frames, rect, under, over, index, due = animation
+            if due > now:
+                continue
+            frame = frames.getFrame(index)
+            if frame is None:
+                animation[5] = now + 1000
+                continue
+            self.drawAnimationFrame(rect, under, frame[0], over)
+            animation[4] = index + 1
+            # Stay on the animation's own schedule, unless it fell more
+            # than a frame behind
+            animation[5] = max(due + frame[1], now)
+        self.scheduleAnimations()
+
+    def drawAnimationFrame(self, rect, under, img, over):
+        painter = QPainter(self.targetFrame)
+        painter.setClipRect(rect)
+        painter.drawPixmap(rect, self.backgroundPM, rect)
+        drawSource(painter, rect.topLeft(), under)
+        painter.drawImage(rect.topLeft(), img)
+        drawSource(painter, rect.topLeft(), over)
+        painter.end()
+        if self.timeline.isActive("scene"):
+            # The running fade picks the frame up from targetFrame
+            return
+        rect = rect.intersected(self.frame.rect())
+        painter = QPainter(self.frame)
+        painter.drawPixmap(rect, self.targetFrame, rect)
+        painter.end()
+        self.frameUpdated.emit(rect)
+
+
+class MapWindow(QWidget):
+    # One output of a compositor, created with its own compositor if none
+    # is given. Outputs can be scaled and offset (or fit to the window),
+    # mirrored for rear projection, and can stop following the display to
+    # hold on the last frame they showed.
+    def __init__(self, compositor=None):
+        super(MapWindow, self).__init__()
+        if compositor is None:
+            compositor = MDDisplayCompositor()
+            self.setMinimumHeight(CommonValues.DisplayHeight)
+            self.setMinimumWidth(CommonValues.DisplayWidth)
+        self.compositor = compositor
+        self.compositor.frameUpdated.connect(self.updateFrame)
+        self.scale = 1.0
+        self.offset = QPoint(0, 0)
+        self.fitToWindow = False
+        self.mirrored = False
+        self.heldFrame = None
+
+        self.setContextMenuPolicy(Qt.ActionsContextMenu)
+        fitAction = QAction("Fit to Window", self)
+        fitAction.setCheckable(True)
+        fitAction.toggled.connect(self.setFitToWindow)
+        mirrorAction = QAction("Mirror", self)
+        mirrorAction.setCheckable(True)
+        mirrorAction.toggled.connect(self.setMirrored)
+        followAction = QAction("Follow Display", self)
+        followAction.setCheckable(True)
+        followAction.setChecked(True)
+        followAction.toggled.connect(self.setFollowing)
+        self.addAction(fitAction)
+        self.addAction(mirrorAction)
+        self.addAction(followAction)
+
+    def getCompositor(self):
+        return self.compositor
+
+    def createOutput(self):
+        output = MapWindow(self.compositor)
+        output.setFitToWindow(True)
+        return output
+
+    def hideScene(self):
+        self.compositor.hideScene()
+
+    def updateScene(self, pm):
+        self.compositor.updateScene(pm)
+
+    def transitionScene(self, pm):
+        self.compositor.transitionScene(pm)
+
+    def updateRegion(self, pm, rect):
+        self.compositor.updateRegion(pm, rect)
+
+    def setImage(self, img, tween=None):
+        self.compositor.setImage(img, tween)
+
+    def setAnimations(self, animations):
+        self.compositor.setAnimations(animations)
+
+    def getFrame(self):
+        if self.heldFrame is not None:
+            return self.heldFrame
+        return self.compositor.getFrame()
+
+    def setScale(self, scale):
+        self.scale = scale
+        self.update()
+
+    def setOffset(self, x, y):
+        self.offset = QPoint(x, y)
+        self.update()
+
+    def setFitToWindow(self, fit):
+        self.fitToWindow = fit
+        self.update()
+
+    def setMirrored(self, mirrored):
+        self.mirrored = mirrored
+        self.update()
+
+    def setFollowing(self, following):
+        # A held frame is an implicitly shared copy, so it only costs
+        # memory once the compositor draws the next frame
+        self.heldFrame = None if following else \
+            QPixmap(self.compositor.getFrame())
+        self.update()
+
+    def isFollowing(self):
+        return self.heldFrame is None
+
+    def getTransform(self):
+        frameSize = self.compositor.getFrame().size()
+        scale, offset = self.scale, QPoint(self.offset)
+        if self.fitToWindow:
+            scale = min(self.width() / frameSize.width(),
+                        self.height() / frameSize.height())
+            offset = QPoint(
+                int((self.width() - frameSize.width() * scale) / 2),
+                int((self.height() - frameSize.height() * scale) / 2))
+        transform = QTransform()
+        transform.translate(offset.x(), offset.y())
+        transform.scale(scale, scale)
+        if self.mirrored:
+            transform.translate(frameSize.width(), 0)
+            transform.scale(-1, 1)
+        return transform
+
+    def updateFrame(self, rect):
+        if self.heldFrame is None:
+            self.update(self.getTransform().mapRect(rect).adjusted(
+                -1, -1, 1, 1))
+
+    def resizeEvent(self, event):
+        self.update()
+
+    def paintEvent(self, paintEvent):
+        painter = QPainter(self)
+        rect = paintEvent.rect()
+        frame = self.getFrame()
+        transform = self.getTransform()
+        if transform.isIdentity():
+            painter.drawPixmap(rect, frame, rect)
+        else:
+            painter.fillRect(rect, Qt.black)
+            painter.setTransform(transform)
+            painter.setRenderHint(QPainter.SmoothPixmapTransform)
+            painter.drawPixmap(0, 0, frame)
+
+
+def drawSource(painter, point, src):
+    # Scene images arrive as pixmaps, or as images wrapping shared memory
+    # when the display runs in its own process
+    if isinstance(src, QImage):
+        painter.drawImage(point, src)
+    else:
+        painter.drawPixmap(point, src)
+
+
+class MDTimeline(QObject):
+    # Runs any number of named tracks off one timer. Playing on a track
+    # that is already running cancels what was there, so superseded
+    # animations are dropped instead of queued. Tweens are advanced by the
+    # real elapsed time, so a late timer skips frames rather than slowing
+    # the animation down.
+    def __init__(self, interval=CommonValues.intervalTime):
+        super(MDTimeline, self).__init__()
+        self.tracks = {}
+        self.clock = QElapsedTimer()
+        self.timer = QTimer()
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self.advance)
+
+    def play(self, track, tween, onUpdate=None, onFinished=None):
+        self.tracks[track] = (tween, onUpdate, onFinished)
+        if onUpdate is not None:
+            onUpdate(tween.getCurrentValue())
+        if not self.timer.isActive():
+            self.clock.start()
+            self.timer.start()
+
+    def cancel(self, track):
+        self.tracks.pop(track, None)
+
+    def isActive(self, track=None):
+        if track is None:
+            return len(self.tracks) > 0
+        return track in self.tracks
+
+    @QtCore.pyqtSlot()
+    def advance(self):
+        delta = self.clock.restart()
+        for track, animation in list(self.tracks.items()):
+            tween, onUpdate, onFinished = animation
+            tween.update(delta)
+            if onUpdate is not None:
+                onUpdate(tween.getCurrentValue())
+            if tween.completed() and self.tracks.get(track) is animation:
+                del self.tracks[track]
+                if onFinished is not None:
+                    onFinished()
+        if len(self.tracks) == 0:
+            self.timer.stop()
+
+
+class MDTween:
+    def __init__(self, startValue, endValue, time,
+                 easing=QEasingCurve.Linear):
+        self.startValue = startValue
+        self.endValue = endValue
+        self.valueDelta = endValue - startValue
+        self.time = time
+        self.timeRemaining = time
+        self.curve = QEasingCurve(easing)
+
+    def update(self, delta):
+        self.timeRemaining -= delta
+        return self.getCurrentValue()
+
+    def getCurrentValue(self):
+        if self.time <= 0:
+            return self.endValue
+        progress = min(1, max(0, (self.time - self.timeRemaining) /
+                              self.time))
+        return self.startValue + (self.valueDelta *
+                                  self.curve.valueForProgress(progress))
+
+    def completed(self):
+        return self.timeRemaining <= 0
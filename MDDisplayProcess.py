@@ -0,0 +1,375 @@
+"""
+Map Displayer is a scene-based toolset for displaying Encounter Maps on a
+second screen for Tabletop RPGs
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Map Displayer.
+
+Map Displayer is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Map Displayer is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Map Displayer.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtGui import QImage, QPixmap
+from PyQt5.QtCore import QObject, QTimer, QRect, pyqtSignal
+from multiprocessing import shared_memory
+import multiprocessing
+import time
+
+from MDCommon import CommonValues
+
+
+# Runs the MapWindow in its own process so the editor's GUI thread (modal
+# dialogs, loading sessions, rendering) can never stall a fade on the
+# players' screen. Rendered images go through a ring of full frame slots
+# in shared memory, commands and slot releases through a pipe.
+class MDDisplayProcess(QObject):
+    displayError = pyqtSignal(str)
+
+    slotCount = 4
+    queueInterval = 10
+    idleInterval = 250
+    pixelFormat = QImage.Format_ARGB32_Premultiplied
+
+    def __init__(self):
+        super(MDDisplayProcess, self).__init__()
+        self.slotSize = CommonValues.DisplayWidth * \
+            CommonValues.DisplayHeight * 4
+        self.process = None
+        self.conn = None
+        self.shm = None
+        self.freeSlots = []
+        # (command, image) in the order they were made, waiting for a free
+        # slot. Commands without an image wait behind the ones before them.
+        self.queue = []
+        self.replies = []
+        self.visible = False
+        # Picks up slot releases quickly while anything is queued, and
+        # errors from the display now and then while it is running
+        self.timer = QTimer()
+        self.timer.setInterval(self.idleInterval)
+        self.timer.timeout.connect(self.retrySend)
+
+    def start(self):
+        self.shm = shared_memory.SharedMemory(
+            create=True, size=self.slotSize * self.slotCount)
+        self.freeSlots = list(range(self.slotCount))
+        # Never fork a process that already has a QApplication
+        ctx = multiprocessing.get_context("spawn")
+        self.conn, childConn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=runDisplayProcess,
+            args=(childConn, self.shm.name, self.slotSize), daemon=True)
+        self.process.start()
+        childConn.close()
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+        self.queue = []
+        if self.process is not None:
+            try:
+                self.conn.send(("quit",))
+            except OSError:
+                pass
+            self.process.join(2)
+            if self.process.is_alive():
+                self.process.terminate()
+            self.conn.close()
+            self.shm.close()
+            self.shm.unlink()
+            self.process = None
+
+    def ensureRunning(self):
+        if self.process is not None and not self.process.is_alive():
+            # What was still queued goes to the new process
+            queue = self.queue
+            self.stop()
+            self.queue = queue
+        if self.process is None:
+            self.start()
+            if self.visible:
+                self.send(("show",))
+
+    def isVisible(self):
+        return self.visible
+
+    def show(self):
+        self.ensureRunning()
+        self.visible = True
+        self.send(("show",))
+
+    def readReplies(self, timeout=0):
+        try:
+            while self.conn.poll(timeout):
+                msg = self.conn.recv()
+                if msg[0] == "release":
+                    self.freeSlots.append(msg[1])
+                elif msg[0] == "error":
+                    self.displayError.emit(msg[1])
+                else:
+                    self.replies.append(msg)
+                timeout = 0
+        except (EOFError, OSError):
+            # The process is gone, ensureRunning starts another one
+            pass
+
+    def send(self, msg, img=None):
+        self.queue.append((msg, img))
+        self.sendQueued()
+
+    def sendQueued(self):
+        # The display copies a slot out as soon as it reads the command,
+        # so images only queue up while it is more than a ring behind
+        self.readReplies()
+        while len(self.queue) > 0:
+            msg, img = self.queue[0]
+            if img is not None:
+                if len(self.freeSlots) == 0:
+                    break
+                msg = self.writeSlot(self.freeSlots.pop(0), img, *msg)
+            self.queue.pop(0)
+            self.conn.send(msg)
+        interval = self.queueInterval if len(self.queue) > 0 \
+            else self.idleInterval
+        if self.timer.interval() != interval:
+            self.timer.setInterval(interval)
+
+    def retrySend(self):
+        # A display that was closed only comes back for the next command
+        if len(self.queue) > 0:
+            self.ensureRunning()
+        self.sendQueued()
+
+    def writeSlot(self, slot, img, command, rect):
+        n = img.sizeInBytes()
+        bits = img.constBits()
+        bits.setsize(n)
+        offset = slot * self.slotSize
+        self.shm.buf[offset:offset + n] = bits
+        if rect is not None:
+            rect = (rect.x(), rect.y(), rect.width(), rect.height())
+        return (command, slot, img.width(), img.height(),
+                img.bytesPerLine(), rect)
+
+    def getSlotImage(self, pm):
+        # The image as it is copied into a slot, None (and reported) when
+        # it doesn't fit one
+        img = pm.toImage() if not isinstance(pm, QImage) else pm
+        if img.format() != self.pixelFormat:
+            img = img.convertToFormat(self.pixelFormat)
+        if img.sizeInBytes() > self.slotSize:
+            self.displayError.emit(
+                "Could not send a {}x{} image to the display, it is larger "
+                "than the display ({}x{})".format(
+                    img.width(), img.height(), CommonValues.DisplayWidth,
+                    CommonValues.DisplayHeight))
+            return None
+        return img
+
+    def sendImage(self, command, pm, rect=None):
+        self.ensureRunning()
+        img = self.getSlotImage(pm)
+        if img is None:
+            return
+        if command in ("update", "transition"):
+            # A new frame replaces one still waiting to go out, along with
+            # the regions that were to be drawn on it
+            self.queue = [q for q in self.queue
+                          if q[0][0] not in ("update", "region")]
+        self.send((command, rect), img)
+
+    def updateScene(self, pm):
+        if pm is not None:
+            self.sendImage("update", pm)
+
+    def transitionScene(self, pm):
+        if pm is not None:
+            self.sendImage("transition", pm)
+
+    def updateRegion(self, pm, rect):
+        self.sendImage("region", pm, rect)
+
+    def hideScene(self):
+        self.ensureRunning()
+        self.send(("hide",))
+
+    def setAnimations(self, animations):
+        # The layers around each animated image go through the slots like
+        # any other image, the display process decodes the frames itself
+        self.ensureRunning()
+        descriptions = []
+        for filePath, rect, rotation, under, over in animations:
+            under = self.getSlotImage(under)
+            over = self.getSlotImage(over)
+            if under is None or over is None:
+                # Stays still at the frame it has in the scene image
+                continue
+            self.send(("animUnder", rect), under)
+            self.send(("animOver", rect), over)
+            descriptions.append(
+                (filePath, (rect.x(), rect.y(), rect.width(), rect.height()),
+                 rotation))
+        self.send(("animate", descriptions))
+
+    def reloadAsset(self, filePath):
+        # Animation frames are decoded in the display process from its own
+        # assets, which don't see the file change
+        self.ensureRunning()
+        self.send(("reload", filePath))
+
+    def addOutput(self):
+        # Extra outputs live in the display process too, drawing from the
+        # same composed frame as its main window
+        self.ensureRunning()
+        self.send(("addOutput",))
+
+    def request(self, msg, timeout=5):
+        self.ensureRunning()
+        self.conn.send(msg)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            self.readReplies(0.05)
+            for reply in self.replies:
+                if reply[0] == msg[0]:
+                    self.replies.remove(reply)
+                    return reply
+        return None
+
+    def startWebDisplay(self, port):
+        reply = self.request(("startWeb", port))
+        if reply is None or reply[1] is None:
+            raise OSError("display process did not start the web display"
+                          if reply is None else reply[2])
+        return reply[1]
+
+    def stopWebDisplay(self):
+        self.ensureRunning()
+        self.send(("stopWeb",))
+
+
+class MDDisplayProcessHost(QObject):
+    # The display process side: reads commands off the pipe on a timer,
+    # so the only thing this GUI thread ever does is run the display
+    def __init__(self, conn, shmName, slotSize):
+        super(MDDisplayProcessHost, self).__init__()
+        from MDDisplay import MapWindow
+        self.conn = conn
+        self.shm = shared_memory.SharedMemory(name=shmName)
+        self.slotSize = slotSize
+        self.window = MapWindow()
+        self.outputs = []
+        self.animationLayers = []
+        self.webDisplay = None
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.readCommands)
+        self.timer.start(5)
+
+    def readImage(self, slot, width, height, bpl):
+        # Wraps the slot without copying; it is drawn into the display's
+        # own frame right away and released after that
+        offset = slot * self.slotSize
+        return QImage(self.shm.buf[offset:offset + bpl * height], width,
+                      height, bpl, MDDisplayProcess.pixelFormat)
+
+    def readCommands(self):
+        try:
+            while self.conn.poll():
+                self.runCommand(self.conn.recv())
+        except (EOFError, OSError):
+            self.quit()
+
+    def runCommand(self, msg):
+        command = msg[0]
+        if command in ("update", "transition", "region", "animUnder",
+                       "animOver"):
+            slot, width, height, bpl, rect = msg[1:]
+            img = self.readImage(slot, width, height, bpl)
+            if command == "update":
+                self.window.updateScene(img)
+            elif command == "transition":
+                self.window.transitionScene(img)
+            elif command == "region":
+                self.window.updateRegion(img, QRect(*rect))
+            else:
+                # Kept for as long as the animation plays, so it is copied
+                # out of the slot
+                self.animationLayers.append(QPixmap.fromImage(img))
+            del img
+            self.conn.send(("release", slot))
+        elif command == "animate":
+            layers = self.animationLayers
+            self.animationLayers = []
+            if len(layers) != 2 * len(msg[1]):
+                # A layer didn't make it through the slots. The previous
+                # scene's animations mustn't keep playing over this one.
+                self.window.setAnimations([])
+                return
+            self.window.setAnimations([
+                (filePath, QRect(*rect), rotation, layers[2 * i],
+                 layers[2 * i + 1])
+                for i, (filePath, rect, rotation) in enumerate(msg[1])])
+        elif command == "reload":
+            from MDAssets import MDImageAsset
+            asset = MDImageAsset.assets.get(msg[1])
+            if asset is not None:
+                asset.reload()
+        elif command == "hide":
+            self.window.hideScene()
+        elif command == "show":
+            self.window.show()
+        elif command == "addOutput":
+            output = self.window.createOutput()
+            output.show()
+            self.outputs.append(output)
+        elif command == "startWeb":
+            from MDWebDisplay import MDWebDisplay
+            try:
+                if self.webDisplay is None:
+                    self.webDisplay = MDWebDisplay(self.window.getCompositor(),
+                                                   msg[1])
+                    self.webDisplay.displayError.connect(self.sendError)
+                self.webDisplay.start()
+                self.conn.send(("startWeb", self.webDisplay.getURL(), ""))
+            except OSError as e:
+                self.conn.send(("startWeb", None, str(e)))
+        elif command == "stopWeb":
+            if self.webDisplay is not None:
+                self.webDisplay.stop()
+        elif command == "quit":
+            self.quit()
+
+    def sendError(self, message):
+        # Shown in the editor's status bar
+        try:
+            self.conn.send(("error", message))
+        except OSError:
+            pass
+
+    def quit(self):
+        self.timer.stop()
+        if self.webDisplay is not None:
+            self.webDisplay.stop()
+        QApplication.instance().quit()
+
+
+def runDisplayProcess(conn, shmName, slotSize):
+    app = QApplication([])
+    host = MDDisplayProcessHost(conn, shmName, slotSize)
+    app.exec_()
+    for output in host.outputs:
+        output.close()
+    host.window.close()
+    host.shm.close()
@@ -0,0 +1,205 @@
+"""
+Map Displayer is a scene-based toolset for displaying Encounter Maps on a
+second screen for Tabletop RPGs
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Map Displayer.
+
+Map Displayer is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Map Displayer is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Map Displayer.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from PyQt5.QtGui import QImage
+from PyQt5.QtCore import QObject, QRect, pyqtSignal
+import base64
+import numpy as np
+
+from MDCommon import CommonValues
+from MDOperations import modelOperation
+
+
+# One cell per grid square of the display, 1 where the cell is fogged.
+# Every operation works on the whole array at once instead of per cell.
+class MDFogLayer(QObject):
+    fogUpdated = pyqtSignal()
+    # Bounding rect of the cells that changed, in grid units
+    cellsChanged = pyqtSignal(QRect)
+
+    columns = -(-CommonValues.DisplayWidth // CommonValues.PPI)
+    rows = -(-CommonValues.DisplayHeight // CommonValues.PPI)
+
+    def __init__(self, cells=None):
+        super(MDFogLayer, self).__init__()
+        if cells is None:
+            cells = np.zeros((self.rows, self.columns), dtype=np.uint8)
+        self.cells = cells
+        self.image = None
+        # False while cells may be shared with a copy of this layer
+        self.ownsCells = True
+
+    @classmethod
+    def createFromJSON(cls, js):
+        rows, columns = js["rows"], js["columns"]
+        runs = np.frombuffer(base64.b64decode(js["data"]), dtype=np.uint8)
+        packed = np.repeat(runs[1::2], runs[0::2])
+        bits = np.unpackbits(packed)[:rows * columns]
+        stored = bits.reshape((rows, columns))
+        # Sessions saved with a different display size keep what overlaps
+        cells = np.zeros((cls.rows, cls.columns), dtype=np.uint8)
+        r, c = min(rows, cls.rows), min(columns, cls.columns)
+        cells[:r, :c] = stored[:r, :c]
+        return cls(cells)
+
+    def getJSON(self):
+        # Bit-pack the cells, then run length encode the packed bytes as
+        # (count, byte) pairs with counts capped at 255
+        packed = np.packbits(self.cells.ravel())
+        starts = np.concatenate(
+            ([0], np.flatnonzero(packed[1:] != packed[:-1]) + 1))
+        lengths = np.diff(np.append(starts, len(packed)))
+        repeats = (lengths + 254) // 255
+        counts = np.full(repeats.sum(), 255, dtype=np.uint8)
+        counts[np.cumsum(repeats) - 1] = lengths - 255 * (repeats - 1)
+        runs = np.empty(len(counts) * 2, dtype=np.uint8)
+        runs[0::2] = counts
+        runs[1::2] = np.repeat(packed[starts], repeats)
+        return {
+            "rows": self.rows,
+            "columns": self.columns,
+            "data": base64.b64encode(runs.tobytes()).decode("ascii")
+        }
+
+    def copy(self):
+        # Copy on write: both layers keep using the same cells (and cached
+        # image) until one of them changes
+        self.ownsCells = False
+        fog = MDFogLayer(self.cells)
+        fog.ownsCells = False
+        fog.image = self.image
+        return fog
+
+    def getCells(self):
+        return self.cells
+
+    def isFogged(self, x, y):
+        if 0 <= y < self.rows and 0 <= x < self.columns:
+            return bool(self.cells[y, x])
+        return False
+
+    def hasFog(self):
+        return bool(self.cells.any())
+
+    def applyMask(self, mask, fogged):
+        value = 1 if fogged else 0
+        changed = mask & (self.cells != value)
+        rows = np.flatnonzero(changed.any(axis=1))
+        if len(rows) == 0:
+            return
+        if not self.ownsCells:
+            self.cells = self.cells.copy()
+            self.ownsCells = True
+        self.cells[changed] = value
+        self.updateCells(changed, rows)
+
+    def updateCells(self, changed, rows):
+        columns = np.flatnonzero(changed.any(axis=0))
+        self.image = None
+        self.fogUpdated.emit()
+        self.cellsChanged.emit(QRect(
+            int(columns[0]), int(rows[0]), int(columns[-1] - columns[0] + 1),
+            int(rows[-1] - rows[0] + 1)))
+
+    def getUndoState(self):
+        # The cells themselves, shared the same way as with copy(), so an
+        # undo step only costs memory once the fog is changed after it
+        self.ownsCells = False
+        return self.cells
+
+    def restoreUndoState(self, cells):
+        changed = cells != self.cells
+        rows = np.flatnonzero(changed.any(axis=1))
+        if len(rows) == 0:
+            return
+        self.cells = cells
+        self.ownsCells = False
+        self.updateCells(changed, rows)
+
+    def cellCenters(self):
+        return np.ogrid[0.5:self.rows:1, 0.5:self.columns:1]
+
+    @modelOperation
+    def setAll(self, fogged):
+        self.applyMask(np.ones(self.cells.shape, dtype=bool), fogged)
+
+    @modelOperation
+    def setRect(self, x, y, width, height, fogged):
+        mask = np.zeros(self.cells.shape, dtype=bool)
+        mask[max(y, 0):max(y + height, 0), max(x, 0):max(x + width, 0)] = True
+        self.applyMask(mask, fogged)
+
+    @modelOperation
+    def setCircle(self, cx, cy, radius, fogged):
+        ys, xs = self.cellCenters()
+        mask = (xs - cx) ** 2 + (ys - cy) ** 2 <= radius ** 2
+        self.applyMask(mask, fogged)
+
+    @modelOperation
+    def setPolygon(self, points, fogged):
+        # Even-odd test of every cell center, one pass per polygon edge
+        ys, xs = self.cellCenters()
+        mask = np.zeros(self.cells.shape, dtype=bool)
+        for i in range(len(points)):
+            x1, y1 = points[i - 1]
+            x2, y2 = points[i]
+            if y1 == y2:
+                continue
+            crosses = (ys >= min(y1, y2)) & (ys < max(y1, y2))
+            xCross = x1 + (ys - y1) * (x2 - x1) / (y2 - y1)
+            mask ^= crosses & (xs < xCross)
+        self.applyMask(mask, fogged)
+
+    @modelOperation
+    def floodFill(self, x, y, fogged):
+        # Grow the region one step in each direction per pass, limited to
+        # cells matching the starting cell (4-connected)
+        if not (0 <= y < self.rows and 0 <= x < self.columns):
+            return
+        same = self.cells == self.cells[y, x]
+        region = np.zeros(self.cells.shape, dtype=bool)
+        region[y, x] = True
+        while True:
+            grown = region.copy()
+            grown[1:, :] |= region[:-1, :]
+            grown[:-1, :] |= region[1:, :]
+            grown[:, 1:] |= region[:, :-1]
+            grown[:, :-1] |= region[:, 1:]
+            grown &= same
+            if np.array_equal(grown, region):
+                break
+            region = grown
+        self.applyMask(region, fogged)
+
+    def getImage(self):
+        # One pixel per cell; painters stretch it over the display in a
+        # single drawImage call
+        if self.image is None:
+            argb = np.where(self.cells != 0, np.uint32(0xFF000000),
+                            np.uint32(0)).astype(np.uint32)
+            self.image = QImage(argb.tobytes(), self.columns, self.rows,
+                                self.columns * 4, QImage.Format_ARGB32).copy()
+        return self.image
+
+    def getTargetRect(self, scale=1):
+        step = CommonValues.PPI * scale
+        return QRect(0, 0, int(self.columns * step), int(self.rows * step))
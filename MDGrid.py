@@ -0,0 +1,178 @@
+"""
+Map Displayer is a scene-based toolset for displaying Encounter Maps on a
+second screen for Tabletop RPGs
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Map Displayer.
+
+Map Displayer is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Map Displayer is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Map Displayer.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from PyQt5.QtGui import (QImage, QPainter, QPainterPath, QPen, QColor,
+                         QBrush, QTransform)
+from PyQt5.QtCore import QObject, QSize, Qt, pyqtSignal
+import math
+
+from MDCommon import CommonValues
+from MDOperations import modelOperation
+
+
+# Grid lines over a scene's images, under darkness and fog. It is drawn by
+# filling with a brush made of one cached tile of the pattern instead of
+# line by line, so a whole grid costs about as much as one fillRect. Tiles
+# are QImages so thumbnails can draw grids on a worker thread.
+class MDGridLayer(QObject):
+    gridUpdated = pyqtSignal()
+
+    styles = ("none", "square", "hex")
+    lineWidth = 2
+    undoFields = ("style", "color", "opacity", "offset")
+
+    def __init__(self, style="none", color="#000000", opacity=0.5,
+                 offset=(0, 0)):
+        super(MDGridLayer, self).__init__()
+        self.style = style
+        self.color = color
+        self.opacity = opacity
+        # Shift of the grid in display pixels, to line it up with a map
+        self.offset = tuple(offset)
+        self.brushes = {}
+
+    @classmethod
+    def createFromJSON(cls, js):
+        return cls(js.get("style", "none"), js.get("color", "#000000"),
+                   js.get("opacity", 0.5), js.get("offset", (0, 0)))
+
+    def getJSON(self):
+        return {
+            "style": self.style,
+            "color": self.color,
+            "opacity": self.opacity,
+            "offset": list(self.offset)
+        }
+
+    def copy(self):
+        return MDGridLayer.createFromJSON(self.getJSON())
+
+    def getStyle(self):
+        return self.style
+
+    def getColor(self):
+        return self.color
+
+    def getOpacity(self):
+        return self.opacity
+
+    def getOffset(self):
+        return self.offset
+
+    def isVisible(self):
+        return self.style != "none" and self.opacity > 0
+
+    def updateGrid(self):
+        self.brushes = {}
+        self.gridUpdated.emit()
+
+    @modelOperation
+    def setStyle(self, style):
+        self.style = style
+        self.updateGrid()
+
+    @modelOperation
+    def setColor(self, color):
+        self.color = color
+        self.updateGrid()
+
+    @modelOperation
+    def setOpacity(self, opacity):
+        self.opacity = opacity
+        self.updateGrid()
+
+    @modelOperation
+    def setOffset(self, x, y):
+        self.offset = (x, y)
+        self.updateGrid()
+
+    def getUndoState(self):
+        return tuple(getattr(self, field) for field in self.undoFields)
+
+    def restoreUndoState(self, state):
+        for field, value in zip(self.undoFields, state):
+            setattr(self, field, value)
+        self.updateGrid()
+
+    def getRepeatSize(self, scale=1):
+        # Size of one repeat of the pattern. Hexes are pointy topped with
+        # their flat sides a grid unit apart, so the pattern is two rows of
+        # hexes high.
+        w = CommonValues.PPI * scale
+        return (w, w * math.sqrt(3)) if self.style == "hex" else (w, w)
+
+    def getTileRepeats(self, length):
+        # How many repeats of length a tile holds, picked so the tile's
+        # whole pixel size is as close as possible to them. The grid then
+        # stays on the units without stretching the tile, which would take
+        # every fill off Qt's fast untransformed path.
+        return min(range(1, 17),
+                   key=lambda n: abs(round(n * length) - n * length))
+
+    def createTile(self, scale):
+        w, h = self.getRepeatSize(scale)
+        columns, rows = self.getTileRepeats(w), self.getTileRepeats(h)
+        tile = QImage(QSize(round(columns * w), round(rows * h)),
+                      QImage.Format_ARGB32_Premultiplied)
+        tile.fill(Qt.transparent)
+        pattern = QPainterPath()
+        if self.style == "hex":
+            s = h / 3
+            pattern.moveTo(w / 2, 0)
+            for x, y in ((w, s / 2), (w, 1.5 * s), (w / 2, 2 * s),
+                         (0, 1.5 * s), (0, s / 2), (w / 2, 0)):
+                pattern.lineTo(x, y)
+            pattern.moveTo(w / 2, 2 * s)
+            pattern.lineTo(w / 2, 3 * s)
+        else:
+            pattern.addRect(0, 0, w, h)
+        # Lines on the tile's edges and corners continue in the next tile,
+        # so the neighbours' copies are stroked too and both halves of
+        # every line end up in the tile. One stroke, so crossing lines are
+        # not blended twice.
+        path = QPainterPath()
+        for i in range(-1, columns + 1):
+            for j in range(-1, rows + 1):
+                path.addPath(pattern.translated(i * w, j * h))
+        color = QColor(self.color)
+        color.setAlphaF(self.opacity)
+        pen = QPen(color, max(1.0, self.lineWidth * scale))
+        painter = QPainter(tile)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.strokePath(path, pen)
+        painter.end()
+        return tile
+
+    def getBrush(self, scale=1):
+        brush = self.brushes.get(scale)
+        if brush is None:
+            brush = QBrush(self.createTile(scale))
+            brush.setTransform(QTransform.fromTranslate(
+                round(self.offset[0] * scale), round(self.offset[1] * scale)))
+            self.brushes[scale] = brush
+        return brush
+
+    def paint(self, painter, rect, scale=1):
+        # rect is in the painter's coordinates, which have the display's
+        # top left at 0, 0 at the given scale
+        if self.isVisible():
+            painter.fillRect(rect, self.getBrush(scale))
@@ -0,0 +1,364 @@
+"""
+Map Displayer is a scene-based toolset for displaying Encounter Maps on a
+second screen for Tabletop RPGs
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Map Displayer.
+
+Map Displayer is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Map Displayer is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Map Displayer.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from PyQt5.QtGui import QImage, QImageReader
+from PyQt5.QtCore import QSize, Qt
+import argparse
+import atexit
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+
+# Decoded pixels are stored raw with this header in front of them, padded
+# out to headerSize so the pixel data starts page aligned in the mapping
+# magic, version, width, height, bytes per line, QImage format
+headerFormat = "<4sIIIII"
+headerSize = 4096
+cacheMagic = b"MDIC"
+cacheVersion = 1
+
+
+class MDImageCache:
+    defaultMaxBytes = 2 * 1024 * 1024 * 1024
+    pixelFormat = QImage.Format_ARGB32_Premultiplied
+    # Changes to the index are written at most this often (seconds), and
+    # at exit. Entries written in between are found again by readEntry.
+    saveInterval = 2
+
+    def __init__(self, cacheDir=None, maxBytes=None):
+        if cacheDir is None:
+            cacheDir = os.environ.get("MD_CACHE_DIR", os.path.join(
+                os.path.expanduser("~"), ".cache", "map-displayer"))
+        self.cacheDir = cacheDir
+        self.maxBytes = self.defaultMaxBytes if maxBytes is None else maxBytes
+        self.indexPath = os.path.join(self.cacheDir, "index.json")
+        self.lock = threading.RLock()
+        self.index = None
+        # Entries this process deleted, so merging with the index on disk
+        # doesn't bring them back
+        self.removed = set()
+        self.dirty = False
+        self.lastSave = 0
+        atexit.register(self.flushIndex)
+
+    def readIndex(self):
+        try:
+            with open(self.indexPath, "r") as f:
+                js = json.load(f)
+            if js.get("version") == cacheVersion:
+                return js
+        except (OSError, ValueError):
+            pass
+        return {"version": cacheVersion, "sources": {}, "entries": {}}
+
+    def loadIndex(self):
+        if self.index is None:
+            self.index = self.readIndex()
+        return self.index
+
+    def saveIndex(self, merge=True):
+        # Other processes (the warm command, a second editor) write the
+        # same index, so what they added since it was read is merged in
+        # instead of overwritten
+        os.makedirs(self.cacheDir, exist_ok=True)
+        if merge:
+            disk = self.readIndex()
+            for src in self.index["sources"]:
+                disk["sources"][src] = self.index["sources"][src]
+            for name, entry in self.index["entries"].items():
+                other = disk["entries"].get(name)
+                if other is not None:
+                    entry["used"] = max(entry["used"], other["used"])
+                disk["entries"][name] = entry
+            for name in self.removed:
+                disk["entries"].pop(name, None)
+            self.index = disk
+        self.removed = set()
+        self.dirty = False
+        self.lastSave = time.monotonic()
+        tmpPath = "{}.{}.{}.tmp".format(self.indexPath, os.getpid(),
+                                        threading.get_ident())
+        with open(tmpPath, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmpPath, self.indexPath)
+
+    def markDirty(self):
+        # Called with the lock held. Saving merges with the index on disk,
+        # so it is batched instead of done for every change.
+        self.dirty = True
+        if time.monotonic() - self.lastSave >= self.saveInterval:
+            self.saveIndex()
+
+    def flushIndex(self):
+        with self.lock:
+            if self.dirty:
+                try:
+                    self.saveIndex()
+                except OSError:
+                    pass
+
+    def getContentHash(self, filePath):
+        # The (path, size, mtime) triple is checked first so the file only
+        # has to be hashed again when it actually changed on disk
+        try:
+            st = os.stat(filePath)
+        except OSError:
+            return None
+        with self.lock:
+            sources = self.loadIndex()["sources"]
+            src = sources.get(filePath)
+            if src is not None and src["size"] == st.st_size and \
+                    src["mtime"] == st.st_mtime_ns:
+                return src["hash"]
+
+        hasher = hashlib.sha1()
+        with open(filePath, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                hasher.update(block)
+        contentHash = hasher.hexdigest()
+        with self.lock:
+            self.loadIndex()["sources"][filePath] = {
+                "size": st.st_size,
+                "mtime": st.st_mtime_ns,
+                "hash": contentHash
+            }
+            self.markDirty()
+        return contentHash
+
+    def getEntryName(self, contentHash, size=None):
+        variant = "full" if size is None else "{}x{}".format(
+            size.width(), size.height())
+        return "{}-{}.raw".format(contentHash, variant)
+
+    def readEntry(self, name):
+        # The returned QImage holds a reference to the mapping, so the cache
+        # file stays mapped for as long as the image is alive. copy() it
+        # before handing it to another thread.
+        path = os.path.join(self.cacheDir, name)
+        try:
+            with open(path, "rb") as f:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        try:
+            header = struct.unpack_from(headerFormat, mapping)
+        except struct.error:
+            header = (None, 0, 0, 0, 0, 0)
+        magic, version, width, height, bpl, fmt = header
+        if magic != cacheMagic or version != cacheVersion or \
+                len(mapping) < headerSize + bpl * height:
+            # Truncated or from another version, decoded again as a miss
+            mapping.close()
+            self.dropEntry(name)
+            return None
+        pixels = memoryview(mapping)[headerSize:headerSize + bpl * height]
+        with self.lock:
+            entries = self.loadIndex()["entries"]
+            if name not in entries:
+                # Written by a process that exited before saving the index
+                entries[name] = {"bytes": len(mapping)}
+                self.removed.discard(name)
+                self.markDirty()
+            entries[name]["used"] = time.time()
+        return QImage(pixels, width, height, bpl, QImage.Format(fmt))
+
+    def dropEntry(self, name):
+        try:
+            os.remove(os.path.join(self.cacheDir, name))
+        except OSError:
+            pass
+        with self.lock:
+            self.loadIndex()["entries"].pop(name, None)
+            self.removed.add(name)
+
+    def writeEntry(self, name, img):
+        if img.format() != self.pixelFormat:
+            img = img.convertToFormat(self.pixelFormat)
+        os.makedirs(self.cacheDir, exist_ok=True)
+        path = os.path.join(self.cacheDir, name)
+        tmpPath = "{}.{}.tmp".format(path, threading.get_ident())
+        header = struct.pack(headerFormat, cacheMagic, cacheVersion,
+                             img.width(), img.height(), img.bytesPerLine(),
+                             int(img.format()))
+        with open(tmpPath, "wb") as f:
+            f.write(header.ljust(headerSize, b"\0"))
+            f.write(img.constBits().asstring(img.sizeInBytes()))
+        os.replace(tmpPath, path)
+        with self.lock:
+            self.removed.discard(name)
+            self.loadIndex()["entries"][name] = {
+                "bytes": headerSize + img.sizeInBytes(),
+                "used": time.time()
+            }
+            self.evict(keep=name)
+            self.markDirty()
+        return img
+
+    def evict(self, keep=None):
+        with self.lock:
+            entries = self.loadIndex()["entries"]
+            total = sum(e["bytes"] for e in entries.values())
+            for name in sorted(entries, key=lambda n: entries[n]["used"]):
+                if total <= self.maxBytes:
+                    break
+                if name == keep:
+                    continue
+                try:
+                    os.remove(os.path.join(self.cacheDir, name))
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    # Still mapped somewhere (windows), try again next time
+                    continue
+                total -= entries.pop(name)["bytes"]
+                self.removed.add(name)
+
+    def loadImage(self, filePath, size=None):
+        # Returns the image at full resolution, or scaled to size, decoding
+        # and storing it on a miss
+        contentHash = self.getContentHash(filePath)
+        if contentHash is None:
+            return QImage()
+        name = self.getEntryName(contentHash, size)
+        img = self.readEntry(name)
+        if img is not None:
+            return img
+
+        if size is None:
+            img = QImageReader(filePath).read()
+        else:
+            full = self.readEntry(self.getEntryName(contentHash))
+            if full is None and size.width() * size.height() <= 256 * 256:
+                # setScaledSize lets decoders that support it (jpeg) skip
+                # decoding the full resolution image for small variants
+                reader = QImageReader(filePath)
+                reader.setScaledSize(size)
+                img = reader.read()
+            else:
+                if full is None:
+                    full = self.loadImage(filePath)
+                img = full.scaled(size, Qt.IgnoreAspectRatio,
+                                  Qt.SmoothTransformation)
+        if img.isNull():
+            return img
+        return self.writeEntry(name, img)
+
+    def loadThumbnail(self, filePath, maxSize):
+        size = QImageReader(filePath).size()
+        if not size.isValid():
+            return QImage()
+        size.scale(maxSize, Qt.KeepAspectRatio)
+        return self.loadImage(filePath, size)
+
+    def warmImage(self, filePath, sizes=(), thumbnailSize=None):
+        self.loadImage(filePath)
+        for size in sizes:
+            self.loadImage(filePath, size)
+        if thumbnailSize is not None:
+            self.loadThumbnail(filePath, thumbnailSize)
+
+    def getStats(self):
+        with self.lock:
+            entries = self.loadIndex()["entries"]
+            return {
+                "entries": len(entries),
+                "bytes": sum(e["bytes"] for e in entries.values()),
+                "maxBytes": self.maxBytes,
+                "sources": len(self.index["sources"])
+            }
+
+    def clear(self):
+        with self.lock:
+            entries = self.loadIndex()["entries"]
+            for name in list(entries):
+                try:
+                    os.remove(os.path.join(self.cacheDir, name))
+                except OSError:
+                    pass
+            self.index = {"version": cacheVersion, "sources": {},
+                          "entries": {}}
+            self.saveIndex(merge=False)
+
+
+imageCache = MDImageCache()
+
+
+def getSessionImagePaths(js):
+    paths = []
+    for scene in js["scenes"]:
+        for so in scene["sceneObjects"].get("images", []):
+            fp = so.get("filepath", "")
+            if len(fp) > 0 and fp not in paths:
+                paths.append(fp)
+    return paths
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Manage the Map Displayer decoded image cache")
+    parser.add_argument("--cache-dir", default=None)
+    parser.add_argument("--max-mb", type=int, default=None)
+    commands = parser.add_subparsers(dest="command")
+    warm = commands.add_parser(
+        "warm", help="decode every image of a session into the cache")
+    warm.add_argument("sessions", nargs="+")
+    warm.add_argument("--preview-scale", type=float, default=0.5)
+    commands.add_parser("stats", help="show cache size")
+    commands.add_parser("clear", help="remove every cached image")
+    args = parser.parse_args(argv)
+
+    maxBytes = None if args.max_mb is None else args.max_mb * 1024 * 1024
+    cache = MDImageCache(args.cache_dir, maxBytes)
+    if args.command == "warm":
+        from MDAssets import MDImageAsset
+        for sessionPath in args.sessions:
+            with open(sessionPath, "r") as f:
+                js = json.load(f)
+            for fp in getSessionImagePaths(js):
+                start = time.perf_counter()
+                size = QImageReader(fp).size()
+                if not size.isValid():
+                    print("skipped {} (cannot read)".format(fp))
+                    continue
+                previewSize = QSize(int(size.width() * args.preview_scale),
+                                    int(size.height() * args.preview_scale))
+                cache.warmImage(fp, (previewSize,), MDImageAsset.thumbnailSize)
+                print("{} ({:.0f} ms)".format(
+                    fp, (time.perf_counter() - start) * 1000))
+    elif args.command == "clear":
+        cache.clear()
+    else:
+        stats = cache.getStats()
+        print("{} entries from {} images, {:.1f} / {:.1f} MB".format(
+            stats["entries"], stats["sources"], stats["bytes"] / 1048576,
+            stats["maxBytes"] / 1048576))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -20,35 +20,48 @@ along with Map Displayer.
 If not, see <https://www.gnu.org/licenses/>.
 """
 
+# First, so --profile-startup can time every import after it
+import MDStartup
 from PyQt5.QtWidgets import (QApplication, QWidget, QListWidget, QGridLayout,
                              QPushButton, QLineEdit, QFileDialog, QLabel,
                              QListWidgetItem, QVBoxLayout, QHBoxLayout,
                              QScrollArea, QComboBox, QSpinBox, QStackedWidget,
-                             QDialog, QMainWindow, QAction)
+                             QDialog, QMainWindow, QAction, QCheckBox,
+                             QColorDialog)
 from PyQt5.QtGui import (QPixmap, QPainter, QPalette,
-                         QImage, QPen, QBrush, QColor)
-from PyQt5 import QtCore
-from PyQt5.QtCore import Qt, QTimer, pyqtSignal
+                         QPen, QBrush, QColor, QIcon, QPolygonF,
+                         QTransform, QRegion)
+from PyQt5.QtCore import (Qt, QTimer, QThreadPool, QStandardPaths, QSize,
+                          QSettings, pyqtSignal, QPointF, QRect, QRectF,
+                          QLineF)
+import argparse
 import json
 import sys
 import os
 
 from MDSceneData import (MDSession, SceneDarkness, SceneImage, MDScene,
-                         SceneLightCircle)
+                         SceneLightCircle, SceneToken, SceneWall,
+                         SceneDarknessPolygon)
+from MDAssets import MDImageAsset, MDAssetWatcher
+from MDGrid import MDGridLayer
+from MDCommon import CommonValues
+from MDDisplay import MapWindow, MDTween
+from MDTokens import MDTokenAtlas, drawTokens, getTokenCellSize
+from MDRender import (getSceneFrame, getSceneAnimations, shareSceneFrame,
+                      scaleRect, MDSceneThumbnailTask)
+from MDSave import MDSessionWriter, MDLoadTask
+from MDDiagnostics import getMemoryReport, MDDiagnosticsDialog
+from MDOperations import modelOperation, MDOperationRecorder
+from MDUndo import MDUndoHistory
 
 
-class CommonValues:
-    intervalTime = 25
-    DisplayHeight = 1080
-    DisplayWidth = 1920
-    PPI = 72
-    SceneObjectTypes = ("Images", "Darkness", "Light")
-    SceneObjectTypeImage = "Images"
-    SceneObjectTypeDark = "Darkness"
-    SceneObjectTypeLight = "Light"
+def getSettings():
+    return QSettings("Map Displayer", "Map Displayer")
 
 
 class MDMain(QMainWindow):
+    autosaveInterval = 2 * 60 * 1000
+
     def __init__(self, session=None):
         super(MDMain, self).__init__()
 
@@ -58,10 +71,14 @@ class MDMain(QMainWindow):
         openAction = QAction("Open", self)
         openAction.triggered.connect(self.openSession)
         saveAction = QAction("Save", self)
-        saveAction.triggered.connect(self.saveAsSession)
+        saveAction.triggered.connect(self.saveSession)
         saveAsAction = QAction("Save As", self)
         saveAsAction.triggered.connect(self.saveAsSession)
         importSceneAction = QAction("Import", self)
+        self.recorder = None
+        self.recordAction = QAction("Record Operations", self)
+        self.recordAction.setCheckable(True)
+        self.recordAction.toggled.connect(self.toggleRecording)
 
         self.statusBar()
 
@@ -71,17 +88,64 @@ class MDMain(QMainWindow):
         fileMenu.addAction(saveAction)
         fileMenu.addAction(saveAsAction)
         fileMenu.addAction(importSceneAction)
+        fileMenu.addAction(self.recordAction)
+
+        self.undoHistory = MDUndoHistory()
+        self.undoHistory.historyChanged.connect(self.updateUndoActions)
+        self.undoAction = QAction("Undo", self)
+        self.undoAction.triggered.connect(self.undo)
+        self.redoAction = QAction("Redo", self)
+        self.redoAction.triggered.connect(self.redo)
+        self.updateUndoActions()
+
+        editMenu = menuBar.addMenu("Edit")
+        editMenu.addAction(self.undoAction)
+        editMenu.addAction(self.redoAction)
+        MDStartup.mark("window menus")
+
+        self.webDisplay = None
+        self.webDisplayAction = QAction("Web Display", self)
+        self.webDisplayAction.setCheckable(True)
+        self.webDisplayAction.toggled.connect(self.toggleWebDisplay)
+
+        self.separateDisplayAction = QAction("Separate Display Process",
+                                             self)
+        self.separateDisplayAction.setCheckable(True)
+        self.separateDisplayAction.toggled.connect(self.toggleSeparateDisplay)
+
+        addOutputAction = QAction("Add Output Window", self)
+        addOutputAction.triggered.connect(self.addOutput)
+
+        displayMenu = menuBar.addMenu("Display")
+        displayMenu.addAction(addOutputAction)
+        displayMenu.addAction(self.webDisplayAction)
+        displayMenu.addAction(self.separateDisplayAction)
         menuBar.setNativeMenuBar(False)
 
         self.mapWindow = None
+        self.outputs = []
         self.session = MDSession() if session is None else session
+        self.sessionPath = None
+        self.writer = MDSessionWriter()
+        self.writer.saveFinished.connect(self.finishSave)
+        self.autosaveTimer = QTimer()
+        self.autosaveTimer.setInterval(self.autosaveInterval)
+        self.autosaveTimer.timeout.connect(self.autosaveSession)
+        self.autosaveTimer.start()
+        self.assetWatcher = MDAssetWatcher()
+        self.assetWatcher.assetReloaded.connect(self.reloadAsset)
+        self.watchAssets()
+        self.restoreTask = None
         self.sceneEditor = MDSceneEditor(self.session.getScene(0))
+        MDStartup.mark("window scene editor")
         self.sceneList = MDSceneList()
         self.sceneList.updateList(self.session.getScenes())
         self.sceneList.addingScene.connect(self.addSceneToSession)
+        self.sceneList.duplicatingScene.connect(self.duplicateScene)
         self.sceneList.currentSceneUpdated.connect(self.updateCurrentScene)
         self.imageList = MDImageObjectList()
         self.imageList.imageSelected.connect(self.addImageToScene)
+        self.imageList.tokenSelected.connect(self.addTokenToScene)
 
         displayButtons = QWidget()
         buttonLayout = QHBoxLayout()
@@ -91,11 +155,23 @@ class MDMain(QMainWindow):
         self.transitionCurrentScene.clicked.connect(self.transitionScene)
         self.hideCurrentScene = QPushButton("Hide Scene")
         self.hideCurrentScene.clicked.connect(self.hideScene)
+        self.liveUpdateBox = QCheckBox("Live Update")
+        self.liveUpdateBox.toggled.connect(self.toggleLiveUpdate)
         buttonLayout.addWidget(self.hideCurrentScene)
         buttonLayout.addWidget(self.displayCurrentScene)
         buttonLayout.addWidget(self.transitionCurrentScene)
+        buttonLayout.addWidget(self.liveUpdateBox)
         displayButtons.setLayout(buttonLayout)
 
+        # While live updating, changes to the displayed scene are gathered
+        # here and sent to the display once per frame as region updates
+        self.displayedScene = None
+        self.pendingRegion = QRegion()
+        self.liveTimer = QTimer()
+        self.liveTimer.setSingleShot(True)
+        self.liveTimer.setInterval(CommonValues.intervalTime)
+        self.liveTimer.timeout.connect(self.flushLiveUpdate)
+
         layout = QGridLayout()
         layout.addWidget(self.sceneEditor, 0, 0, 2, 1)
         layout.addWidget(self.sceneList, 0, 1)
@@ -108,11 +184,34 @@ class MDMain(QMainWindow):
         self.setWindowTitle("New Session")
 
         self.keyBindings = {
-            Qt.Key_S | Qt.ControlModifier: (self.saveAsSession,),
-            Qt.Key_S | Qt.ControlModifier | Qt.ShiftModifier:
+            Qt.Key_S | Qt.ControlModifier: (self.saveSession,),
+            int(Qt.Key_S | Qt.ControlModifier | Qt.ShiftModifier):
             (self.saveAsSession,),
             Qt.Key_O | Qt.ControlModifier: (self.openSession,),
+            Qt.Key_Z | Qt.ControlModifier: (self.undo,),
+            int(Qt.Key_Z | Qt.ControlModifier | Qt.ShiftModifier):
+            (self.redo,),
+            Qt.Key_Y | Qt.ControlModifier: (self.redo,),
+            # Not in any menu on purpose
+            int(Qt.Key_D | Qt.ControlModifier | Qt.ShiftModifier):
+            (self.openDiagnostics,),
         }
+        self.diagnosticsDialog = None
+        MDStartup.mark("window lists and layout")
+
+    def getMemoryReport(self):
+        compositor = None
+        if isinstance(self.mapWindow, MapWindow):
+            compositor = self.mapWindow.getCompositor()
+        return getMemoryReport(self.session, compositor)
+
+    def openDiagnostics(self):
+        if self.diagnosticsDialog is None:
+            self.diagnosticsDialog = MDDiagnosticsDialog(self.getMemoryReport)
+        else:
+            self.diagnosticsDialog.refresh()
+        self.diagnosticsDialog.show()
+        self.diagnosticsDialog.raise_()
 
     def keyPressEvent(self, event):
         key = event.key() | int(event.modifiers())
@@ -123,19 +222,86 @@ class MDMain(QMainWindow):
             else:
                 command[0](command[1])
 
+    def updateUndoActions(self):
+        self.undoAction.setEnabled(self.undoHistory.canUndo())
+        self.redoAction.setEnabled(self.undoHistory.canRedo())
+
+    # Operations themselves, so recordings replay them too
+    @modelOperation
+    def undo(self):
+        self.showUndoneChange(self.undoHistory.undo())
+
+    @modelOperation
+    def redo(self):
+        self.showUndoneChange(self.undoHistory.redo())
+
+    def watchAssets(self):
+        self.assetWatcher.watchPaths(self.session.getAssetPaths())
+
+    def reloadAsset(self, filePath):
+        # Scenes report what was drawn from the file, which refreshes their
+        # frames, thumbnails and, with live update, the display
+        if self.isSeparateDisplay():
+            self.mapWindow.reloadAsset(filePath)
+        for scene in self.session.getScenes():
+            scene.updateAsset(filePath)
+        self.statusBar().showMessage(
+            "Reloaded {}".format(os.path.basename(filePath)), 3000)
+
+    def showUndoneChange(self, target):
+        # Undone objects may use files that are no longer watched
+        self.watchAssets()
+        # Scenes and objects update the editor and display themselves, only
+        # the session's scene list isn't watched by anything
+        if target is not self.session:
+            return
+        scenes = self.session.getScenes()
+        cs = self.sceneEditor.getCurrentScene()
+        if cs not in scenes:
+            cs = scenes[min(self.sceneList.sceneList.currentRow(),
+                            len(scenes) - 1)]
+            self.sceneEditor.setCurrentScene(cs)
+        self.sceneList.updateList(scenes, scenes.index(cs),
+                                  self.displayedScene)
+
+    @modelOperation
     def updateCurrentScene(self, index):
         cs = self.session.getScene(index)
         self.sceneEditor.setCurrentScene(cs)
 
     def addSceneToSession(self, sceneName):
+        # Switching to the new scene goes through updateCurrentScene, so
+        # recordings replay the later operations against the right scene
         newScene = MDScene(sceneName)
         self.session.addScene(newScene)
-        self.sceneEditor.setCurrentScene(newScene)
+        self.updateCurrentScene(len(self.session.getScenes()) - 1)
         self.sceneList.updateList(self.session.getScenes(), 0)
 
+    def duplicateScene(self, index):
+        # The copy goes right after the original, e.g. for variants of a
+        # map with different fog
+        scene = self.session.getScene(index)
+        newScene = scene.copyScene("{} (copy)".format(scene.getName()))
+        shareSceneFrame(scene, newScene)
+        self.session.insertScene(index + 1, newScene)
+        self.updateCurrentScene(index + 1)
+        self.sceneList.updateList(self.session.getScenes(), index + 1,
+                                  self.displayedScene)
+
     def addImageToScene(self, index):
         si = self.imageList.getSceneImage(index)
         self.sceneEditor.addtoScene(si)
+        self.watchAssets()
+
+    def addTokenToScene(self, index):
+        token = self.imageList.getSceneToken(index)
+        if token is not None:
+            # Packed into the display's atlas now instead of on the first
+            # frame it is shown in
+            MDTokenAtlas.getEntry(token.getFilepath(),
+                                  getTokenCellSize(token))
+        self.sceneEditor.addtoScene(token)
+        self.watchAssets()
 
     def switchImage(self):
         cr = self.imageList.currentRow()
@@ -157,10 +323,29 @@ class MDMain(QMainWindow):
         for img in self.images:
             self.imageList.addItem(QListWidgetItem(img.getName()))
 
-    def displayScene(self):
+    def isSeparateDisplay(self):
+        return self.mapWindow is not None and \
+            not isinstance(self.mapWindow, MapWindow)
+
+    def getMapWindow(self, show=True):
         if self.mapWindow is None:
-            self.mapWindow = MapWindow()
+            if self.separateDisplayAction.isChecked():
+                # Imported on first use, like the web display, as most
+                # sessions never need either
+                from MDDisplayProcess import MDDisplayProcess
+                self.mapWindow = MDDisplayProcess()
+                self.mapWindow.displayError.connect(
+                    self.statusBar().showMessage)
+                self.mapWindow.start()
+            else:
+                self.mapWindow = MapWindow()
+        if show and not self.mapWindow.isVisible():
             self.mapWindow.show()
+        return self.mapWindow
+
+    @modelOperation
+    def displayScene(self):
+        self.getMapWindow()
 
         cs = self.sceneEditor.getCurrentScene()
 
@@ -168,11 +353,12 @@ class MDMain(QMainWindow):
             # Generate image
             csImage = self.generateSceneImage(cs)
             self.mapWindow.updateScene(csImage)
+            self.mapWindow.setAnimations(getSceneAnimations(cs))
+            self.setDisplayedScene(cs)
 
+    @modelOperation
     def transitionScene(self):
-        if self.mapWindow is None:
-            self.mapWindow = MapWindow()
-            self.mapWindow.show()
+        self.getMapWindow()
 
         cs = self.sceneEditor.getCurrentScene()
 
@@ -180,91 +366,231 @@ class MDMain(QMainWindow):
             # Generate image
             csImage = self.generateSceneImage(cs)
             self.mapWindow.transitionScene(csImage)
+            self.mapWindow.setAnimations(getSceneAnimations(cs))
+            self.setDisplayedScene(cs)
 
+    @modelOperation
     def hideScene(self):
-        if self.mapWindow is None:
-            self.mapWindow = MapWindow()
-            self.mapWindow.show()
+        self.getMapWindow()
         self.mapWindow.hideScene()
-
-    def generateSceneImage(self, cs):
-        sceneImg = QPixmap(CommonValues.DisplayWidth,
-                           CommonValues.DisplayHeight)
-        sceneImg.fill(Qt.transparent)
-        imgFog = QImage(CommonValues.DisplayWidth, CommonValues.DisplayHeight,
-                        QImage.Format_ARGB32)
-        imgFog.fill(Qt.transparent)
-        fogPainter = QPainter(imgFog)
-        painter = QPainter(sceneImg)
-        curSOS = cs.getSceneObjects()
-
-        for so in curSOS["images"]:
-            if not so.isHidden():
-                img = so.getImage()
-                d = so.getDimensions()
-                if img is not None:
-                    print("Drawing Image!")
-                    print(d)
-                    painter.drawPixmap(
-                        d[0] * CommonValues.PPI,
-                        d[1] * CommonValues.PPI, img)
-
-        for so in curSOS["darkness"]:
-            if not so.isHidden():
-                d = so.getDimensions()
-                fogPainter.setBrush(Qt.black)
-                fogPainter.setPen(Qt.black)
-                fogPainter.drawRect(
-                    d[0] * CommonValues.PPI, d[1] * CommonValues.PPI,
-                    d[2] * CommonValues.PPI, d[3] * CommonValues.PPI)
-
-        for so in curSOS["light"]:
-            if not so.isHidden():
-                pass
-
-        fogPainter.end()
-
-        painter.drawImage(0, 0, imgFog)
-        painter.end()
-        return sceneImg
+        self.setDisplayedScene(None)
+
+    def toggleRecording(self, recording):
+        # Recordings replay with "python MDOperations.py <file>"
+        if recording:
+            filePath = QFileDialog.getSaveFileName(
+                self, 'Record To', '', "Map Displayer Recording (*.mdrec)")
+            if filePath is None or not filePath[0]:
+                self.recordAction.setChecked(False)
+                return
+            self.recorder = MDOperationRecorder(self.session, filePath[0],
+                                                self)
+        elif self.recorder is not None:
+            self.recorder.stop()
+            self.recorder = None
+
+    def closeDisplay(self):
+        if self.webDisplayAction.isChecked():
+            self.webDisplayAction.setChecked(False)
+        if self.isSeparateDisplay():
+            self.mapWindow.stop()
+        elif self.mapWindow is not None:
+            self.mapWindow.close()
+        for output in self.outputs:
+            output.close()
+        self.outputs = []
+        self.mapWindow = None
+        self.webDisplay = None
+        self.setDisplayedScene(None)
+
+    def addOutput(self):
+        # Another window showing the same composed frame, e.g. a projector
+        # next to the players' TV. It costs a blit per update, not a render.
+        display = self.getMapWindow()
+        if self.isSeparateDisplay():
+            display.addOutput()
+        else:
+            output = display.createOutput()
+            output.show()
+            self.outputs.append(output)
+
+    def toggleSeparateDisplay(self, separate):
+        # The next display command opens the display the new way
+        self.closeDisplay()
+
+    def closeEvent(self, event):
+        self.recordAction.setChecked(False)
+        self.closeDisplay()
+        self.autosaveTimer.stop()
+        self.writer.waitForDone()
+        self.undoHistory.stop()
+        super(MDMain, self).closeEvent(event)
+
+    def toggleWebDisplay(self, enabled):
+        # The web display mirrors the map window, which doesn't have to be
+        # shown on a local screen for it to work. A separate display
+        # process runs its own web display.
+        from MDWebDisplay import MDWebDisplay
+        display = self.getMapWindow(False)
+        if enabled:
+            try:
+                if self.isSeparateDisplay():
+                    url = display.startWebDisplay(MDWebDisplay.defaultPort)
+                else:
+                    if self.webDisplay is None:
+                        self.webDisplay = MDWebDisplay(
+                            display.getCompositor())
+                        self.webDisplay.displayError.connect(
+                            self.statusBar().showMessage)
+                    self.webDisplay.start()
+                    url = self.webDisplay.getURL()
+            except OSError as e:
+                self.statusBar().showMessage(
+                    "Could not start web display: {}".format(e))
+                self.webDisplayAction.setChecked(False)
+                return
+            self.statusBar().showMessage("Web display at {}".format(url))
+        else:
+            if self.isSeparateDisplay():
+                display.stopWebDisplay()
+            elif self.webDisplay is not None:
+                self.webDisplay.stop()
+            self.statusBar().showMessage("Web display stopped")
+
+    def setDisplayedScene(self, cs):
+        if self.displayedScene is not None:
+            self.displayedScene.regionUpdated.disconnect(self.queueLiveUpdate)
+        self.displayedScene = cs
+        self.pendingRegion = QRegion()
+        if cs is not None:
+            cs.regionUpdated.connect(self.queueLiveUpdate)
+
+    def toggleLiveUpdate(self, live):
+        # Edits made while live updating was off are shown all at once
+        if live and self.displayedScene is not None:
+            self.mapWindow.updateScene(
+                self.generateSceneImage(self.displayedScene))
+            self.mapWindow.setAnimations(
+                getSceneAnimations(self.displayedScene))
+
+    def queueLiveUpdate(self, rect):
+        if self.liveUpdateBox.isChecked() and not rect.isEmpty():
+            self.pendingRegion = self.pendingRegion.united(rect)
+            if not self.liveTimer.isActive():
+                self.liveTimer.start()
+
+    def flushLiveUpdate(self):
+        cs = self.displayedScene
+        region = self.pendingRegion
+        self.pendingRegion = QRegion()
+        if cs is None or self.mapWindow is None:
+            return
+        for rect in region.rects():
+            self.mapWindow.updateRegion(self.generateSceneImage(cs, rect),
+                                        rect)
+        # Layers of animated images the change touched have to be redone
+        animations = getSceneAnimations(cs, region)
+        if animations is not None:
+            self.mapWindow.setAnimations(animations)
+
+    def generateSceneImage(self, cs, rect=None):
+        # Shares the scene's cached frame with the editor's player view
+        frame = getSceneFrame(cs).getFrame()
+        return frame if rect is None else frame.copy(rect)
+
+    def saveSession(self):
+        if self.sessionPath is None:
+            self.saveAsSession()
+        else:
+            self.writer.save(self.session, self.sessionPath)
+            self.statusBar().showMessage("Saving...")
 
     def saveAsSession(self):
         filePath = QFileDialog.getSaveFileName(
             self, 'Save File', '', "Map Displayer Session (*.mds)")
-        if filePath is not None:
-            # self.mapEditor.setFilePath(filePath)
-            session = self.session
+        if filePath is not None and filePath[0]:
             # Grab name from FilePath
-            fp = filePath[0]
-            if "/" in fp:
-                fp = fp.split("/")[-1]
+            fp = os.path.basename(filePath[0])
             if fp.endswith(".mds"):
                 fp = fp[:-4]
-            session.setName(fp)
-            sessionJS = session.getJSON()
-            self.saveJSONToFile(sessionJS, filePath[0])
-            # update the string
-            # self.mapEditor.markEdited(False)
+            self.session.setName(fp)
+            self.sessionPath = self.resourcePath(filePath[0])
+            self.saveSession()
             self.setWindowTitle(filePath[0])
 
+    def autosaveSession(self):
+        # Only scenes changed since the last save are serialized again, the
+        # rest of the snapshot is shared, and the write happens on the
+        # writer's thread
+        if not self.writer.isSaving():
+            self.writer.save(self.session, self.getAutosavePath(), True)
+
+    def getAutosavePath(self):
+        if self.sessionPath is not None:
+            return self.sessionPath + ".autosave"
+        autosaveDir = QStandardPaths.writableLocation(
+            QStandardPaths.AppDataLocation)
+        os.makedirs(autosaveDir, exist_ok=True)
+        return os.path.join(autosaveDir, "Untitled.mds.autosave")
+
+    def finishSave(self, path, error):
+        if error:
+            self.statusBar().showMessage(
+                "Could not save {}: {}".format(path, error))
+        elif path == self.sessionPath:
+            getSettings().setValue("lastSession", path)
+            self.statusBar().showMessage("Saved {}".format(path), 3000)
+
     def openSession(self):
         pathToOpen = QFileDialog.getOpenFileName(
             self, 'Open File', '', "Map Displayer Session (*.mds)")
         if pathToOpen is not None and pathToOpen[0]:
             session = self.loadSessionFromFile(pathToOpen[0])
             if session is not None:
-                self.session = session
-                self.sceneEditor.setCurrentScene(self.session.getScene(0))
-                self.sceneList.updateList(self.session.getScenes(), 0)
-                self.setWindowTitle(pathToOpen[0])
-
-    def saveJSONToFile(cls, jsObj,  path, ext=""):
-        text = json.dumps(jsObj)
-        f = open(cls.resourcePath(path+ext), "w+")
-        f.write(text)
-        f.close()
-
-    def loadSessionFromFile(cls, path):
+                self.setSession(session, pathToOpen[0])
+
+    def setSession(self, session, path):
+        # A recording belongs to the session it started with
+        self.recordAction.setChecked(False)
+        self.undoHistory.clear()
+        self.session.release()
+        self.session = session
+        self.sessionPath = path
+        self.watchAssets()
+        self.sceneEditor.setCurrentScene(self.session.getScene(0))
+        self.sceneList.updateList(self.session.getScenes(), 0)
+        self.setWindowTitle(path)
+        getSettings().setValue("lastSession", path)
+
+    def restoreLastSession(self):
+        # The window comes up with an empty session while the last one is
+        # read and its first scene decoded on the pool
+        path = getSettings().value("lastSession", "")
+        if not path or not os.path.exists(path):
+            MDStartup.printReport()
+            return
+        self.restoreTask = MDLoadTask(
+            path, self.sceneEditor.scenePreviewWindow.zoom/100)
+        self.restoreTask.signals.finished.connect(self.finishRestore)
+        QThreadPool.globalInstance().start(self.restoreTask)
+        self.statusBar().showMessage("Opening {}...".format(path))
+
+    def finishRestore(self, path, js, error, seconds):
+        self.restoreTask = None
+        MDStartup.mark("waiting for the last session")
+        MDStartup.mark("  read on the pool", seconds)
+        if js is None:
+            self.statusBar().showMessage(
+                "Could not open {}: {}".format(path, error))
+        elif self.sessionPath is None and not self.undoHistory.canUndo():
+            # Only if nothing was opened or changed in the meantime
+            self.setSession(MDSession.createFromJSON(js), path)
+            self.statusBar().showMessage("Opened {}".format(path), 3000)
+            MDStartup.mark("building the last session")
+        MDStartup.printReport()
+
+    @staticmethod
+    def loadSessionFromFile(path):
         f = open(path, "r")
         if f.mode == "r":
             contents = f.read()
@@ -317,9 +643,18 @@ class MDTextEditWindow(QWidget):
 
 
 class MDSceneEditor(QWidget):
+    fogTools = (("No Fog Tool", None),
+                ("Reveal Rect", ("rect", False)),
+                ("Hide Rect", ("rect", True)),
+                ("Reveal Circle", ("circle", False)),
+                ("Hide Circle", ("circle", True)),
+                ("Reveal Polygon", ("polygon", False)),
+                ("Hide Polygon", ("polygon", True)),
+                ("Reveal Area", ("fill", False)),
+                ("Hide Area", ("fill", True)))
+
     def __init__(self, scene=None):
         self.currentScene = MDScene() if scene is None else scene
-        self.currentScene.sceneUpdated.connect(self.updateUI)
         self.connectSceneObjects()
 
         self.selectedSO = ("", -1)
@@ -331,31 +666,82 @@ class MDSceneEditor(QWidget):
         self.nameDialog = None
         self.nameEditor = None
 
+        self.playerViewBox = QCheckBox("Player View")
+        self.playerViewBox.setToolTip(
+            "Preview the scene exactly as the display shows it")
+
         nameLayout = QHBoxLayout()
         nameLayout.addWidget(self.nameLabel)
         nameLayout.addWidget(self.nameEditBtn)
+        nameLayout.addWidget(self.playerViewBox)
         nameWidget.setLayout(nameLayout)
 
         self.objectList = MDSceneObjectList()
         self.objectList.updateList(self.currentScene.getSceneObjects())
         self.objectList.selectedSceneObject.connect(self.updateSO)
         self.objectList.addingSceneObject.connect(self.addSONoImage)
+        self.objectList.duplicatingSceneObject.connect(self.duplicateSO)
         self.scenePreviewWindow = MapScenePreview(self.currentScene)
+        self.scenePreviewWindow.darknessClicked.connect(self.selectDarkness)
+        self.playerViewBox.toggled.connect(
+            self.scenePreviewWindow.setPlayerView)
 
+        # Property views are built the first time an object of their type
+        # is selected, see getPropertyView
         self.propertyStack = QStackedWidget(self)
-        self.imageProperty = MDSceneImagePropertyView()
-        self.darknessProperty = MDSceneDarknessPropertyView()
-        self.lightProperty = MDSceneRLightPropertyView()
-
         self.propertyStack.addWidget(QWidget())
-        self.propertyStack.addWidget(self.imageProperty)
-        self.propertyStack.addWidget(self.darknessProperty)
-        self.propertyStack.addWidget(self.lightProperty)
+        self.propertyViews = {}
+
+        fogWidget = QWidget()
+        self.fogToolBox = QComboBox()
+        for tool in self.fogTools:
+            self.fogToolBox.addItem(tool[0])
+        self.fogToolBox.currentIndexChanged.connect(self.updateFogTool)
+        self.revealFogBtn = QPushButton("Reveal All")
+        self.revealFogBtn.clicked.connect(self.revealAllFog)
+        self.hideFogBtn = QPushButton("Hide All")
+        self.hideFogBtn.clicked.connect(self.hideAllFog)
+        fogLayout = QGridLayout()
+        fogLayout.addWidget(QLabel("Fog:"), 0, 0)
+        fogLayout.addWidget(self.fogToolBox, 0, 1)
+        fogLayout.addWidget(self.revealFogBtn, 1, 0)
+        fogLayout.addWidget(self.hideFogBtn, 1, 1)
+        fogWidget.setLayout(fogLayout)
+
+        gridWidget = QWidget()
+        self.gridStyleBox = QComboBox()
+        for style in ("No Grid", "Square Grid", "Hex Grid"):
+            self.gridStyleBox.addItem(style)
+        self.gridStyleBox.currentIndexChanged.connect(self.updateGridStyle)
+        self.gridColorBtn = QPushButton("Color")
+        self.gridColorBtn.clicked.connect(self.pickGridColor)
+        self.gridOpacityBox = QSpinBox()
+        self.gridOpacityBox.setRange(0, 100)
+        self.gridOpacityBox.setSuffix("%")
+        self.gridOpacityBox.valueChanged.connect(self.updateGridOpacity)
+        self.gridXBox = QSpinBox()
+        self.gridYBox = QSpinBox()
+        for box in (self.gridXBox, self.gridYBox):
+            box.setRange(-CommonValues.PPI, CommonValues.PPI)
+            box.valueChanged.connect(self.updateGridOffset)
+        gridLayout = QGridLayout()
+        gridLayout.addWidget(QLabel("Grid:"), 0, 0)
+        gridLayout.addWidget(self.gridStyleBox, 0, 1)
+        gridLayout.addWidget(self.gridColorBtn, 0, 2)
+        gridLayout.addWidget(QLabel("Opacity:"), 1, 0)
+        gridLayout.addWidget(self.gridOpacityBox, 1, 1)
+        gridLayout.addWidget(QLabel("Offset:"), 2, 0)
+        gridLayout.addWidget(self.gridXBox, 2, 1)
+        gridLayout.addWidget(self.gridYBox, 2, 2)
+        gridWidget.setLayout(gridLayout)
+        self.updateGridUI()
 
         objectBar = QWidget()
         objectLayout = QVBoxLayout()
         objectLayout.addWidget(self.objectList)
         objectLayout.addWidget(self.propertyStack)
+        objectLayout.addWidget(fogWidget)
+        objectLayout.addWidget(gridWidget)
         objectBar.setLayout(objectLayout)
 
         scrollArea = QScrollArea()
@@ -376,17 +762,33 @@ class MDSceneEditor(QWidget):
         layout.addWidget(centerArea)
         self.setLayout(layout)
 
-    def connectSceneObjects(self):
-        self.currentScene.sceneUpdated.connect(self.updateUI)
-        sos = self.currentScene.getSceneObjects()
+    def connectSceneObjects(self, connect=True):
+        # Also used to disconnect the scene that is switched away from, or
+        # switching back and forth would update the editor once per visit
+        cs = self.currentScene
+        signals = [(cs.sceneUpdated, self.updateUI),
+                   (cs.getFog().fogUpdated, self.updatePreview),
+                   (cs.getGrid().gridUpdated, self.updateGridUI)]
+        sos = cs.getSceneObjects()
         for sKey in sos:
             for so in sos[sKey]:
-                so.objectUpdated.connect(self.updateUI)
+                signals.append((so.objectUpdated, self.updateUI))
+        for signal, slot in signals:
+            if connect:
+                signal.connect(slot)
+            else:
+                try:
+                    signal.disconnect(slot)
+                except TypeError:
+                    # Added to the scene without going through the editor
+                    pass
 
     def setCurrentScene(self, cs):
+        self.connectSceneObjects(False)
         self.currentScene = cs
         self.connectSceneObjects()
         self.scenePreviewWindow.setCurrentScene(cs)
+        self.updateGridUI()
         self.updateSO(-1, -1)
         self.updateUI()
 
@@ -401,39 +803,124 @@ class MDSceneEditor(QWidget):
 
     def updateUI(self):
         sos = self.currentScene.getSceneObjects()
+        typeStr, index = self.selectedSO
+        if typeStr and index >= len(sos[typeStr]):
+            # Undoing an add took the selected object out of the scene
+            self.selectedSO = ("", -1)
+            self.updateSO(-1, -1)
+            self.scenePreviewWindow.setSelectedSO(None)
+        view = self.propertyStack.currentWidget()
+        if isinstance(view, MDSceneObjectPropertyView):
+            view.refreshUI()
         self.nameLabel.setText(self.currentScene.getName())
         self.objectList.updateList(sos, self.selectedSO)
         self.scenePreviewWindow.repaint()
 
+    def updatePreview(self):
+        self.scenePreviewWindow.repaint()
+
+    def updateFogTool(self, index):
+        self.scenePreviewWindow.setFogTool(self.fogTools[index][1])
+
+    def revealAllFog(self):
+        self.currentScene.getFog().setAll(False)
+
+    def hideAllFog(self):
+        self.currentScene.getFog().setAll(True)
+
+    def updateGridUI(self):
+        grid = self.currentScene.getGrid()
+        controls = (self.gridStyleBox, self.gridOpacityBox, self.gridXBox,
+                    self.gridYBox)
+        for control in controls:
+            control.blockSignals(True)
+        self.gridStyleBox.setCurrentIndex(
+            MDGridLayer.styles.index(grid.getStyle()))
+        self.gridOpacityBox.setValue(round(grid.getOpacity() * 100))
+        self.gridXBox.setValue(grid.getOffset()[0])
+        self.gridYBox.setValue(grid.getOffset()[1])
+        for control in controls:
+            control.blockSignals(False)
+        self.gridColorBtn.setStyleSheet(
+            "background-color: {}".format(grid.getColor()))
+        self.scenePreviewWindow.repaint()
+
+    def updateGridStyle(self, index):
+        self.currentScene.getGrid().setStyle(MDGridLayer.styles[index])
+
+    def pickGridColor(self):
+        grid = self.currentScene.getGrid()
+        color = QColorDialog.getColor(QColor(grid.getColor()), self,
+                                      "Grid Color")
+        if color.isValid():
+            grid.setColor(color.name())
+
+    def updateGridOpacity(self, opacity):
+        self.currentScene.getGrid().setOpacity(opacity / 100)
+
+    def updateGridOffset(self):
+        self.currentScene.getGrid().setOffset(self.gridXBox.value(),
+                                              self.gridYBox.value())
+
     def updateSO(self, type, index):
-        print("SO UPDATE: {}, {}".format(type, index))
         typeStr = ""
         if type > -1:
-            typeStr = ("images", "darkness", "light")[type]
+            typeStr = MDSceneObjectList.types[type][0]
             self.selectedSO = (typeStr, index)
             if index > -1:
-                # print(index)
                 so = self.currentScene.getSceneObject(typeStr, index)
-                if isinstance(so, SceneImage):
-                    self.propertyStack.setCurrentIndex(1)
-                    self.imageProperty.setSceneObject(so)
-
-                elif isinstance(so, SceneDarkness):
-                    self.propertyStack.setCurrentIndex(2)
-                    self.darknessProperty.setSceneObject(so)
-                elif isinstance(so, SceneLightCircle):
-                    self.propertyStack.setCurrentIndex(3)
-                    self.lightProperty.setSceneObject(so)
+                view = self.getPropertyView(
+                    "darknessPolygon"
+                    if isinstance(so, SceneDarknessPolygon) else typeStr)
+                self.propertyStack.setCurrentWidget(view)
+                view.setSceneObject(so)
                 self.scenePreviewWindow.setSelectedSO(so)
         else:
             self.propertyStack.setCurrentIndex(0)
 
+    def getPropertyView(self, typeStr):
+        view = self.propertyViews.get(typeStr)
+        if view is None:
+            view = {"images": MDSceneImagePropertyView,
+                    "darkness": MDSceneDarknessPropertyView,
+                    "darknessPolygon": MDSceneDarknessPolygonPropertyView,
+                    "light": MDSceneRLightPropertyView,
+                    "tokens": MDSceneTokenPropertyView,
+                    "walls": MDSceneWallPropertyView}[typeStr]()
+            self.propertyViews[typeStr] = view
+            self.propertyStack.addWidget(view)
+            if typeStr == "darknessPolygon":
+                view.drawingPolygon.connect(
+                    self.scenePreviewWindow.drawPolygon)
+        return view
+
+    def selectDarkness(self, so):
+        # Clicked in the preview
+        typeIndex = [t[0] for t in MDSceneObjectList.types].index("darkness")
+        index = self.currentScene.getSceneObjects()["darkness"].index(so)
+        self.updateSO(typeIndex, index)
+        self.objectList.updateList(self.currentScene.getSceneObjects(),
+                                   self.selectedSO)
+
+    def duplicateSO(self):
+        typeStr, index = self.selectedSO
+        if typeStr and index > -1:
+            self.addtoScene(
+                self.currentScene.getSceneObject(typeStr, index).copy())
+
     def addSONoImage(self, type):
         so = None
         if type == 0:
             so = SceneDarkness("darkness", 0, 0, 1, 1)
-        else:
+        elif type == 1:
+            so = SceneDarknessPolygon(
+                "darkness", [(0, 2), (2, 0), (4, 2), (2, 4)])
+        elif type == 2:
             so = SceneLightCircle("light", 0, 0, 6, 6)
+        elif type == 3:
+            so = SceneWall("wall", 0, 0, 4, 0)
+        else:
+            so = SceneWall("door", 0, 0, 1, 0, True)
         self.addtoScene(so)
 
     def openNameEdit(self):
@@ -449,56 +936,125 @@ class MDSceneEditor(QWidget):
         layout.addWidget(self.nameEditor)
         self.nameDialog.setLayout(layout)
         self.nameDialog.exec_()
+        # Also reached when the dialog's window is closed, which doesn't go
+        # through apply or cancel, so the dialog is never kept around
+        self.nameDialog = None
+        self.nameEditor = None
 
     def applyNameEdit(self):
         self.currentScene.setName(self.nameEditor.getName())
 
         self.nameDialog.close()
-        self.nameDialog = None
-        self.nameEditor = None
 
     def cancelNameEdit(self):
         self.nameDialog.close()
-        self.nameDialog = None
-        self.nameEditor = None
 
 
 class MDSceneList(QWidget):
     currentSceneUpdated = pyqtSignal(int)
     addingScene = pyqtSignal(str)
+    duplicatingScene = pyqtSignal(int)
+
+    thumbnailSize = QSize(160, 90)
+    thumbnailDelay = 500
 
     def __init__(self):
         super(MDSceneList, self).__init__()
         self.nameDialog = None
         self.nameEditor = None
 
+        self.scenes = []
+        self.thumbnails = {}
+        self.thumbnailRequests = {}
+        self.thumbnailTasks = []
+        self.requestCount = 0
+        self.watchedScenes = set()
+        # Edits come in bursts, the thumbnail follows once they settle
+        self.thumbnailTimer = QTimer()
+        self.thumbnailTimer.setSingleShot(True)
+        self.thumbnailTimer.setInterval(self.thumbnailDelay)
+        self.thumbnailTimer.timeout.connect(self.updateThumbnails)
+
         layout = QVBoxLayout()
         self.sceneList = QListWidget()
+        self.sceneList.setIconSize(self.thumbnailSize)
         self.sceneList.itemClicked.connect(self.updateCurrentScene)
         self.addSceneBtn = QPushButton("Add Scene")
         self.addSceneBtn.clicked.connect(self.addScene)
+        self.duplicateSceneBtn = QPushButton("Duplicate Scene")
+        self.duplicateSceneBtn.clicked.connect(self.duplicateScene)
         self.removeSceneBtn = QPushButton("Remove Scene")
         self.removeSceneBtn.setEnabled(False)
         layout.addWidget(QLabel("List of Scenes"))
         layout.addWidget(self.sceneList)
         layout.addWidget(self.addSceneBtn)
+        layout.addWidget(self.duplicateSceneBtn)
         layout.addWidget(self.removeSceneBtn)
         self.setLayout(layout)
 
     def updateList(self, list, currentRow=0, displayedScene=None):
         self.sceneList.clear()
+        self.scenes = list
 
         for scene in list:
             nameText = ""
             if scene is displayedScene:
                 nameText = "(D) "
             nameText += scene.getName()
-            self.sceneList.addItem(QListWidgetItem(nameText))
+            item = QListWidgetItem(nameText)
+            thumbnail = self.thumbnails.get(scene)
+            if thumbnail is not None:
+                item.setIcon(thumbnail[1])
+            self.sceneList.addItem(item)
+            if scene not in self.watchedScenes:
+                self.watchedScenes.add(scene)
+                scene.sceneUpdated.connect(self.queueThumbnails)
+                scene.regionUpdated.connect(self.queueThumbnails)
         self.sceneList.setCurrentRow(currentRow)
+        self.updateThumbnails()
+
+    def queueThumbnails(self, *args):
+        self.thumbnailTimer.start()
+
+    def updateThumbnails(self):
+        # Thumbnails are rendered on the pool from scene snapshots and kept
+        # with the scene version they show, so only changed scenes are
+        # rendered again. One request per scene is in flight at a time.
+        pending = set(r[0] for r in self.thumbnailRequests.values())
+        for scene in self.scenes:
+            thumbnail = self.thumbnails.get(scene)
+            if scene in pending or (thumbnail is not None and
+                                    thumbnail[0] == scene.getVersion()):
+                continue
+            self.requestCount += 1
+            self.thumbnailRequests[self.requestCount] = (
+                scene, scene.getVersion())
+            task = MDSceneThumbnailTask(self.requestCount,
+                                        scene.getSnapshot(),
+                                        self.thumbnailSize)
+            task.signals.finished.connect(self.applyThumbnail)
+            self.thumbnailTasks.append(task)
+            QThreadPool.globalInstance().start(task)
+
+    def applyThumbnail(self, requestId, img):
+        scene, version = self.thumbnailRequests.pop(requestId)
+        self.thumbnailTasks = [t for t in self.thumbnailTasks
+                               if t.requestId != requestId]
+        icon = QIcon(QPixmap.fromImage(img))
+        self.thumbnails[scene] = (version, icon)
+        if scene in self.scenes:
+            self.sceneList.item(self.scenes.index(scene)).setIcon(icon)
+        if version != scene.getVersion():
+            self.thumbnailTimer.start()
 
     def updateCurrentScene(self):
         self.currentSceneUpdated.emit(self.sceneList.currentRow())
 
+    def duplicateScene(self):
+        cr = self.sceneList.currentRow()
+        if cr >= 0:
+            self.duplicatingScene.emit(cr)
+
     def addScene(self):
         self.nameDialog = QDialog()
         layout = QVBoxLayout()
@@ -510,25 +1066,32 @@ class MDSceneList(QWidget):
         layout.addWidget(self.nameEditor)
         self.nameDialog.setLayout(layout)
         self.nameDialog.exec_()
+        self.nameDialog = None
+        self.nameEditor = None
 
     def applySceneAdd(self):
         self.addingScene.emit(self.nameEditor.getName())
         # self.sceneObject.setName(self.nameEditor.getName())
 
         self.nameDialog.close()
-        self.nameDialog = None
-        self.nameEditor = None
 
     def cancelSceneAdd(self):
         self.nameDialog.close()
-        self.nameDialog = None
-        self.nameEditor = None
 
 
 class MDSceneObjectList(QWidget):
 
     selectedSceneObject = pyqtSignal(int, int)
     addingSceneObject = pyqtSignal(int)
+    duplicatingSceneObject = pyqtSignal()
+
+    # Keys of MDScene.getSceneObjects in list order, with their headers.
+    # The type index in selectedSceneObject is the position in here.
+    types = (("images", "-----Images-----"),
+             ("darkness", "----Darkness----"),
+             ("light", "------Light------"),
+             ("tokens", "-----Tokens-----"),
+             ("walls", "------Walls------"))
 
     def __init__(self):
         super(MDSceneObjectList, self).__init__()
@@ -537,10 +1100,16 @@ class MDSceneObjectList(QWidget):
         self.objectList.itemClicked.connect(self.updateCurrentSO)
         self.objectTypeBox = QComboBox()
         self.objectTypeBox.addItem("Darkness")
+        self.objectTypeBox.addItem("Darkness (Polygon)")
         self.objectTypeBox.addItem("Light (Radius)")
+        self.objectTypeBox.addItem("Wall")
+        self.objectTypeBox.addItem("Door")
         self.addObjectBtn = QPushButton("Add Object")
         self.addObjectBtn.clicked.connect(self.createSceneObject)
 
+        self.dupObjectBtn = QPushButton("Duplicate Object")
+        self.dupObjectBtn.clicked.connect(self.duplicatingSceneObject)
+
         self.delObjectBtn = QPushButton("Delete Object")
         self.delObjectBtn.clicked.connect(self.deleteSelectedObject)
         self.delObjectBtn.setEnabled(False)
@@ -550,6 +1119,7 @@ class MDSceneObjectList(QWidget):
         layout.addWidget(self.objectList)
         layout.addWidget(self.objectTypeBox)
         layout.addWidget(self.addObjectBtn)
+        layout.addWidget(self.dupObjectBtn)
         layout.addWidget(self.delObjectBtn)
         self.setLayout(layout)
 
@@ -557,25 +1127,16 @@ class MDSceneObjectList(QWidget):
         self.objectList.clear()
         self.numObjects.clear()
 
-        self.objectList.addItem(QListWidgetItem("-----Images-----"))
-        self.addSOsToList(list["images"])
-        self.objectList.addItem(QListWidgetItem("----Darkness----"))
-        self.addSOsToList(list["darkness"])
-        self.objectList.addItem(QListWidgetItem("------Light------"))
-        self.addSOsToList(list["light"])
-
-        self.numObjects.append(len(list["images"]))
-        self.numObjects.append(len(list["darkness"]))
-        self.numObjects.append(len(list["light"]))
-        # print(index)
+        for key, header in self.types:
+            self.objectList.addItem(QListWidgetItem(header))
+            self.addSOsToList(list[key])
+            self.numObjects.append(len(list[key]))
         index = -1
         ln = 1
-        types = ["images", "darkness", "light"]
         type = indTup[0]
-        for i in range(3):
-            if types[i] == type:
+        for i in range(len(self.types)):
+            if self.types[i][0] == type:
                 index = ln + indTup[1] + 1
-                print("FOUND: {}, {}".format(indTup, index))
                 break
             ln += self.numObjects[i]
 
@@ -590,10 +1151,9 @@ class MDSceneObjectList(QWidget):
             self.objectList.addItem(QListWidgetItem(nameText))
 
     def updateCurrentSO(self):
-        print("Updating SO")
         cr = self.objectList.currentRow()
         emitData = (-1, -1)
-        for i in range(3):
+        for i in range(len(self.types)):
             if cr <= self.numObjects[i]:
                 if cr == 0:
                     emitData = (-1, -1)
@@ -641,14 +1201,27 @@ class MDSceneObjectPropertyView(QWidget):
 
     def setSceneObject(self, so):
         self.sceneObject = so
+        self.refreshUI()
+
+    def refreshUI(self):
+        # Showing the values must not write them back to the model, which
+        # would also put every selection into the undo history
+        boxes = self.findChildren(QSpinBox)
+        for box in boxes:
+            box.blockSignals(True)
         self.updateUI()
+        for box in boxes:
+            box.blockSignals(False)
+        self.nameLabel.setText(self.sceneObject.getName())
+        self.hideShowBtn.setText(
+            "Show" if self.sceneObject.isHidden() else "Hide")
 
     def updateModelPosition(self):
         self.sceneObject.setPos(self.xBox.value(),
                                 self.yBox.value())
 
     def updateUI(self):
-        print("TODO")
+        pass
 
     def toggleHidden(self):
         self.sceneObject.toggleHidden()
@@ -669,25 +1242,29 @@ class MDSceneObjectPropertyView(QWidget):
         layout.addWidget(self.nameEditor)
         self.nameDialog.setLayout(layout)
         self.nameDialog.exec_()
+        self.nameDialog = None
+        self.nameEditor = None
 
     def applyNameEdit(self):
         self.sceneObject.setName(self.nameEditor.getName())
 
         self.nameDialog.close()
-        self.nameDialog = None
-        self.nameEditor = None
 
     def cancelNameEdit(self):
         self.nameDialog.close()
-        self.nameDialog = None
-        self.nameEditor = None
 
 
 class MDSceneImagePropertyView(MDSceneObjectPropertyView):
     def __init__(self):
         super(MDSceneImagePropertyView, self).__init__()
         self.cw = QPushButton("CW")
+        self.cw.clicked.connect(self.rotateCW)
         self.ccw = QPushButton("CCW")
+        self.ccw.clicked.connect(self.rotateCCW)
+        self.scaleBox = QSpinBox()
+        self.scaleBox.setRange(1, 1000)
+        self.scaleBox.setSuffix("%")
+        self.scaleBox.valueChanged.connect(self.updateScale)
 
         layout = QGridLayout()
         layout.addWidget(self.nameWidget, 0, 0, 1, 2)
@@ -695,15 +1272,28 @@ class MDSceneImagePropertyView(MDSceneObjectPropertyView):
         layout.addWidget(self.xBox, 1, 1)
         layout.addWidget(QLabel("Y:"), 2, 0)
         layout.addWidget(self.yBox, 2, 1)
-        layout.addWidget(self.cw, 3, 0)
-        layout.addWidget(self.ccw, 3, 1)
-        layout.addWidget(self.hideShowBtn, 4, 0, 1, 2)
+        layout.addWidget(QLabel("Scale:"), 3, 0)
+        layout.addWidget(self.scaleBox, 3, 1)
+        layout.addWidget(self.cw, 4, 0)
+        layout.addWidget(self.ccw, 4, 1)
+        layout.addWidget(self.hideShowBtn, 5, 0, 1, 2)
         self.setLayout(layout)
 
+    def rotateCW(self):
+        self.sceneObject.rotate(90)
+
+    def rotateCCW(self):
+        self.sceneObject.rotate(-90)
+
+    def updateScale(self, scale):
+        if scale != round(self.sceneObject.getScale() * 100):
+            self.sceneObject.setScale(scale / 100)
+
     def updateUI(self):
         p = self.sceneObject.getPos()
         self.xBox.setValue(p[0])
         self.yBox.setValue(p[1])
+        self.scaleBox.setValue(round(self.sceneObject.getScale() * 100))
 
 
 class MDSceneDarknessPropertyView(MDSceneObjectPropertyView):
@@ -741,6 +1331,39 @@ class MDSceneDarknessPropertyView(MDSceneObjectPropertyView):
         self.hBox.setValue(d[3])
 
 
+class MDSceneDarknessPolygonPropertyView(MDSceneObjectPropertyView):
+    drawingPolygon = pyqtSignal(object)
+
+    def __init__(self):
+        super(MDSceneDarknessPolygonPropertyView, self).__init__()
+        self.pointsLabel = QLabel()
+        self.drawBtn = QPushButton("Draw Shape")
+        self.drawBtn.setToolTip("Left click the corners in the preview, "
+                                "right click to finish")
+        self.drawBtn.clicked.connect(self.drawShape)
+
+        layout = QGridLayout()
+        layout.addWidget(self.nameWidget, 0, 0, 1, 2)
+        layout.addWidget(QLabel("X:"), 1, 0)
+        layout.addWidget(self.xBox, 1, 1)
+        layout.addWidget(QLabel("Y:"), 2, 0)
+        layout.addWidget(self.yBox, 2, 1)
+        layout.addWidget(self.pointsLabel, 3, 0)
+        layout.addWidget(self.drawBtn, 3, 1)
+        layout.addWidget(self.hideShowBtn, 4, 0, 1, 2)
+        self.setLayout(layout)
+
+    def drawShape(self):
+        self.drawingPolygon.emit(self.sceneObject)
+
+    def updateUI(self):
+        p = self.sceneObject.getPos()
+        self.xBox.setValue(p[0])
+        self.yBox.setValue(p[1])
+        self.pointsLabel.setText(
+            "{} corners".format(len(self.sceneObject.getPoints())))
+
+
 class MDSceneRLightPropertyView(MDSceneObjectPropertyView):
     def __init__(self):
         super(MDSceneRLightPropertyView, self).__init__()
@@ -776,22 +1399,108 @@ class MDSceneRLightPropertyView(MDSceneObjectPropertyView):
         self.dimRadius.setValue(self.sceneObject.getDimRadus())
 
 
+class MDSceneTokenPropertyView(MDSceneObjectPropertyView):
+    def __init__(self):
+        super(MDSceneTokenPropertyView, self).__init__()
+        self.sizeBox = QSpinBox()
+        self.sizeBox.setRange(1, 10)
+        self.sizeBox.valueChanged.connect(self.updateSize)
+
+        layout = QGridLayout()
+        layout.addWidget(self.nameWidget, 0, 0, 1, 2)
+        layout.addWidget(QLabel("X:"), 1, 0)
+        layout.addWidget(self.xBox, 1, 1)
+        layout.addWidget(QLabel("Y:"), 2, 0)
+        layout.addWidget(self.yBox, 2, 1)
+        layout.addWidget(QLabel("Size:"), 3, 0)
+        layout.addWidget(self.sizeBox, 3, 1)
+        layout.addWidget(self.hideShowBtn, 4, 0, 1, 2)
+        self.setLayout(layout)
+
+    def updateSize(self, size):
+        self.sceneObject.setSize(size)
+
+    def updateUI(self):
+        p = self.sceneObject.getPos()
+        self.xBox.setValue(p[0])
+        self.yBox.setValue(p[1])
+        self.sizeBox.setValue(self.sceneObject.getSize())
+
+
+class MDSceneWallPropertyView(MDSceneObjectPropertyView):
+    def __init__(self):
+        super(MDSceneWallPropertyView, self).__init__()
+        # xBox and yBox are the start of the wall
+        self.x2Box = QSpinBox()
+        self.x2Box.valueChanged.connect(self.updateModelPosition)
+        self.y2Box = QSpinBox()
+        self.y2Box.valueChanged.connect(self.updateModelPosition)
+        self.doorBox = QCheckBox("Door")
+        self.doorBox.clicked.connect(self.updateDoor)
+        self.openBtn = QPushButton("Open")
+        self.openBtn.clicked.connect(self.toggleOpen)
+
+        layout = QGridLayout()
+        layout.addWidget(self.nameWidget, 0, 0, 1, 2)
+        layout.addWidget(QLabel("X:"), 1, 0)
+        layout.addWidget(self.xBox, 1, 1)
+        layout.addWidget(QLabel("Y:"), 2, 0)
+        layout.addWidget(self.yBox, 2, 1)
+        layout.addWidget(QLabel("End X:"), 3, 0)
+        layout.addWidget(self.x2Box, 3, 1)
+        layout.addWidget(QLabel("End Y:"), 4, 0)
+        layout.addWidget(self.y2Box, 4, 1)
+        layout.addWidget(self.doorBox, 5, 0)
+        layout.addWidget(self.openBtn, 5, 1)
+        layout.addWidget(self.hideShowBtn, 6, 0, 1, 2)
+        self.setLayout(layout)
+
+    def updateModelPosition(self):
+        self.sceneObject.setSegment(self.xBox.value(), self.yBox.value(),
+                                    self.x2Box.value(), self.y2Box.value())
+
+    def updateDoor(self, door):
+        self.sceneObject.setDoor(door)
+        self.openBtn.setEnabled(door)
+
+    def toggleOpen(self):
+        self.sceneObject.toggleOpen()
+        self.openBtn.setText(
+            "Close" if self.sceneObject.isOpen() else "Open")
+
+    def updateUI(self):
+        x1, y1, x2, y2 = self.sceneObject.getSegment()
+        self.xBox.setValue(x1)
+        self.yBox.setValue(y1)
+        self.x2Box.setValue(x2)
+        self.y2Box.setValue(y2)
+        self.doorBox.setChecked(self.sceneObject.isDoor())
+        self.openBtn.setEnabled(self.sceneObject.isDoor())
+        self.openBtn.setText(
+            "Close" if self.sceneObject.isOpen() else "Open")
+
+
 class MDImageObjectList(QWidget):
 
     imageSelected = pyqtSignal(int)
+    tokenSelected = pyqtSignal(int)
 
     def __init__(self):
         super(MDImageObjectList, self).__init__()
         self.imageList = QListWidget()
+        self.imageList.setIconSize(MDImageAsset.thumbnailSize)
         siBtn = QPushButton("Upload Image")
         siBtn.pressed.connect(self.setImage)
         selImgBtn = QPushButton("Add Image to Scene")
         selImgBtn.pressed.connect(self.addImageToScene)
+        selTokenBtn = QPushButton("Add Image as Token")
+        selTokenBtn.pressed.connect(self.addTokenToScene)
         layout = QVBoxLayout()
         layout.addWidget(QLabel("Images:"))
         layout.addWidget(self.imageList)
         layout.addWidget(siBtn)
         layout.addWidget(selImgBtn)
+        layout.addWidget(selTokenBtn)
         self.setLayout(layout)
         self.mapWindow = None
         self.images = []
@@ -799,300 +1508,450 @@ class MDImageObjectList(QWidget):
     def addImageToScene(self):
         self.imageSelected.emit(self.imageList.currentRow())
 
+    def addTokenToScene(self):
+        self.tokenSelected.emit(self.imageList.currentRow())
+
     def setImage(self):
-        pathToOpen = QFileDialog.getOpenFileName(self, 'Open File',
-                                                 '', "Image (*.png)")
-        if pathToOpen is not None and pathToOpen[0]:
-            pathName = pathToOpen[0]
-            if "/" in pathName:
-                pathName = pathName.split("/")[-1]
-            imgSO = SceneImage(pathName, pathToOpen[0])
-            self.images.append(imgSO)
+        pathsToOpen = QFileDialog.getOpenFileNames(
+            self, 'Open Files', '',
+            "Image (*.png *.apng *.jpg *.jpeg *.bmp *.gif *.webp)")
+        if pathsToOpen is not None and pathsToOpen[0]:
+            for path in pathsToOpen[0]:
+                asset = MDImageAsset.getAsset(path)
+                if asset not in self.images:
+                    self.images.append(asset)
+                    asset.thumbnailLoaded.connect(self.updateUI)
+                    asset.loadThumbnail()
             self.updateUI()
 
     def updateUI(self):
+        cr = self.imageList.currentRow()
         self.imageList.clear()
-        for img in self.images:
-            self.imageList.addItem(QListWidgetItem(img.getName()))
+        for asset in self.images:
+            item = QListWidgetItem(self.getImageName(asset))
+            thumbnail = asset.getThumbnail()
+            if thumbnail is not None:
+                item.setIcon(QIcon(thumbnail))
+            self.imageList.addItem(item)
+        self.imageList.setCurrentRow(cr)
+
+    def getImageName(self, asset):
+        pathName = asset.getFilePath()
+        if "/" in pathName:
+            pathName = pathName.split("/")[-1]
+        return pathName
 
     def getSceneImage(self, index):
-        if len(self.images) > index:
-            return self.images[index]
+        # The library only holds the asset, the SceneImage (and the full
+        # resolution decode) is only made once it is added to a scene
+        if index >= 0 and len(self.images) > index:
+            asset = self.images[index]
+            return SceneImage(self.getImageName(asset), asset.getFilePath())
+        return None
+
+    def getSceneToken(self, index):
+        if index >= 0 and len(self.images) > index:
+            asset = self.images[index]
+            return SceneToken(self.getImageName(asset), asset.getFilePath())
         return None
 
 
 class MapScenePreview(QWidget):
+    darknessClicked = pyqtSignal(object)
+
+    # (attribute, width, style, color) of the overlay pens: darkness, dim
+    # light and bright light, each Unselected/Selected and Shown/Hidden,
+    # and the fog shape being drawn
+    penStyles = (
+        ("darkUSPen", 2, Qt.SolidLine, (110, 10, 10)),
+        ("darkSSPen", 4, Qt.SolidLine, (170, 10, 10)),
+        ("darkUHPen", 2, Qt.DotLine, (110, 10, 10)),
+        ("darkSHPen", 4, Qt.DotLine, (170, 10, 10)),
+        ("dimLUSPen", 2, Qt.SolidLine, (150, 150, 12)),
+        ("dimLSSPen", 4, Qt.SolidLine, (200, 200, 12)),
+        ("dimLUHPen", 2, Qt.DashLine, (150, 150, 12)),
+        ("dimLSHPen", 4, Qt.DashLine, (200, 200, 12)),
+        ("brightLUSPen", 2, Qt.SolidLine, (60, 150, 20)),
+        ("brightLSSPen", 4, Qt.SolidLine, (60, 200, 20)),
+        ("brightLUHPen", 2, Qt.DashLine, (60, 150, 20)),
+        ("brightLSHPen", 4, Qt.DashLine, (60, 200, 20)),
+        ("wallPen", 3, Qt.SolidLine, (200, 90, 20)),
+        ("wallHPen", 3, Qt.DotLine, (200, 90, 20)),
+        ("doorPen", 3, Qt.SolidLine, (140, 70, 200)),
+        ("doorOPen", 3, Qt.DashLine, (140, 70, 200)),
+        ("fogToolPen", 2, Qt.DashLine, (20, 160, 200)))
+
     def __init__(self, scene):
         super(MapScenePreview, self).__init__()
-        self.currentScene = scene
+        self.pensCreated = False
+        self.currentScene = None
         self.selectedSO = None
         self.zoom = 50
+        self.fogTool = None
+        self.fogPoints = []
+        # Darkness polygon getting a new shape from the clicks
+        self.polygonTarget = None
+        self.playerView = False
+        # Assets whose scaled images repaint the preview when they come in
+        self.watchedAssets = set()
         self.setMinimumWidth(int(CommonValues.DisplayWidth/2))
         self.setMinimumHeight(int(CommonValues.DisplayHeight/2))
 
-        # Pen for Darkness SceneObject
-        self.darkUSPen = QPen()
-        self.darkUSPen.setWidth(2)
-        self.darkUSPen.setStyle(Qt.SolidLine)
-        self.darkUSPen.setColor(QColor(110, 10, 10))
-
-        self.darkSSPen = QPen()
-        self.darkSSPen.setWidth(4)
-        self.darkSSPen.setStyle(Qt.SolidLine)
-        self.darkSSPen.setColor(QColor(170, 10, 10))
-
-        self.darkUHPen = QPen()
-        self.darkUHPen.setWidth(2)
-        self.darkUHPen.setStyle(Qt.DotLine)
-        self.darkUHPen.setColor(QColor(110, 10, 10))
-
-        self.darkSHPen = QPen()
-        self.darkSHPen.setWidth(4)
-        self.darkSHPen.setStyle(Qt.DotLine)
-        self.darkSHPen.setColor(QColor(170, 10, 10))
-
-        # Pen for Dim Light
-        self.dimLUSPen = QPen()
-        self.dimLUSPen.setWidth(2)
-        self.dimLUSPen.setStyle(Qt.SolidLine)
-        self.dimLUSPen.setColor(QColor(150, 150, 12))
-
-        self.dimLSSPen = QPen()
-        self.dimLSSPen.setWidth(4)
-        self.dimLSSPen.setStyle(Qt.SolidLine)
-        self.dimLSSPen.setColor(QColor(200, 200, 12))
-
-        self.dimLUHPen = QPen()
-        self.dimLUHPen.setWidth(2)
-        self.dimLUHPen.setStyle(Qt.DashLine)
-        self.dimLUHPen.setColor(QColor(150, 150, 12))
-
-        self.dimLSHPen = QPen()
-        self.dimLSHPen.setWidth(4)
-        self.dimLSHPen.setStyle(Qt.DashLine)
-        self.dimLSHPen.setColor(QColor(200, 200, 12))
-
-        # Pen for Bright Light
-        self.brightLUSPen = QPen()
-        self.brightLUSPen.setWidth(2)
-        self.brightLUSPen.setStyle(Qt.SolidLine)
-        self.brightLUSPen.setColor(QColor(60, 150, 20))
-
-        self.brightLSSPen = QPen()
-        self.brightLSSPen.setWidth(4)
-        self.brightLSSPen.setStyle(Qt.SolidLine)
-        self.brightLSSPen.setColor(QColor(60, 200, 20))
-
-        self.brightLUHPen = QPen()
-        self.brightLUHPen.setWidth(2)
-        self.brightLUHPen.setStyle(Qt.DashLine)
-        self.brightLUHPen.setColor(QColor(60, 150, 20))
-
-        self.brightLSHPen = QPen()
-        self.brightLSHPen.setWidth(4)
-        self.brightLSHPen.setStyle(Qt.DashLine)
-        self.brightLSHPen.setColor(QColor(60, 200, 20))
-
         # self.previewBkg = QPixmap("preview_tiles.png")
+        self.setCurrentScene(scene)
 
     def setCurrentScene(self, scene):
+        if self.currentScene is not None:
+            getSceneFrame(self.currentScene).frameUpdated.disconnect(
+                self.updateFrame)
         self.currentScene = scene
+        if scene is not None:
+            getSceneFrame(scene).frameUpdated.connect(self.updateFrame)
         self.repaint()
 
+    def setPlayerView(self, playerView):
+        self.playerView = playerView
+        self.repaint()
+
+    def updateFrame(self, rect):
+        if self.playerView:
+            self.update(scaleRect(rect, self.zoom/100))
+
     def setSelectedSO(self, so):
+        # Only the overlay around the old and new selection changes
+        scale = self.zoom/100
+        for selected in (self.selectedSO, so):
+            if selected is not None:
+                self.update(scaleRect(selected.getBounds(), scale).adjusted(
+                    -4, -4, 4, 4))
         self.selectedSO = so
+
+    def setFogTool(self, tool):
+        self.fogTool = tool
+        self.fogPoints = []
+        self.polygonTarget = None
         self.repaint()
 
+    def drawPolygon(self, so):
+        self.polygonTarget = so
+        self.fogPoints = []
+        self.repaint()
+
+    def getGridPos(self, event):
+        scaledStep = CommonValues.PPI * (self.zoom/100)
+        return (event.x() / scaledStep, event.y() / scaledStep)
+
+    def mousePressEvent(self, event):
+        if self.currentScene is None:
+            return
+        if self.polygonTarget is not None:
+            # Corners snap to the grid, right click finishes the shape
+            if event.button() == Qt.RightButton:
+                points = self.fogPoints
+                self.fogPoints = []
+                if len(points) > 2:
+                    self.polygonTarget.setPoints(points)
+                self.polygonTarget = None
+            else:
+                pos = self.getGridPos(event)
+                self.fogPoints.append((round(pos[0]), round(pos[1])))
+            self.repaint()
+            return
+        if self.fogTool is None:
+            if event.button() == Qt.LeftButton:
+                pos = self.getGridPos(event)
+                so = self.currentScene.getDarknessAt(pos[0], pos[1])
+                if so is not None:
+                    self.darknessClicked.emit(so)
+            return
+        shape, fogged = self.fogTool
+        pos = self.getGridPos(event)
+        fog = self.currentScene.getFog()
+        if shape == "fill":
+            fog.floodFill(int(pos[0]), int(pos[1]), fogged)
+        elif shape == "polygon":
+            # Left click adds a point, right click closes the polygon
+            if event.button() == Qt.RightButton:
+                points = self.fogPoints
+                self.fogPoints = []
+                if len(points) > 2:
+                    fog.setPolygon(points, fogged)
+            else:
+                self.fogPoints.append(pos)
+            self.repaint()
+        else:
+            self.fogPoints = [pos, pos]
+
+    def mouseMoveEvent(self, event):
+        if self.polygonTarget is None and self.fogTool is not None and \
+                self.fogTool[0] != "polygon" and len(self.fogPoints) == 2:
+            self.fogPoints[1] = self.getGridPos(event)
+            self.repaint()
+
+    def mouseReleaseEvent(self, event):
+        if self.polygonTarget is not None or self.fogTool is None or \
+                self.fogTool[0] == "polygon" or len(self.fogPoints) != 2:
+            return
+        shape, fogged = self.fogTool
+        start, end = self.fogPoints
+        self.fogPoints = []
+        fog = self.currentScene.getFog()
+        if shape == "rect":
+            x1, x2 = sorted((int(start[0]), int(end[0])))
+            y1, y2 = sorted((int(start[1]), int(end[1])))
+            fog.setRect(x1, y1, x2 - x1 + 1, y2 - y1 + 1, fogged)
+        elif shape == "circle":
+            radius = ((end[0] - start[0]) ** 2 +
+                      (end[1] - start[1]) ** 2) ** 0.5
+            fog.setCircle(start[0], start[1], radius, fogged)
+
+    def createPens(self):
+        # On the first paint instead of with the widget
+        for name, width, style, color in self.penStyles:
+            setattr(self, name, QPen(QColor(*color), width, style))
+        self.pensCreated = True
+
     def paintEvent(self, paintEvent):
+        if not self.pensCreated:
+            self.createPens()
         if self.currentScene is not None:
             scale = (self.zoom/100)
-            scaledStep = CommonValues.PPI * scale
             painter = QPainter(self)
-            painter.setPen(Qt.black)
-            painter.setBrush(Qt.black)
-            # painter.drawPixmap(0, 0, self.previewBkg)
-            painter.drawRect(0, 0, int(CommonValues.DisplayWidth*scale),
-                             int(CommonValues.DisplayHeight*scale))
-            sceneObjects = self.currentScene.getSceneObjects()
-            for so in sceneObjects["images"]:
-                hidden = so.isHidden()
-                selected = so is self.selectedSO
-
-                img = so.getImage()
-                d = so.getDimensions()
-                if hidden and selected:
-                    if img is not None:
-                        painter.setOpacity(0.5)
-                        painter.drawPixmap(
-                            int(d[0]*scaledStep), int(d[1]*scaledStep),
-                            img.scaled(int(d[2]*scale), int(d[3]*scale)))
-                elif not hidden:
-                    if img is not None:
-                        painter.drawPixmap(
-                            int(d[0]*scaledStep), int(d[1]*scaledStep),
-                            img.scaled(int(d[2]*scale), int(d[3]*scale)))
-                if selected:
-                    painter.setPen(Qt.yellow)
-                    painter.setBrush(Qt.NoBrush)
-                    painter.setOpacity(1)
-                    painter.drawRect(
-                        int(d[0]*scaledStep), int(d[1]*scaledStep),
-                        int(d[2]*scale), int(d[3]*scale))
-
-            for so in sceneObjects["darkness"]:
-                hidden = so.isHidden()
-                selected = so is self.selectedSO
-
-                d = so.getDimensions()
-                d = (int(d[0] * scaledStep), int(d[1] * scaledStep),
-                     int(d[2] * scaledStep), int(d[3] * scaledStep))
+            if self.playerView:
+                # The map is the scene's cached display frame, so repaints
+                # for selection or fog tool changes are a blit plus overlay
+                rect = paintEvent.rect()
+                frame = getSceneFrame(self.currentScene).getScaledFrame(scale)
+                painter.drawPixmap(rect, frame, rect)
+            else:
+                self.paintScene(painter, scale)
+            self.paintOverlay(painter, scale)
 
+    def paintScene(self, painter, scale):
+        scaledStep = CommonValues.PPI * scale
+        painter.setPen(Qt.black)
+        painter.setBrush(Qt.black)
+        # painter.drawPixmap(0, 0, self.previewBkg)
+        painter.drawRect(0, 0, int(CommonValues.DisplayWidth*scale),
+                         int(CommonValues.DisplayHeight*scale))
+        sceneObjects = self.currentScene.getSceneObjects()
+        for so in sceneObjects["images"]:
+            if not so.isHidden():
+                self.paintSceneImage(painter, so, scale)
+
+        self.currentScene.getGrid().paint(
+            painter, QRectF(0, 0, CommonValues.DisplayWidth*scale,
+                            CommonValues.DisplayHeight*scale), scale)
+        drawTokens(painter, [so for so in sceneObjects["tokens"]
+                             if not so.isHidden()], scale)
+
+        fog = self.currentScene.getFog()
+        if fog.hasFog():
+            painter.setOpacity(0.6)
+            painter.drawImage(fog.getTargetRect(scale), fog.getImage())
+            painter.setOpacity(1)
+
+        # Visible darkness rects are filled as one merged shape, polygons
+        # with their cached path at this zoom
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(QBrush(QColor(0, 0, 0, 110)))
+        painter.drawPath(QTransform.fromScale(scaledStep, scaledStep).map(
+            self.currentScene.getDarknessPath()))
+        for so in sceneObjects["darkness"]:
+            if isinstance(so, SceneDarknessPolygon) and so.isVisible():
+                painter.drawPath(so.getPath(scale))
+
+    def paintSceneImage(self, painter, so, scale):
+        # Sizes not scaled yet are loaded on the pool, the image is
+        # stretched from another size or left grey until they are in
+        scaledStep = CommonValues.PPI * scale
+        d = so.getDimensions()
+        rect = QRect(int(d[0]*scaledStep), int(d[1]*scaledStep),
+                     int(d[2]*scale), int(d[3]*scale))
+        img = so.requestScaledImage(rect.width(), rect.height())
+        asset = so.getAsset()
+        if asset is not None and asset not in self.watchedAssets:
+            asset.scaledImageLoaded.connect(self.update)
+            self.watchedAssets.add(asset)
+        if img is None:
+            painter.fillRect(rect, Qt.darkGray)
+        else:
+            painter.drawPixmap(rect, img)
+
+    def paintOverlay(self, painter, scale):
+        # GM only markings: selection, hidden objects and outlines
+        scaledStep = CommonValues.PPI * scale
+        sceneObjects = self.currentScene.getSceneObjects()
+        so = self.selectedSO
+        if so is not None and so in sceneObjects["images"]:
+            d = so.getDimensions()
+            if so.isHidden():
+                painter.setOpacity(0.5)
+                self.paintSceneImage(painter, so, scale)
+            painter.setPen(Qt.yellow)
+            painter.setBrush(Qt.NoBrush)
+            painter.setOpacity(1)
+            painter.drawRect(
+                int(d[0]*scaledStep), int(d[1]*scaledStep),
+                int(d[2]*scale), int(d[3]*scale))
+
+        # Hidden tokens are shown faintly, all of them, since they are
+        # usually creatures waiting to be revealed
+        drawTokens(painter, [so for so in sceneObjects["tokens"]
+                             if so.isHidden()], scale, 0.4)
+        if so is not None and so in sceneObjects["tokens"]:
+            painter.setPen(Qt.yellow)
+            painter.setBrush(Qt.NoBrush)
+            painter.drawRect(scaleRect(so.getBounds(), scale))
+
+        # The merged darkness is outlined as one shape, only hidden and
+        # selected rects are drawn on their own
+        painter.setPen(self.darkUSPen)
+        painter.setBrush(Qt.NoBrush)
+        painter.drawPath(QTransform.fromScale(scaledStep, scaledStep).map(
+            self.currentScene.getDarknessPath()))
+
+        for so in sceneObjects["darkness"]:
+            hidden = so.isHidden()
+            selected = so is self.selectedSO
+            if isinstance(so, SceneDarknessPolygon):
+                # Not part of the merged outline, so always drawn
+                path = so.getPath(scale)
                 if selected:
-                    painter.setBrush(QBrush(QColor(110, 10, 10)))
-                    painter.setPen(Qt.NoPen)
                     painter.setOpacity(0.5)
-                    painter.drawRect(d[0], d[1], d[2], d[3])
-                    if hidden:
-                        painter.setPen(self.darkSHPen)
-                    else:
-                        painter.setPen(self.darkSSPen)
-                elif hidden:
-                    painter.setPen(self.darkUHPen)
-                else:
-                    painter.setPen(self.darkUSPen)
-                # painter.setPen(self.darkSHPen)
+                    painter.fillPath(path, QColor(110, 10, 10))
+                    painter.setOpacity(1)
                 painter.setBrush(Qt.NoBrush)
-                painter.setOpacity(1)
+                painter.setPen(((self.darkUSPen, self.darkUHPen),
+                                (self.darkSSPen, self.darkSHPen))
+                               [selected][hidden])
+                painter.drawPath(path)
+                continue
+            if not hidden and not selected:
+                continue
+
+            d = so.getDimensions()
+            d = (int(d[0] * scaledStep), int(d[1] * scaledStep),
+                 int(d[2] * scaledStep), int(d[3] * scaledStep))
+
+            if selected:
+                painter.setBrush(QBrush(QColor(110, 10, 10)))
+                painter.setPen(Qt.NoPen)
+                painter.setOpacity(0.5)
                 painter.drawRect(d[0], d[1], d[2], d[3])
-                painter.drawLine(d[0], d[1], d[0] + d[2], d[1] + d[3])
-                painter.drawLine(d[0], d[1] + d[3], d[0] + d[2], d[1])
-
-            for so in sceneObjects["light"]:
-                hidden = so.isHidden()
-                selected = so is self.selectedSO
-
-                p = so.getPos()
-                br = so.getBrightRadius()
-                dr = so.getDimRadus()
-                brightPen = None
-                dimPen = None
                 if hidden:
-                    dimPen = self.dimLUHPen
-                    brightPen = self.brightLUHPen
+                    painter.setPen(self.darkSHPen)
                 else:
-                    dimPen = self.dimLUSPen
-                    brightPen = self.brightLUSPen
-                if br > 0:
-                    painter.setBrush(Qt.NoBrush)
-                    painter.setPen(brightPen)
-                    painter.drawEllipse(
-                        int((p[0]-br)*scaledStep), int((p[1]-br)*scaledStep),
-                        int(2*br*scaledStep), int(2*br*scaledStep))
-                if dr > 0:
-                    dr = dr + br
-                    painter.setBrush(Qt.NoBrush)
-                    painter.setPen(dimPen)
-                    painter.drawEllipse(
-                        int((p[0]-dr)*scaledStep), int((p[1]-dr)*scaledStep),
-                        int(2*dr*scaledStep), int(2*dr*scaledStep))
-
-
-class MapWindow(QWidget):
-    def __init__(self):
-        super(MapWindow, self).__init__()
-        self.setMinimumHeight(CommonValues.DisplayHeight)
-        self.setMinimumWidth(CommonValues.DisplayWidth)
-        self.animationList = []
-        self.finalImage = None
-        self.backgroundPM = QPixmap("display_bkg.png")
-
-        # Use QTimer to allow the animation Tweens
-        self.timer = QTimer()
-        self.timer.timeout.connect(self.updateAnimation)
-        self.timer.start(CommonValues.intervalTime)
-
-    def hideScene(self):
-        self.animationList.append((None, self.finalImage, MDTween(1, 0, 1000)))
-        self.finalImage = None
-
-    def updateScene(self, pm):
-        if pm is not None:
-            self.animationList.append(
-                (self.finalImage, pm, MDTween(0, 1, 1000)))
-            self.finalImage = pm
-
-    def transitionScene(self, pm):
-        if pm is not None:
-            self.animationList.append(
-                (None, self.finalImage, MDTween(1, 0, 1000)))
-            self.animationList.append(
-                (None, pm, MDTween(0, 1, 1000)))
-            self.finalImage = pm
-
-    def setImage(self, img, tween=None):
-        if tween is None:
-            tween = MDTween(1, 1, 0)
-        self.animationList.append((None, img, tween))
-        self.finalImage = img
-
-    def paintEvent(self, paintEvent):
-        painter = QPainter(self)
-        painter.setOpacity(1)
-        painter.setPen(Qt.black)
-        painter.setBrush(Qt.black)
-        painter.setOpacity(1)
-        painter.drawPixmap(0, 0, self.backgroundPM)
-        if len(self.animationList) > 0:
-            anPM = self.animationList[0]
-            bkgPM = anPM[0]
-            if bkgPM is not None:
-                painter.drawPixmap(0, 0, bkgPM)
-
-            if anPM[1] is not None:
-                painter.setOpacity(anPM[2].getCurrentValue())
-                painter.drawPixmap(0, 0, anPM[1])
-        elif self.finalImage is not None:
-            painter.drawPixmap(0, 0, self.finalImage)
-
-    @QtCore.pyqtSlot()
-    def updateAnimation(self):
-        if len(self.animationList) > 0:
-            # perform tween update
-            animation = self.animationList[0]
-            if animation[2].completed():
-                self.animationList.pop(0)
+                    painter.setPen(self.darkSSPen)
             else:
-                animation[2].update(CommonValues.intervalTime)
-            self.repaint()
-
-
-class MDTween:
-    def __init__(self, startValue, endValue, time):
-        self.startValue = startValue
-        self.endValue = endValue
-        self.valueDelta = endValue - startValue
-        self.time = time
-        self.timeRemaining = time
-
-    def update(self, delta):
-        self.timeRemaining -= delta
-        return self.getCurrentValue()
-
-    def getCurrentValue(self):
-        # Do a linear thing
-        return self.startValue + (self.valueDelta *
-                                  ((self.time - self.timeRemaining) /
-                                   self.time))
-
-    def completed(self):
-        return self.timeRemaining <= 0
-
-
-app = QApplication([])
-mainWindow = MDMain()
-# previewWindow = QWidget()
-
-mainWindow.show()
-# previewWindow.show()
-
-app.exec_()
+                painter.setPen(self.darkUHPen)
+            # painter.setPen(self.darkSHPen)
+            painter.setBrush(Qt.NoBrush)
+            painter.setOpacity(1)
+            painter.drawRect(d[0], d[1], d[2], d[3])
+            painter.drawLine(d[0], d[1], d[0] + d[2], d[1] + d[3])
+            painter.drawLine(d[0], d[1] + d[3], d[0] + d[2], d[1])
+
+        for so in sceneObjects["light"]:
+            hidden = so.isHidden()
+            selected = so is self.selectedSO
+
+            p = so.getPos()
+            br = so.getBrightRadius()
+            dr = so.getDimRadus()
+            brightPen = None
+            dimPen = None
+            if hidden:
+                dimPen = self.dimLUHPen
+                brightPen = self.brightLUHPen
+            else:
+                dimPen = self.dimLUSPen
+                brightPen = self.brightLUSPen
+            if br > 0:
+                painter.setBrush(Qt.NoBrush)
+                painter.setPen(brightPen)
+                painter.drawEllipse(
+                    int((p[0]-br)*scaledStep), int((p[1]-br)*scaledStep),
+                    int(2*br*scaledStep), int(2*br*scaledStep))
+            if dr > 0:
+                dr = dr + br
+                painter.setBrush(Qt.NoBrush)
+                painter.setPen(dimPen)
+                painter.drawEllipse(
+                    int((p[0]-dr)*scaledStep), int((p[1]-dr)*scaledStep),
+                    int(2*dr*scaledStep), int(2*dr*scaledStep))
+            if not hidden:
+                # What the light reaches past the walls
+                bright, dim = \
+                    self.currentScene.getVisibility().getLitPaths(so)
+                painter.setPen(Qt.NoPen)
+                painter.setBrush(QBrush(QColor(230, 200, 60, 40)))
+                toPreview = QTransform.fromScale(scale, scale)
+                painter.drawPath(toPreview.map(bright))
+                painter.drawPath(toPreview.map(dim))
+
+        for so in sceneObjects["walls"]:
+            x1, y1, x2, y2 = so.getSegment()
+            if so is self.selectedSO:
+                painter.setPen(QPen(Qt.yellow, 3))
+            elif so.isHidden():
+                painter.setPen(self.wallHPen)
+            elif so.isDoor():
+                painter.setPen(self.doorOPen if so.isOpen() else self.doorPen)
+            else:
+                painter.setPen(self.wallPen)
+            painter.drawLine(QLineF(x1 * scaledStep, y1 * scaledStep,
+                                    x2 * scaledStep, y2 * scaledStep))
+
+        if len(self.fogPoints) > 0:
+            painter.setOpacity(1)
+            painter.setBrush(Qt.NoBrush)
+            painter.setPen(self.fogToolPen)
+            pts = [QPointF(p[0]*scaledStep, p[1]*scaledStep)
+                   for p in self.fogPoints]
+            shape = "polygon" if self.polygonTarget is not None \
+                else self.fogTool[0]
+            if shape == "rect":
+                painter.drawRect(QRectF(pts[0], pts[1]))
+            elif shape == "circle":
+                r = QLineF(pts[0], pts[1]).length()
+                painter.drawEllipse(pts[0], r, r)
+            else:
+                painter.drawPolyline(QPolygonF(pts))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Map Displayer")
+    parser.add_argument("session", nargs="?",
+                        help="session file to open instead of the last one")
+    parser.add_argument("--no-restore", action="store_true",
+                        help="start with an empty session")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="print how long imports and building the "
+                             "window took")
+    args = parser.parse_args(argv)
+    MDStartup.mark("imports")
+
+    app = QApplication([])
+    app.setApplicationName("Map Displayer")
+    MDStartup.mark("QApplication")
+    mainWindow = MDMain()
+    mainWindow.show()
+    app.processEvents()
+    MDStartup.mark("first paint")
+
+    if args.session is not None:
+        session = MDMain.loadSessionFromFile(args.session)
+        if session is not None:
+            mainWindow.setSession(session, args.session)
+        MDStartup.mark("open session")
+        MDStartup.printReport()
+    elif args.no_restore:
+        MDStartup.printReport()
+    else:
+        mainWindow.restoreLastSession()
+    return app.exec_()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,239 @@
+"""
+Map Displayer is a scene-based toolset for displaying Encounter Maps on a
+second screen for Tabletop RPGs
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Map Displayer.
+
+Map Displayer is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Map Displayer is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Map Displayer.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from functools import wraps
+import argparse
+import json
+import os
+import sys
+import time
+
+
+# Called as listener(target, name, args) after every operation on the
+# model (and the display commands of MDMain). Only the outermost
+# operation is reported, not the ones it calls itself.
+operationListeners = []
+# Same, but called right before the operation runs
+operationStartListeners = []
+operationDepth = [0]
+# When the outermost operation running started, in ms on the operation
+# clock. Replays set the clock to each operation's recorded time, so what
+# depends on the pace of operations (merging undo steps) comes out the
+# same as in the recorded session.
+operationTime = [0]
+replayTime = [None]
+clockStart = time.perf_counter()
+
+
+def getClockTime():
+    if replayTime[0] is not None:
+        return replayTime[0]
+    return int((time.perf_counter() - clockStart) * 1000)
+
+
+def modelOperation(method):
+    # Signals pass their own arguments to slots, so extra trailing ones are
+    # dropped the way PyQt would for the undecorated method
+    argCount = method.__code__.co_argcount - 1
+
+    @wraps(method)
+    def wrapper(self, *args):
+        args = args[:argCount]
+        if operationDepth[0] == 0:
+            operationTime[0] = getClockTime()
+            for listener in list(operationStartListeners):
+                listener(self, method.__name__, args)
+        operationDepth[0] += 1
+        try:
+            result = method(self, *args)
+        finally:
+            operationDepth[0] -= 1
+        if operationDepth[0] == 0:
+            for listener in list(operationListeners):
+                listener(self, method.__name__, args)
+        return result
+    return wrapper
+
+
+def getTargetPath(session, target, main=None):
+    # Stable address of a model object, so an operation can be found
+    # again in another process. None for objects outside the session.
+    if target is session:
+        return ["session"]
+    if main is not None and target is main:
+        return ["main"]
+    for i, scene in enumerate(session.getScenes()):
+        if target is scene:
+            return ["scene", i]
+        if target is scene.getFog():
+            return ["fog", i]
+        if target is scene.getGrid():
+            return ["grid", i]
+        sos = scene.getSceneObjects()
+        for key in sos:
+            for j, so in enumerate(sos[key]):
+                if target is so:
+                    return ["object", i, key, j]
+    return None
+
+
+def resolveTargetPath(session, path, main=None):
+    kind = path[0]
+    if kind == "session":
+        return session
+    if kind == "main":
+        return main
+    scene = session.getScene(path[1])
+    if kind == "scene":
+        return scene
+    if kind == "fog":
+        return scene.getFog()
+    if kind == "grid":
+        return scene.getGrid()
+    return scene.getSceneObject(path[2], path[3])
+
+
+def encodeArgument(arg):
+    if hasattr(arg, "getJSON"):
+        return {"class": type(arg).__name__, "json": arg.getJSON()}
+    if isinstance(arg, (list, tuple)):
+        return [encodeArgument(a) for a in arg]
+    return arg
+
+
+def decodeArgument(arg):
+    from MDSceneData import (MDScene, SceneImage, SceneDarkness,
+                             SceneDarknessPolygon, SceneLightCircle,
+                             SceneToken, SceneWall)
+    classes = {"MDScene": MDScene, "SceneImage": SceneImage,
+               "SceneDarkness": SceneDarkness,
+               "SceneDarknessPolygon": SceneDarknessPolygon,
+               "SceneLightCircle": SceneLightCircle,
+               "SceneToken": SceneToken, "SceneWall": SceneWall}
+    if isinstance(arg, dict) and "class" in arg:
+        return classes[arg["class"]].createFromJSON(arg["json"])
+    if isinstance(arg, list):
+        return [decodeArgument(a) for a in arg]
+    return arg
+
+
+# Writes every operation made on a session to a file, one JSON object per
+# line. The first line holds the session as it was when recording started.
+class MDOperationRecorder:
+    def __init__(self, session, path, main=None):
+        self.session = session
+        self.main = main
+        self.file = open(path, "w")
+        self.start = getClockTime()
+        self.file.write(json.dumps({"session": session.getJSON()}) + "\n")
+        operationListeners.append(self.record)
+
+    def record(self, target, name, args):
+        path = getTargetPath(self.session, target, self.main)
+        if path is None:
+            return
+        self.file.write(json.dumps({
+            "t": (operationTime[0] - self.start) / 1000,
+            "target": path,
+            "op": name,
+            "args": [encodeArgument(a) for a in args]
+        }) + "\n")
+
+    def stop(self):
+        if self.record in operationListeners:
+            operationListeners.remove(self.record)
+        self.file.close()
+
+
+def getPercentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def replayOperations(path, realTime=False, window=None):
+    # Re-runs a recording on a fresh MDMain and returns the latency of
+    # every operation in ms, by operation name. Pending events are
+    # processed after each operation, so whatever it triggers right away
+    # (repaints, live updates) is part of its time.
+    from PyQt5.QtWidgets import QApplication
+    from MDMain import MDMain
+    from MDSceneData import MDSession
+    app = QApplication.instance()
+    with open(path, "r") as f:
+        header = json.loads(f.readline())
+        if window is None:
+            window = MDMain(MDSession.createFromJSON(header["session"]))
+            window.show()
+        session = window.session
+        latencies = {}
+        start = time.perf_counter()
+        for line in f:
+            entry = json.loads(line)
+            if realTime:
+                wait = entry["t"] - (time.perf_counter() - start)
+                while wait > 0:
+                    app.processEvents()
+                    time.sleep(min(wait, 0.005))
+                    wait = entry["t"] - (time.perf_counter() - start)
+            target = resolveTargetPath(session, entry["target"], window)
+            args = [decodeArgument(a) for a in entry["args"]]
+            opStart = time.perf_counter()
+            replayTime[0] = round(entry["t"] * 1000)
+            try:
+                getattr(target, entry["op"])(*args)
+            finally:
+                replayTime[0] = None
+            app.processEvents()
+            name = "{}.{}".format(type(target).__name__, entry["op"])
+            latencies.setdefault(name, []).append(
+                (time.perf_counter() - opStart) * 1000)
+    return latencies
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Replay recorded Map Displayer operations headlessly "
+                    "and report their latency")
+    parser.add_argument("recording")
+    parser.add_argument("--real-time", action="store_true",
+                        help="keep the recorded pace instead of running "
+                             "as fast as possible")
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtWidgets import QApplication
+    app = QApplication([])
+    latencies = replayOperations(args.recording, args.real_time)
+    print("{:<36} {:>6} {:>8} {:>8} {:>8} {:>8}".format(
+        "operation", "count", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+    for name in sorted(latencies):
+        values = latencies[name]
+        print("{:<36} {:>6} {:>8.2f} {:>8.2f} {:>8.2f} {:>8.2f}".format(
+            name, len(values), getPercentile(values, 50),
+            getPercentile(values, 90), getPercentile(values, 99),
+            max(values)))
+    app.quit()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,310 @@
+"""
+Map Displayer is a scene-based toolset for displaying Encounter Maps on a
+second screen for Tabletop RPGs
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Map Displayer.
+
+Map Displayer is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Map Displayer is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Map Displayer.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+from PyQt5.QtGui import (QPixmap, QPainter, QImage, QRegion, QTransform,
+                         QColor, QPolygonF)
+from PyQt5.QtCore import (QObject, QRunnable, QRect, QSize, QPointF, Qt,
+                          pyqtSignal)
+
+from MDCommon import CommonValues, getImageBytes
+from MDFog import MDFogLayer
+from MDGrid import MDGridLayer
+from MDImageCache import imageCache
+from MDSceneData import SceneDarknessPolygon
+from MDTokens import drawTokens
+
+
+def getDisplayRect():
+    return QRect(0, 0, CommonValues.DisplayWidth, CommonValues.DisplayHeight)
+
+
+def renderScene(cs, rect=None, images=slice(None), effects=True):
+    # Renders the part of the scene inside rect (display pixels, the whole
+    # display by default) into a pixmap the size of rect. Objects outside
+    # of rect are skipped entirely. images selects which of the scene's
+    # images are drawn and effects whether darkness and fog are, so the
+    # layers around an animated image can be rendered on their own.
+    if rect is None:
+        rect = getDisplayRect()
+    sceneImg = QPixmap(rect.size())
+    sceneImg.fill(Qt.transparent)
+    imgFog = QImage(rect.size(), QImage.Format_ARGB32_Premultiplied)
+    imgFog.fill(Qt.transparent)
+    fogPainter = QPainter(imgFog)
+    painter = QPainter(sceneImg)
+    for p in (painter, fogPainter):
+        p.translate(-rect.x(), -rect.y())
+        p.setClipRect(rect)
+    curSOS = cs.getSceneObjects()
+
+    for so in curSOS["images"][images]:
+        if not so.isHidden() and so.getBounds().intersects(rect):
+            img = so.getImage()
+            d = so.getDimensions()
+            if img is not None:
+                painter.drawPixmap(
+                    d[0] * CommonValues.PPI,
+                    d[1] * CommonValues.PPI, img)
+
+    if effects:
+        cs.getGrid().paint(painter, rect)
+        drawTokens(painter, [so for so in curSOS["tokens"]
+                             if not so.isHidden() and
+                             so.getBounds().intersects(rect)])
+
+    # The merged region never overlaps itself, so each covered pixel
+    # is only filled once however many darkness rects are stacked
+    for r in cs.getDarknessRegion().rects() if effects else ():
+        r = QRect(r.x() * CommonValues.PPI, r.y() * CommonValues.PPI,
+                  r.width() * CommonValues.PPI, r.height() * CommonValues.PPI)
+        if r.intersects(rect):
+            fogPainter.fillRect(r.intersected(rect), Qt.black)
+    # Polygons each fill their cached path in one call
+    for so in curSOS["darkness"] if effects else ():
+        if isinstance(so, SceneDarknessPolygon) and so.isVisible() and \
+                so.getBounds().intersects(rect):
+            fogPainter.fillPath(so.getPath(), Qt.black)
+
+    # Lights take their lit area out of the darkness, bright light all of
+    # it and dim light half. Walls stop them, the fog of war is left as the
+    # GM painted it.
+    lights = [so for so in curSOS["light"] if effects and
+              not so.isHidden() and so.getBounds().intersects(rect)]
+    if len(lights) > 0:
+        visibility = cs.getVisibility()
+        fogPainter.save()
+        fogPainter.setRenderHint(QPainter.Antialiasing)
+        fogPainter.setCompositionMode(QPainter.CompositionMode_DestinationOut)
+        for so in lights:
+            bright, dim = visibility.getLitPaths(so)
+            fogPainter.fillPath(dim, QColor(0, 0, 0, 128))
+            fogPainter.fillPath(bright, Qt.black)
+        fogPainter.restore()
+
+    fog = cs.getFog()
+    if effects and fog.hasFog():
+        fogPainter.drawImage(fog.getTargetRect(), fog.getImage())
+
+    fogPainter.end()
+
+    painter.resetTransform()
+    painter.setClipping(False)
+    painter.drawImage(0, 0, imgFog)
+    painter.end()
+    return sceneImg
+
+
+def getSceneAnimations(cs, touched=None):
+    # (filePath, rect, rotation, under, over) for every animated image the
+    # display should play. under holds the images below it and over the
+    # images above it plus darkness and fog, both only the size of the
+    # image, so a new frame is composed without touching the rest. With a
+    # touched region, returns None unless an animated image is in it.
+    found = []
+    images = cs.getSceneObjects()["images"]
+    for i, so in enumerate(images):
+        asset = so.getAsset()
+        if so.isHidden() or asset is None or not asset.isAnimated():
+            continue
+        rect = so.getBounds()
+        if rect.intersects(getDisplayRect()):
+            found.append((i, so, rect))
+    if touched is not None and \
+            not any(touched.intersects(rect) for i, so, rect in found):
+        return None
+    return [(so.getAsset().getFilePath(), rect, so.getRotation(),
+             renderScene(cs, rect, slice(0, i), False),
+             renderScene(cs, rect, slice(i + 1, None)))
+            for i, so, rect in found]
+
+
+# The rendered display frame of one scene, kept up to date by re-rendering
+# only the areas the scene reports as changed. The display and the editor's
+# player view both draw from it, so a change is rendered once.
+class MDSceneFrame(QObject):
+    # Area of the frame that is out of date, in display pixels
+    frameUpdated = pyqtSignal(QRect)
+
+    def __init__(self, cs):
+        # Parented to the scene so it lives exactly as long as the scene
+        super(MDSceneFrame, self).__init__(cs)
+        self.scene = cs
+        self.frame = None
+        self.dirty = QRegion()
+        self.scaledFrame = None
+        self.scaledDirty = QRegion()
+        self.scale = None
+        cs.regionUpdated.connect(self.invalidate)
+
+    def invalidate(self, rect):
+        rect = rect.intersected(getDisplayRect())
+        if not rect.isEmpty():
+            self.dirty = self.dirty.united(rect)
+            self.scaledDirty = self.scaledDirty.united(rect)
+            self.frameUpdated.emit(rect)
+
+    def getFrame(self):
+        if self.frame is None:
+            self.frame = renderScene(self.scene)
+            self.dirty = QRegion()
+        elif not self.dirty.isEmpty():
+            painter = QPainter(self.frame)
+            painter.setCompositionMode(QPainter.CompositionMode_Source)
+            for rect in self.dirty.rects():
+                painter.drawPixmap(rect.topLeft(),
+                                   renderScene(self.scene, rect))
+            painter.end()
+            self.dirty = QRegion()
+        return self.frame
+
+    def getMemoryUsage(self):
+        return getImageBytes(self.frame) + getImageBytes(self.scaledFrame)
+
+    def getScaledFrame(self, scale):
+        # A copy of the frame at preview scale, patched the same way so a
+        # small edit doesn't rescale the whole frame
+        frame = self.getFrame()
+        if self.scaledFrame is None or scale != self.scale:
+            self.scale = scale
+            self.scaledFrame = frame.scaled(
+                int(frame.width() * scale), int(frame.height() * scale),
+                Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        elif not self.scaledDirty.isEmpty():
+            painter = QPainter(self.scaledFrame)
+            painter.setCompositionMode(QPainter.CompositionMode_Source)
+            painter.setRenderHint(QPainter.SmoothPixmapTransform)
+            for rect in self.scaledDirty.rects():
+                # Grown by a pixel so smoothing at the edges matches
+                rect = rect.adjusted(-1, -1, 1, 1).intersected(frame.rect())
+                target = scaleRect(rect, scale)
+                painter.drawPixmap(target, frame, scaleRect(target, 1 / scale))
+            painter.end()
+        self.scaledDirty = QRegion()
+        return self.scaledFrame
+
+
+def scaleRect(rect, scale):
+    # Smallest rect of whole pixels covering rect * scale
+    x1, y1 = int(rect.x() * scale), int(rect.y() * scale)
+    x2 = -int(-(rect.x() + rect.width()) * scale // 1)
+    y2 = -int(-(rect.y() + rect.height()) * scale // 1)
+    return QRect(x1, y1, x2 - x1, y2 - y1)
+
+
+def getSceneFrame(cs):
+    frame = cs.findChild(MDSceneFrame)
+    if frame is None:
+        frame = MDSceneFrame(cs)
+    return frame
+
+
+def shareSceneFrame(cs, copy):
+    # A duplicated scene looks the same as its original, so it can start
+    # from the original's frames. QPixmap copies are implicitly shared,
+    # pixels are only duplicated when one of the scenes is re-rendered.
+    src = cs.findChild(MDSceneFrame)
+    if src is None or src.frame is None:
+        return
+    dst = getSceneFrame(copy)
+    dst.frame = QPixmap(src.frame)
+    dst.dirty = QRegion(src.dirty)
+    if src.scaledFrame is not None:
+        dst.scaledFrame = QPixmap(src.scaledFrame)
+        dst.scaledDirty = QRegion(src.scaledDirty)
+        dst.scale = src.scale
+
+
+def renderSceneThumbnail(js, size):
+    # Renders a scene snapshot (MDScene.getSnapshot) at thumbnail size.
+    # Only QImages are used so it can run on a worker thread, and images
+    # come from small cached variants, never from the full decode.
+    scale = size.width() / CommonValues.DisplayWidth
+    step = CommonValues.PPI * scale
+    thumb = QImage(size, QImage.Format_ARGB32_Premultiplied)
+    thumb.fill(Qt.black)
+    painter = QPainter(thumb)
+    painter.setRenderHint(QPainter.SmoothPixmapTransform)
+    sos = js["sceneObjects"]
+    for so in sos.get("images", []):
+        if so.get("hidden", False) or not so["filepath"]:
+            continue
+        w = max(1, int(so["width"] * scale))
+        h = max(1, int(so["height"] * scale))
+        rotation = so.get("rotation", 0)
+        img = imageCache.loadImage(
+            so["filepath"], QSize(h, w) if rotation % 180 else QSize(w, h))
+        if img.isNull():
+            continue
+        if rotation:
+            img = img.transformed(QTransform().rotate(rotation))
+        painter.drawImage(int(so["x"] * step), int(so["y"] * step), img)
+
+    if "grid" in js:
+        MDGridLayer.createFromJSON(js["grid"]).paint(painter, thumb.rect(),
+                                                     scale)
+
+    for so in sos.get("tokens", []):
+        if so.get("hidden", False) or not so["filepath"]:
+            continue
+        cellSize = max(1, int(so["size"] * step))
+        img = imageCache.loadImage(so["filepath"], QSize(cellSize, cellSize))
+        if not img.isNull():
+            painter.drawImage(int(so["x"] * step), int(so["y"] * step), img)
+
+    for so in sos.get("darkness", []):
+        if so.get("hidden", False):
+            continue
+        if "points" in so:
+            painter.setPen(Qt.NoPen)
+            painter.setBrush(Qt.black)
+            painter.drawPolygon(QPolygonF([QPointF(x * step, y * step)
+                                           for x, y in so["points"]]))
+        else:
+            painter.fillRect(int(so["x"] * step), int(so["y"] * step),
+                             int(so["width"] * step + 1),
+                             int(so["height"] * step + 1), Qt.black)
+
+    if "fog" in js:
+        fog = MDFogLayer.createFromJSON(js["fog"])
+        if fog.hasFog():
+            painter.drawImage(fog.getTargetRect(scale), fog.getImage())
+    painter.end()
+    return thumb
+
+
+class MDSceneThumbnailSignals(QObject):
+    finished = pyqtSignal(int, QImage)
+
+
+class MDSceneThumbnailTask(QRunnable):
+    def __init__(self, requestId, js, size):
+        super(MDSceneThumbnailTask, self).__init__()
+        self.setAutoDelete(False)
+        self.requestId = requestId
+        self.js = js
+        self.size = size
+        self.signals = MDSceneThumbnailSignals()
+
+    def run(self):
+        self.signals.finished.emit(self.requestId,
+                                   renderSceneThumbnail(self.js, self.size))
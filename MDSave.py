@@ -0,0 +1,152 @@
+"""
+Map Displayer is a scene-based toolset for displaying Encounter Maps on a
+second screen for Tabletop RPGs
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Map Displayer.
+
+Map Displayer is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Map Displayer is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Map Displayer.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, QSize, pyqtSignal
+import json
+import os
+import threading
+import time
+
+from MDImageCache import imageCache
+
+
+def writeSessionFile(js, path):
+    # Written next to the target and renamed over it, so a crash or a full
+    # disk mid-write leaves the previous file intact
+    tmpPath = "{}.{}.tmp".format(path, threading.get_ident())
+    try:
+        with open(tmpPath, "w") as f:
+            json.dump(js, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpPath, path)
+    except OSError:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        raise
+
+
+class MDSaveSignals(QObject):
+    # path, error message (empty on success)
+    finished = pyqtSignal(str, str)
+
+
+class MDSaveTask(QRunnable):
+    def __init__(self, snapshot, path):
+        super(MDSaveTask, self).__init__()
+        self.setAutoDelete(False)
+        self.snapshot = snapshot
+        self.path = path
+        self.signals = MDSaveSignals()
+
+    def run(self):
+        try:
+            writeSessionFile(self.snapshot, self.path)
+            self.signals.finished.emit(self.path, "")
+        except (OSError, TypeError, ValueError) as e:
+            self.signals.finished.emit(self.path, str(e))
+
+
+# Writes session snapshots off the GUI thread. One writer thread keeps
+# saves to the same file in the order they were made.
+class MDSessionWriter(QObject):
+    saveFinished = pyqtSignal(str, str)
+
+    def __init__(self):
+        super(MDSessionWriter, self).__init__()
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(1)
+        self.tasks = []
+        self.lastSnapshots = {}
+
+    def save(self, session, path, onlyIfChanged=False):
+        # Returns False when there was nothing new to write
+        snapshot = session.getSnapshot()
+        last = self.lastSnapshots.get(path)
+        if onlyIfChanged and last is not None and \
+                last["name"] == snapshot["name"] and \
+                len(last["scenes"]) == len(snapshot["scenes"]) and \
+                all(a is b for a, b in zip(last["scenes"],
+                                           snapshot["scenes"])):
+            return False
+        self.lastSnapshots[path] = snapshot
+        task = MDSaveTask(snapshot, path)
+        task.signals.finished.connect(self.finishSave)
+        self.tasks.append(task)
+        self.pool.start(task)
+        return True
+
+    def finishSave(self, path, error):
+        # The single writer finishes tasks in the order they were started
+        self.tasks.pop(0)
+        if error:
+            self.lastSnapshots.pop(path, None)
+        self.saveFinished.emit(path, error)
+
+    def isSaving(self):
+        return len(self.tasks) > 0
+
+    def waitForDone(self):
+        self.pool.waitForDone()
+
+
+class MDLoadSignals(QObject):
+    # path, session JSON (None on failure), error message, seconds taken
+    finished = pyqtSignal(str, object, str, float)
+
+
+class MDLoadTask(QRunnable):
+    # Reads and parses a session file on the pool and decodes the images
+    # of its first scene into the image cache, at full size and at the
+    # editor's preview scale, so opening it on the GUI thread only builds
+    # the objects
+    def __init__(self, path, previewScale):
+        super(MDLoadTask, self).__init__()
+        self.setAutoDelete(False)
+        self.path = path
+        self.previewScale = previewScale
+        self.signals = MDLoadSignals()
+
+    def run(self):
+        start = time.perf_counter()
+        try:
+            with open(self.path, "r") as f:
+                js = json.load(f)
+            scenes = js["scenes"]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.signals.finished.emit(self.path, None, str(e),
+                                       time.perf_counter() - start)
+            return
+        if len(scenes) > 0:
+            for so in scenes[0]["sceneObjects"].get("images", []):
+                fp = so.get("filepath", "")
+                if len(fp) == 0:
+                    continue
+                w = int(so["width"] * self.previewScale)
+                h = int(so["height"] * self.previewScale)
+                if so.get("rotation", 0) % 180:
+                    w, h = h, w
+                imageCache.loadImage(fp)
+                if w > 0 and h > 0:
+                    imageCache.loadImage(fp, QSize(w, h))
+        self.signals.finished.emit(self.path, js, "",
+                                   time.perf_counter() - start)
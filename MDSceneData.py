@@ -21,8 +21,19 @@ If not, see <https://www.gnu.org/licenses/>.
 """
 
 
-from PyQt5.QtGui import QPixmap
-from PyQt5.QtCore import (QObject, pyqtSignal)
+from PyQt5.QtGui import QRegion, QPainterPath, QPolygonF
+from PyQt5.QtCore import (QObject, QRect, QPointF, pyqtSignal)
+from functools import partial
+import bisect
+import math
+
+from MDAssets import MDImageAsset
+from MDCommon import CommonValues
+from MDFog import MDFogLayer
+from MDGrid import MDGridLayer
+from MDOperations import modelOperation
+from MDTokens import MDTokenAtlas
+from MDVisibility import MDVisibility
 
 
 class MDSession(QObject):
@@ -41,18 +52,44 @@ class MDSession(QObject):
     def getName(self):
         return self.name
 
+    @modelOperation
     def setName(self, name):
         self.name = name
 
+    @modelOperation
     def addScene(self, scene):
         self.scenes.append(scene)
 
+    @modelOperation
+    def insertScene(self, index, scene):
+        self.scenes.insert(index, scene)
+
     def getScenes(self):
         return self.scenes
 
     def getScene(self, index):
         return self.scenes[index]
 
+    def release(self):
+        # The session is being closed, its tokens stop holding atlas cells
+        for scene in self.scenes:
+            scene.release()
+
+    def getAssetPaths(self):
+        # Every image file the session's images and tokens are drawn from
+        paths = set()
+        for scene in self.scenes:
+            paths.update(scene.getAssetPaths())
+        return paths
+
+    def getUndoState(self):
+        # Scenes are shared with the session, only the list is copied
+        return (self.name, tuple(self.scenes))
+
+    def restoreUndoState(self, state):
+        self.name = state[0]
+        self.scenes = list(state[1])
+
     def getJSON(self):
         sceneJS = []
         for scene in self.scenes:
@@ -63,25 +100,72 @@ class MDSession(QObject):
             "scenes": sceneJS
         }
 
+    def getSnapshot(self):
+        # Like getJSON, but scenes that haven't changed since their last
+        # snapshot are shared instead of serialized again. Snapshots must
+        # never be modified, which is what makes them safe to write out on
+        # another thread.
+        return {
+            "name": self.name,
+            "scenes": [scene.getSnapshot() for scene in self.scenes]
+        }
+
 
 class MDScene(QObject):
     sceneUpdated = pyqtSignal()
+    # Area of the display touched by a change, in display pixels
+    regionUpdated = pyqtSignal(QRect)
 
-    def __init__(self, name="My Scene", so=None):
+    def __init__(self, name="My Scene", so=None, fog=None, grid=None):
         super(MDScene, self).__init__()
         self.name = name
         if so is None:
             self.sceneObjects = {"images": [],
                                  "darkness": [],
-                                 "light": []}
+                                 "light": [],
+                                 "tokens": [],
+                                 "walls": []}
         else:
             self.sceneObjects = so
+            # Sessions saved before tokens or walls existed
+            self.sceneObjects.setdefault("tokens", [])
+            self.sceneObjects.setdefault("walls", [])
+        self.fog = MDFogLayer() if fog is None else fog
+        self.fog.cellsChanged.connect(self.updateFogCells)
+        self.grid = MDGridLayer() if grid is None else grid
+        self.grid.gridUpdated.connect(self.updateGrid)
+
+        # Union of the visible darkness rects in grid units, kept up to date
+        # as single rects change so painting doesn't depend on overlap
+        self.darknessRegion = None
+        self.darknessPath = None
+        self.darknessRects = {}
+        # Walls indexed for the lights, built the first time lights are drawn
+        self.visibility = None
+
+        # Last known display bounds of every object, so a change can be
+        # reported as the area it covered before and after
+        self.objectBounds = {}
+        self.objectSlots = {}
+        for key in self.sceneObjects:
+            for so in self.sceneObjects[key]:
+                self.connectSceneObject(so)
+
+        # Every change goes through one of these two signals, so they are
+        # enough to tell whether the last snapshot is still current
+        self.version = 0
+        self.snapshot = None
+        self.snapshotVersion = -1
+        self.sceneUpdated.connect(self.markChanged)
+        self.regionUpdated.connect(self.markChanged)
 
     @classmethod
     def createFromJSON(cls, js):
         typeDict = {"images": SceneImage,
                     "darkness": SceneDarkness,
-                    "light": SceneLightCircle}
+                    "light": SceneLightCircle,
+                    "tokens": SceneToken,
+                    "walls": SceneWall}
         sos = {}
         soJS = js["sceneObjects"]
         for type in soJS:
@@ -92,16 +176,112 @@ class MDScene(QObject):
                     typeList.append(typeClass.createFromJSON(so))
                 sos[type] = typeList
 
-        return cls(js["name"], sos)
+        fog = None
+        if "fog" in js:
+            fog = MDFogLayer.createFromJSON(js["fog"])
+        grid = None
+        if "grid" in js:
+            grid = MDGridLayer.createFromJSON(js["grid"])
+        return cls(js["name"], sos, fog, grid)
 
+    @modelOperation
     def addSceneObject(self, so):
         if isinstance(so, SceneImage):
             self.sceneObjects["images"].append(so)
         elif isinstance(so, SceneDarkness):
             self.sceneObjects["darkness"].append(so)
+            self.updateDarkness(so)
         elif isinstance(so, SceneLightCircle):
             self.sceneObjects["light"].append(so)
+        elif isinstance(so, SceneToken):
+            self.sceneObjects["tokens"].append(so)
+        elif isinstance(so, SceneWall):
+            self.sceneObjects["walls"].append(so)
+        else:
+            return
+        self.connectSceneObject(so)
+        self.regionUpdated.emit(so.getBounds())
+        if isinstance(so, SceneWall):
+            self.updateWall(so)
+
+    def connectSceneObject(self, so):
+        self.objectSlots[so] = partial(self.updateSceneObject, so)
+        so.objectUpdated.connect(self.objectSlots[so])
+        self.objectBounds[so] = so.getBounds()
+        if isinstance(so, SceneToken):
+            MDTokenAtlas.addUser(so)
+
+    def disconnectSceneObject(self, so):
+        so.objectUpdated.disconnect(self.objectSlots.pop(so))
+        self.regionUpdated.emit(self.objectBounds.pop(so))
+        if isinstance(so, SceneToken):
+            MDTokenAtlas.removeUser(so)
+        if self.visibility is not None:
+            if isinstance(so, SceneWall):
+                self.visibility.removeWall(so)
+                self.updateLighting(so.getBounds())
+            elif isinstance(so, SceneLightCircle):
+                self.visibility.removeLight(so)
+
+    def release(self):
+        for so in self.sceneObjects["tokens"]:
+            MDTokenAtlas.removeUser(so)
+
+    def updateSceneObject(self, so):
+        if isinstance(so, SceneDarkness):
+            self.updateDarkness(so)
+        old = self.objectBounds.get(so, QRect())
+        new = so.getBounds()
+        self.objectBounds[so] = new
+        self.regionUpdated.emit(old.united(new))
+        if isinstance(so, SceneWall):
+            self.updateWall(so, old.united(new))
+
+    def getVisibility(self):
+        if self.visibility is None:
+            self.visibility = MDVisibility()
+            for so in self.sceneObjects["walls"]:
+                self.visibility.updateWall(so)
+        return self.visibility
+
+    def updateWall(self, so, area=None):
+        # Lights reaching the wall are drawn again with their new shape
+        if self.visibility is None:
+            return
+        self.visibility.updateWall(so)
+        self.updateLighting(so.getBounds() if area is None else area)
+
+    def updateLighting(self, area):
+        self.visibility.invalidate(area)
+        for light in self.sceneObjects["light"]:
+            bounds = light.getBounds()
+            if not light.isHidden() and bounds.intersects(area):
+                self.regionUpdated.emit(bounds)
+
+    def updateFogCells(self, rect):
+        ppi = CommonValues.PPI
+        self.regionUpdated.emit(QRect(rect.x() * ppi, rect.y() * ppi,
+                                      rect.width() * ppi, rect.height() * ppi))
+
+    def getAssetPaths(self):
+        return set(so.getFilepath()
+                   for key in ("images", "tokens")
+                   for so in self.sceneObjects[key]
+                   if len(so.getFilepath()) > 0)
+
+    def updateAsset(self, filePath):
+        # An image file changed on disk, everything drawn from it is
+        # out of date
+        for key in ("images", "tokens"):
+            for so in self.sceneObjects[key]:
+                if so.getFilepath() == filePath:
+                    self.regionUpdated.emit(so.getBounds())
 
+    def updateGrid(self):
+        self.regionUpdated.emit(QRect(0, 0, CommonValues.DisplayWidth,
+                                      CommonValues.DisplayHeight))
+
+    @modelOperation
     def setName(self, name):
         self.name = name
         self.sceneUpdated.emit()
@@ -112,9 +292,140 @@ class MDScene(QObject):
     def getSceneObject(self, type, index):
         return self.sceneObjects[type][index]
 
+    def copyScene(self, name=None):
+        # Clones share image assets and start out sharing the fog cells,
+        # which are only copied once either scene changes its fog
+        sos = {}
+        for key in self.sceneObjects:
+            sos[key] = [so.copy() for so in self.sceneObjects[key]]
+        return MDScene(self.name if name is None else name, sos,
+                       self.fog.copy(), self.grid.copy())
+
+    def getFog(self):
+        return self.fog
+
+    def getGrid(self):
+        return self.grid
+
+    def getDarknessRegion(self):
+        if self.darknessRegion is None:
+            self.darknessRects = {}
+            region = QRegion()
+            for so in self.sceneObjects["darkness"]:
+                rect = so.getVisibleRect()
+                if rect is not None:
+                    self.darknessRects[so] = rect
+                    region = region.united(rect)
+            self.darknessRegion = region
+        return self.darknessRegion
+
+    def getDarknessAt(self, x, y):
+        # Topmost darkness, hidden or not, at (x, y) in grid units
+        for so in reversed(self.sceneObjects["darkness"]):
+            if isinstance(so, SceneDarknessPolygon):
+                if so.containsPoint(x, y):
+                    return so
+            else:
+                dx, dy, dw, dh = so.getDimensions()
+                if dx <= x < dx + dw and dy <= y < dy + dh:
+                    return so
+        return None
+
+    def getDarknessPath(self):
+        if self.darknessPath is None:
+            path = QPainterPath()
+            path.addRegion(self.getDarknessRegion())
+            self.darknessPath = path.simplified()
+        return self.darknessPath
+
+    def updateDarkness(self, so):
+        if self.darknessRegion is None:
+            return
+        old = self.darknessRects.pop(so, None)
+        new = so.getVisibleRect()
+        if old == new:
+            if old is not None:
+                self.darknessRects[so] = old
+            return
+
+        region = self.darknessRegion
+        if old is not None:
+            # Take the old rect out, then give back the parts of it that
+            # are still covered by other rects
+            region = region.subtracted(QRegion(old))
+            for rect in self.darknessRects.values():
+                if rect.intersects(old):
+                    region = region.united(rect.intersected(old))
+        if new is not None:
+            self.darknessRects[so] = new
+            region = region.united(new)
+        self.darknessRegion = region
+        self.darknessPath = None
+
     def getName(self):
         return self.name
 
+    def markChanged(self):
+        self.version += 1
+
+    def getMemoryUsage(self):
+        # Object counts and the signal connections keeping them alive.
+        # Image pixels belong to the shared assets and are not counted here.
+        objects = {}
+        connections = self.receivers(self.sceneUpdated) + \
+            self.receivers(self.regionUpdated)
+        for key in self.sceneObjects:
+            objects[key] = len(self.sceneObjects[key])
+            for so in self.sceneObjects[key]:
+                connections += so.receivers(so.objectUpdated)
+        fogImage = self.fog.image
+        return {
+            "objects": objects,
+            "connections": connections,
+            "fog": self.fog.getCells().nbytes + (
+                0 if fogImage is None else fogImage.sizeInBytes()),
+            "darknessRects": len(self.darknessRects)
+        }
+
+    def getVersion(self):
+        return self.version
+
+    def getUndoState(self):
+        # The object lists are copied shallowly, objects are shared with
+        # the scene and undo their own changes through their own states
+        return (self.name, tuple((key, tuple(self.sceneObjects[key]))
+                                 for key in self.sceneObjects))
+
+    def restoreUndoState(self, state):
+        self.name = state[0]
+        for key, objects in state[1]:
+            current = self.sceneObjects[key]
+            if len(current) == len(objects) and \
+                    all(a is b for a, b in zip(current, objects)):
+                continue
+            for so in current:
+                if so not in objects:
+                    self.disconnectSceneObject(so)
+            self.sceneObjects[key] = list(objects)
+            for so in objects:
+                if so not in self.objectSlots:
+                    self.connectSceneObject(so)
+                    self.regionUpdated.emit(so.getBounds())
+            if key == "darkness":
+                self.darknessRegion = None
+                self.darknessPath = None
+            elif key in ("walls", "light"):
+                self.visibility = None
+                for light in self.sceneObjects["light"]:
+                    self.regionUpdated.emit(light.getBounds())
+        self.sceneUpdated.emit()
+
+    def getSnapshot(self):
+        if self.snapshotVersion != self.version:
+            self.snapshot = self.getJSON()
+            self.snapshotVersion = self.version
+        return self.snapshot
+
     def getJSON(self):
         soJS = {}
         for key in self.sceneObjects:
@@ -124,12 +435,16 @@ class MDScene(QObject):
             soJS[key] = elemArr
         return {
             "name": self.name,
-            "sceneObjects": soJS
+            "sceneObjects": soJS,
+            "fog": self.fog.getJSON(),
+            "grid": self.grid.getJSON()
         }
 
 
 class MDSceneObject(QObject):
     objectUpdated = pyqtSignal()
+    # Everything an undo step has to put back
+    undoFields = ("name", "x", "y", "width", "height", "hidden")
 
     def __init__(self, name="", x=0, y=0, width=-1, height=-1, hidden=False):
         super(MDSceneObject, self).__init__()
@@ -155,51 +470,86 @@ class MDSceneObject(QObject):
     def getDimensions(self):
         return (self.x, self.y, self.width, self.height)
 
+    def getBounds(self):
+        # Area covered on the display, in display pixels
+        ppi = CommonValues.PPI
+        return QRect(self.x * ppi, self.y * ppi,
+                     self.width * ppi, self.height * ppi)
+
+    @modelOperation
     def setName(self, name):
         self.objectUpdated.emit()
         self.name = name
 
+    @modelOperation
     def setPos(self, x, y):
         self.x = x
         self.y = y
         self.objectUpdated.emit()
 
+    @modelOperation
     def setHeight(self, height):
         self.height = height
         self.objectUpdated.emit()
 
+    @modelOperation
     def setWidth(self, width):
         self.width = width
         self.objectUpdated.emit()
 
+    @modelOperation
     def setDimensions(self, x, y, width, height):
         self.x = x
         self.y = y
-        self.height = height,
+        self.height = height
         self.width = width
         self.objectUpdated.emit()
 
     def isHidden(self):
         return self.hidden
 
+    @modelOperation
     def toggleHidden(self):
         self.hidden = not self.hidden
         self.objectUpdated.emit()
 
+    @modelOperation
     def setHidden(self, hidden):
         self.hidden = hidden
         self.objectUpdated.emit()
 
+    def getUndoState(self):
+        return tuple(getattr(self, field) for field in self.undoFields)
+
+    def restoreUndoState(self, state):
+        for field, value in zip(self.undoFields, state):
+            setattr(self, field, value)
+        self.objectUpdated.emit()
+
+    def copy(self):
+        # Objects only hold a few numbers; anything heavy behind them (the
+        # decoded image of a SceneImage) is a shared asset, not copied
+        return self.createFromJSON(self.getJSON())
+
 
 class SceneImage(MDSceneObject):
+    undoFields = MDSceneObject.undoFields + ("rotation",)
+
     def __init__(self, name="", filepath="",
-                 x=0, y=0, height=-1, width=-1, hidden=False):
+                 x=0, y=0, height=-1, width=-1, hidden=False, rotation=0):
         super(SceneImage, self).__init__(name, x, y, height, width, hidden)
         self.filePath = filepath
+        self.asset = None
+        # Clockwise quarter turns, in degrees. width and height are the
+        # size on the display after rotating.
+        self.rotation = rotation % 360
         if len(filepath) > 0:
-            self.image = QPixmap(filepath)
-            self.height = height if height != -1 else self.image.height()
-            self.width = width if width != -1 else self.image.width()
+            # Only the image header is read here, the pixels are decoded
+            # the first time the image is drawn
+            self.asset = MDImageAsset.getAsset(filepath)
+            size = self.getNativeSize()
+            self.height = height if height != -1 else size[1]
+            self.width = width if width != -1 else size[0]
         else:
             self.height = height
             self.width = width
@@ -207,18 +557,71 @@ class SceneImage(MDSceneObject):
     @classmethod
     def createFromJSON(cls, js):
         return cls(js["name"], js["filepath"], js["x"], js["y"],
-                   js["height"], js["width"])
+                   js["height"], js["width"], js.get("hidden", False),
+                   js.get("rotation", 0))
 
     def getImage(self):
-        return self.image
+        # The image as drawn on the display, at its size and rotation
+        if self.asset is None:
+            return None
+        return self.asset.getScaledImage(self.width, self.height,
+                                         self.rotation)
+
+    def getBounds(self):
+        return QRect(self.x * CommonValues.PPI, self.y * CommonValues.PPI,
+                     self.width, self.height)
+
+    def getScaledImage(self, width, height):
+        if self.asset is None:
+            return None
+        return self.asset.getScaledImage(width, height, self.rotation)
+
+    def requestScaledImage(self, width, height):
+        if self.asset is None:
+            return None
+        return self.asset.requestScaledImage(width, height, self.rotation)
+
+    def getAsset(self):
+        return self.asset
+
+    def getFilepath(self):
+        return self.filePath
+
+    def getNativeSize(self):
+        # Size of the image file at the current rotation
+        w, h = self.asset.getSize() if self.asset is not None else (0, 0)
+        return (h, w) if self.rotation % 180 else (w, h)
+
+    def getRotation(self):
+        return self.rotation
+
+    @modelOperation
+    def setRotation(self, rotation):
+        rotation = rotation % 360
+        if (rotation - self.rotation) % 180:
+            self.width, self.height = self.height, self.width
+        self.rotation = rotation
+        self.objectUpdated.emit()
+
+    def rotate(self, degrees):
+        self.setRotation(self.rotation + degrees)
+
+    def getScale(self):
+        w = self.getNativeSize()[0]
+        return self.width / w if w > 0 else 1
+
+    @modelOperation
+    def setScale(self, scale):
+        w, h = self.getNativeSize()
+        self.width = max(1, int(round(w * scale)))
+        self.height = max(1, int(round(h * scale)))
+        self.objectUpdated.emit()
 
     @classmethod
     def copySceneImage(cls, model):
         modelCopy = None
-        if isinstance(SceneImage, model):
-            dim = model.getDimensions()
-            modelCopy = cls(model.getName(), model.getFilepath(),
-                            dim[0], dim[1], dim[2], dim[3])
+        if isinstance(model, SceneImage):
+            modelCopy = model.copy()
         return modelCopy
 
     def getJSON(self):
@@ -229,6 +632,7 @@ class SceneImage(MDSceneObject):
             "y": self.y,
             "width": self.width,
             "height": self.height,
+            "rotation": self.rotation,
             "hidden": self.hidden,
             "filepath": self.filePath
         }
@@ -240,8 +644,16 @@ class SceneDarkness(MDSceneObject):
 
     @classmethod
     def createFromJSON(cls, js):
+        # Polygons are kept in the same list as rects
+        if js.get("type") == "darknessPolygon":
+            return SceneDarknessPolygon.createFromJSON(js)
         return cls(js["name"], js["x"], js["y"],
-                   js["width"], js["height"])
+                   js["width"], js["height"], js.get("hidden", False))
+
+    def getVisibleRect(self):
+        if self.hidden or self.width <= 0 or self.height <= 0:
+            return None
+        return QRect(self.x, self.y, self.width, self.height)
 
     def getJSON(self):
         return {
@@ -255,7 +667,174 @@ class SceneDarkness(MDSceneObject):
         }
 
 
+# Even-odd point tests against a polygon in O(log n). The polygon is cut
+# into horizontal slabs at the y of every vertex and every place where two
+# edges cross, so within a slab the edges never swap places and can be kept
+# sorted left to right. A point is inside when an odd number of the edges
+# in its slab are left of it.
+class MDPolygonSlabs:
+    def __init__(self, points):
+        edges = []
+        for i in range(len(points)):
+            (x1, y1), (x2, y2) = points[i - 1], points[i]
+            if y1 != y2:
+                edges.append((x1, y1, x2, y2) if y1 < y2 else
+                             (x2, y2, x1, y1))
+        # Edges are swept top to bottom, only those overlapping in y can
+        # cross or share a slab
+        edges.sort(key=lambda e: e[1])
+        ys = set(y for x, y in points)
+        active = []
+        for edge in edges:
+            active = [e for e in active if e[3] > edge[1]]
+            for other in active:
+                y = self.getCrossingY(edge, other)
+                if y is not None:
+                    ys.add(y)
+            active.append(edge)
+        self.ys = sorted(ys)
+        self.slabs = []
+        active = []
+        next = 0
+        for top, bottom in zip(self.ys, self.ys[1:]):
+            while next < len(edges) and edges[next][1] <= top:
+                active.append(edges[next])
+                next += 1
+            active = [e for e in active if e[3] >= bottom]
+            mid = (top + bottom) / 2
+            self.slabs.append(sorted(active,
+                                     key=lambda e: self.getX(e, mid)))
+
+    @staticmethod
+    def getX(edge, y):
+        x1, y1, x2, y2 = edge
+        return x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+
+    @staticmethod
+    def getCrossingY(a, b):
+        # y where the two edges cross strictly inside both, or None
+        ax1, ay1, ax2, ay2 = a
+        bx1, by1, bx2, by2 = b
+        dax, day = ax2 - ax1, ay2 - ay1
+        dbx, dby = bx2 - bx1, by2 - by1
+        denom = dax * dby - day * dbx
+        if denom == 0:
+            return None
+        t = ((bx1 - ax1) * dby - (by1 - ay1) * dbx) / denom
+        u = ((bx1 - ax1) * day - (by1 - ay1) * dax) / denom
+        if 0 < t < 1 and 0 < u < 1:
+            return ay1 + t * day
+        return None
+
+    def contains(self, x, y):
+        i = bisect.bisect_right(self.ys, y) - 1
+        if i < 0 or i >= len(self.slabs):
+            return False
+        edges = self.slabs[i]
+        lo, hi = 0, len(edges)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.getX(edges[mid], y) < x:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo % 2 == 1
+
+
+# Darkness in any shape, for the diagonal corridors and round caverns rects
+# can only cover in steps. Points are grid corners kept relative to (x, y),
+# so moving the polygon is moving (x, y); width and height are the size of
+# its bounding box. Filled on its own, not merged into the rect region.
+class SceneDarknessPolygon(SceneDarkness):
+    undoFields = SceneDarkness.undoFields + ("points",)
+
+    def __init__(self, name="", points=(), hidden=False):
+        super(SceneDarknessPolygon, self).__init__(name, 0, 0, 0, 0, hidden)
+        self.points = ()
+        self.setPointsRaw(points)
+        # Display paths by scale and the slabs for hit tests, made for the
+        # shape they were cached with
+        self.cacheKey = None
+        self.paths = {}
+        self.slabs = None
+
+    @classmethod
+    def createFromJSON(cls, js):
+        return cls(js["name"], [tuple(p) for p in js["points"]],
+                   js.get("hidden", False))
+
+    def setPointsRaw(self, points):
+        if len(points) == 0:
+            return
+        self.x = min(p[0] for p in points)
+        self.y = min(p[1] for p in points)
+        self.points = tuple((px - self.x, py - self.y) for px, py in points)
+        self.width = max(p[0] for p in self.points)
+        self.height = max(p[1] for p in self.points)
+
+    def getPoints(self):
+        return [(self.x + px, self.y + py) for px, py in self.points]
+
+    @modelOperation
+    def setPoints(self, points):
+        self.setPointsRaw(points)
+        self.objectUpdated.emit()
+
+    def getVisibleRect(self):
+        # Never part of the merged rect region
+        return None
+
+    def getBounds(self):
+        ppi = CommonValues.PPI
+        left = math.floor(self.x * ppi)
+        top = math.floor(self.y * ppi)
+        return QRect(left, top,
+                     math.ceil((self.x + self.width) * ppi) - left,
+                     math.ceil((self.y + self.height) * ppi) - top)
+
+    def isVisible(self):
+        return not self.hidden and len(self.points) > 2
+
+    def checkCache(self):
+        key = (self.x, self.y, self.points)
+        if key != self.cacheKey:
+            self.cacheKey = key
+            self.paths = {}
+            self.slabs = None
+
+    def getPath(self, scale=1):
+        # The outline in display pixels times scale, 1 for the display and
+        # the zoom for the preview
+        self.checkCache()
+        path = self.paths.get(scale)
+        if path is None:
+            step = CommonValues.PPI * scale
+            path = QPainterPath()
+            path.addPolygon(QPolygonF([QPointF(px * step, py * step)
+                                       for px, py in self.getPoints()]))
+            path.closeSubpath()
+            self.paths[scale] = path
+        return path
+
+    def containsPoint(self, x, y):
+        # Whether (x, y) in grid units is inside the polygon
+        self.checkCache()
+        if self.slabs is None:
+            self.slabs = MDPolygonSlabs(self.getPoints())
+        return self.slabs.contains(x, y)
+
+    def getJSON(self):
+        return {
+            "type": "darknessPolygon",
+            "name": self.name,
+            "points": [list(p) for p in self.getPoints()],
+            "hidden": self.hidden
+        }
+
+
 class SceneLightCircle(MDSceneObject):
+    undoFields = MDSceneObject.undoFields + ("brightRadius", "dimRadius")
+
     def __init__(self, name="", x=0, y=0,
                  brightRadius=-1, dimRadius=-1, hidden=False):
         totalSize = (brightRadius + dimRadius) * 2
@@ -267,7 +846,8 @@ class SceneLightCircle(MDSceneObject):
     @classmethod
     def createFromJSON(cls, js):
         return cls(js["name"], js["x"], js["y"],
-                   js["brightRadius"], js["dimRadius"])
+                   js["brightRadius"], js["dimRadius"],
+                   js.get("hidden", False))
 
     def getBrightRadius(self):
         return self.brightRadius
@@ -275,16 +855,24 @@ class SceneLightCircle(MDSceneObject):
     def getDimRadus(self):
         return self.dimRadius
 
+    def getBounds(self):
+        ppi = CommonValues.PPI
+        r = max(self.brightRadius, 0) + max(self.dimRadius, 0)
+        return QRect((self.x - r) * ppi, (self.y - r) * ppi,
+                     2 * r * ppi, 2 * r * ppi)
+
     def updateRadiusHW(self):
         totalSize = (self.brightRadius + self.dimRadius) * 2
         self.height = totalSize
         self.width = totalSize
         self.objectUpdated.emit()
 
+    @modelOperation
     def setBrightRadius(self, br):
         self.brightRadius = br
         self.updateRadiusHW()
 
+    @modelOperation
     def setDimRadius(self, dr):
         self.dimRadius = dr
         self.updateRadiusHW()
@@ -299,3 +887,118 @@ class SceneLightCircle(MDSceneObject):
             "brightRadius": self.brightRadius,
             "hidden": self.hidden
         }
+
+
+# A creature or marker token: a small image on the grid, size grid units
+# square. Token images are drawn from shared atlases (MDTokens), so a scene
+# full of them costs a few draw calls, not one per token.
+class SceneToken(MDSceneObject):
+    def __init__(self, name="", filepath="", x=0, y=0, size=1, hidden=False):
+        super(SceneToken, self).__init__(name, x, y, size, size, hidden)
+        self.filePath = filepath
+
+    @classmethod
+    def createFromJSON(cls, js):
+        return cls(js["name"], js["filepath"], js["x"], js["y"],
+                   js.get("size", 1), js.get("hidden", False))
+
+    def getFilepath(self):
+        return self.filePath
+
+    def getSize(self):
+        return self.width
+
+    @modelOperation
+    def setSize(self, size):
+        self.width = size
+        self.height = size
+        self.objectUpdated.emit()
+
+    def getJSON(self):
+        return {
+            "type": "token",
+            "name": self.name,
+            "x": self.x,
+            "y": self.y,
+            "size": self.width,
+            "hidden": self.hidden,
+            "filepath": self.filePath
+        }
+
+
+# A wall from (x, y) to (x + width, y + height) in grid units, which lights
+# can't see past. A door is a wall that stops blocking while it is open.
+class SceneWall(MDSceneObject):
+    undoFields = MDSceneObject.undoFields + ("door", "open")
+
+    def __init__(self, name="", x=0, y=0, x2=0, y2=0, door=False,
+                 open=False, hidden=False):
+        super(SceneWall, self).__init__(name, x, y, x2 - x, y2 - y, hidden)
+        self.door = door
+        self.open = open
+
+    @classmethod
+    def createFromJSON(cls, js):
+        return cls(js["name"], js["x"], js["y"], js["x2"], js["y2"],
+                   js.get("door", False), js.get("open", False),
+                   js.get("hidden", False))
+
+    def getEnd(self):
+        return (self.x + self.width, self.y + self.height)
+
+    def getSegment(self):
+        return (self.x, self.y, self.x + self.width, self.y + self.height)
+
+    def getBounds(self):
+        # Padded so the line drawn over the map is covered as well
+        ppi = CommonValues.PPI
+        return QRect(min(self.x, self.x + self.width) * ppi,
+                     min(self.y, self.y + self.height) * ppi,
+                     abs(self.width) * ppi,
+                     abs(self.height) * ppi).adjusted(-4, -4, 4, 4)
+
+    @modelOperation
+    def setSegment(self, x, y, x2, y2):
+        self.x = x
+        self.y = y
+        self.width = x2 - x
+        self.height = y2 - y
+        self.objectUpdated.emit()
+
+    def isDoor(self):
+        return self.door
+
+    @modelOperation
+    def setDoor(self, door):
+        self.door = door
+        self.objectUpdated.emit()
+
+    def isOpen(self):
+        return self.open
+
+    @modelOperation
+    def setOpen(self, open):
+        self.open = open
+        self.objectUpdated.emit()
+
+    @modelOperation
+    def toggleOpen(self):
+        self.open = not self.open
+        self.objectUpdated.emit()
+
+    def isBlocking(self):
+        return not self.hidden and not (self.door and self.open)
+
+    def getJSON(self):
+        x2, y2 = self.getEnd()
+        return {
+            "type": "wall",
+            "name": self.name,
+            "x": self.x,
+            "y": self.y,
+            "x2": x2,
+            "y2": y2,
+            "door": self.door,
+            "open": self.open,
+            "hidden": self.hidden
+        }
@@ -0,0 +1,326 @@
+"""
+Map Displayer is a scene-based toolset for displaying Encounter Maps on a
+second screen for Tabletop RPGs
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Map Displayer.
+
+Map Displayer is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Map Displayer is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Map Displayer.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import gc
+import os
+import random
+import sys
+import tempfile
+import time
+
+from MDOperations import getPercentile
+
+
+def getResidentBytes():
+    # Current resident set size. Only Linux has it in /proc, elsewhere the
+    # peak is the closest there is, which still shows steady growth.
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def getTrend(values):
+    # Growth over the whole run along the least squares line, relative to
+    # where the line starts. Single slow samples barely move it, a leak of
+    # a few objects per step does.
+    n = len(values)
+    if n < 2:
+        return 0
+    meanX = (n - 1) / 2
+    meanY = sum(values) / n
+    slope = sum((x - meanX) * (y - meanY) for x, y in enumerate(values)) / \
+        sum((x - meanX) ** 2 for x in range(n))
+    start = meanY - slope * meanX
+    return slope * (n - 1) / max(abs(start), 1e-9)
+
+
+def getSoakTokenPaths(count=6):
+    # Plain discs in a few colours, written once to the temp directory.
+    # Scenes use the first few, the rest only come and go.
+    from PyQt5.QtGui import QImage, QPainter, QColor
+    from PyQt5.QtCore import Qt
+    directory = os.path.join(tempfile.gettempdir(), "map-displayer-soak")
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, "token{}.png".format(i))
+        if not os.path.exists(path):
+            img = QImage(128, 128, QImage.Format_ARGB32)
+            img.fill(Qt.transparent)
+            painter = QPainter(img)
+            painter.setPen(Qt.NoPen)
+            painter.setBrush(QColor.fromHsv(i * 360 // count, 200, 220))
+            painter.drawEllipse(4, 4, 120, 120)
+            painter.end()
+            img.save(path)
+        paths.append(path)
+    return paths
+
+
+def createSoakSession(sceneCount=4):
+    # A few scenes over the same map with darkness, lights, walls, tokens
+    # and fog, so every kind of object and the rendering caches get
+    # exercised
+    from MDSceneData import (MDSession, MDScene, SceneImage, SceneDarkness,
+                             SceneDarknessPolygon, SceneLightCircle,
+                             SceneToken, SceneWall)
+    mapPath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "display_bkg.png")
+    tokenPaths = getSoakTokenPaths()
+    scenes = []
+    for i in range(sceneCount):
+        scene = MDScene("Soak {}".format(i))
+        scene.addSceneObject(SceneImage("map", mapPath))
+        for j in range(3):
+            scene.addSceneObject(
+                SceneDarkness("darkness", 2 + j * 6, 2 + i, 4, 3))
+        scene.addSceneObject(SceneDarknessPolygon(
+            "darkness", [(16, 1), (18, 1), (24, 7 + i), (22, 7 + i)]))
+        scene.addSceneObject(SceneLightCircle("light", 10, 8, 6, 6))
+        scene.addSceneObject(SceneWall("wall", 6, 5, 14, 5))
+        scene.addSceneObject(SceneWall("wall", 14, 5, 14, 9 + i))
+        scene.addSceneObject(SceneWall("door", 14, 9 + i, 14, 11 + i, True))
+        for j in range(2):
+            scene.addSceneObject(SceneToken(
+                "token", tokenPaths[(i + j) % 4], 3 + j * 4, 9, 1 + j))
+        scene.getFog().setRect(0, 0, 8 + i, 6, True)
+        scenes.append(scene)
+    return MDSession("Soak", scenes)
+
+
+# Drives an MDMain through random scene switches, edits and display
+# commands, the way a long session at the table would
+class MDSoakDriver:
+    def __init__(self, window, seed=0):
+        self.window = window
+        self.random = random.Random(seed)
+        self.actions = (("switchScene", 4), ("moveObject", 6),
+                        ("toggleObject", 2), ("editFog", 4),
+                        ("resizeToken", 2), ("placeToken", 2),
+                        ("displayScene", 2), ("transitionScene", 2),
+                        ("hideScene", 1))
+        self.tokenPaths = getSoakTokenPaths()
+
+    def step(self):
+        action = self.random.choices(
+            [a[0] for a in self.actions], [a[1] for a in self.actions])[0]
+        getattr(self, action)()
+        return action
+
+    def getCurrentScene(self):
+        return self.window.sceneEditor.getCurrentScene()
+
+    def getRandomObject(self, keys=("darkness", "light", "walls",
+                                    "tokens")):
+        sos = self.getCurrentScene().getSceneObjects()
+        candidates = [so for key in keys for so in sos[key]]
+        if len(candidates) == 0:
+            return None
+        return self.random.choice(candidates)
+
+    def switchScene(self):
+        scenes = self.window.session.getScenes()
+        index = self.random.randrange(len(scenes))
+        self.window.sceneList.sceneList.setCurrentRow(index)
+        self.window.updateCurrentScene(index)
+
+    def moveObject(self):
+        so = self.getRandomObject()
+        if so is not None:
+            so.setPos(self.random.randrange(24), self.random.randrange(13))
+
+    def toggleObject(self):
+        from MDSceneData import SceneWall
+        so = self.getRandomObject()
+        if isinstance(so, SceneWall) and so.isDoor():
+            so.toggleOpen()
+        elif so is not None:
+            so.toggleHidden()
+
+    def resizeToken(self):
+        so = self.getRandomObject(("tokens",))
+        if so is not None:
+            so.setSize(self.random.randint(1, 3))
+
+    def placeToken(self):
+        # Put down and taken back again, so its atlas cell is packed and
+        # freed over and over
+        from PyQt5.QtWidgets import QApplication
+        from MDSceneData import SceneToken
+        self.window.sceneEditor.addtoScene(SceneToken(
+            "token", self.random.choice(self.tokenPaths),
+            self.random.randrange(24), self.random.randrange(13)))
+        QApplication.instance().processEvents()
+        self.window.undo()
+
+    def editFog(self):
+        fog = self.getCurrentScene().getFog()
+        fog.setRect(self.random.randrange(20), self.random.randrange(10),
+                    self.random.randint(1, 6), self.random.randint(1, 6),
+                    self.random.random() < 0.5)
+
+    def displayScene(self):
+        self.window.displayScene()
+
+    def transitionScene(self):
+        self.window.transitionScene()
+
+    def hideScene(self):
+        self.window.hideScene()
+
+
+def takeSample(step, latencies):
+    from PyQt5.QtWidgets import QApplication
+    from MDDiagnostics import getQObjectCounts
+    gc.collect()
+    sample = {"step": step,
+              "rss": getResidentBytes(),
+              "objects": len(gc.get_objects()),
+              "qobjects": sum(getQObjectCounts().values()),
+              "widgets": len(QApplication.allWidgets()),
+              "latency": {}}
+    for name, values in latencies.items():
+        sample["latency"][name] = getPercentile(values, 50)
+    return sample
+
+
+def runSoak(window, steps, sampleEvery, seed=0, progress=None):
+    # Runs the driver for steps steps and returns a sample every
+    # sampleEvery steps. Each step's time includes the events it triggers.
+    from PyQt5.QtWidgets import QApplication
+    app = QApplication.instance()
+    driver = MDSoakDriver(window, seed)
+    # A full undo history would look like a leak until it reaches its
+    # limit, a short one is full within the warm-up
+    window.undoHistory.setMaxSteps(100)
+    samples = []
+    latencies = {}
+    for step in range(1, steps + 1):
+        start = time.perf_counter()
+        action = driver.step()
+        app.processEvents()
+        latencies.setdefault(action, []).append(
+            (time.perf_counter() - start) * 1000)
+        if step % sampleEvery == 0:
+            samples.append(takeSample(step, latencies))
+            latencies = {}
+            if progress is not None:
+                progress(samples[-1])
+    return samples
+
+
+def checkSamples(samples, thresholds, warmup=1):
+    # The first samples include caches filling up and are left out.
+    # Returns (metric, trend) for every metric trending past its
+    # threshold, latency per action.
+    samples = samples[warmup:]
+    series = {}
+    for sample in samples:
+        for metric in ("rss", "objects", "qobjects", "widgets"):
+            series.setdefault(metric, []).append(sample[metric])
+        for name, value in sample["latency"].items():
+            series.setdefault("latency." + name, []).append(value)
+    failures = []
+    for metric, values in sorted(series.items()):
+        if len(values) < len(samples):
+            # An action that didn't come up in every window
+            continue
+        trend = getTrend(values)
+        if trend > thresholds[metric.split(".")[0]]:
+            failures.append((metric, trend))
+    return failures
+
+
+def formatSample(sample):
+    latency = sample["latency"].values()
+    return "{:>8} {:>10.1f} {:>9} {:>9} {:>8} {:>9.2f}".format(
+        sample["step"], sample["rss"] / (1024 * 1024), sample["objects"],
+        sample["qobjects"], sample["widgets"],
+        max(latency) if len(latency) else 0)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Drive Map Displayer headlessly for a long session and "
+                    "fail if memory, object counts or latency keep growing")
+    parser.add_argument("--session", help="session file to soak, a "
+                        "generated one by default")
+    parser.add_argument("--steps", type=int, default=10000)
+    parser.add_argument("--sample-every", type=int, default=500)
+    parser.add_argument("--warmup", type=int, default=1,
+                        help="samples left out of the trends")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-rss-growth", type=float, default=0.10)
+    parser.add_argument("--max-object-growth", type=float, default=0.05)
+    parser.add_argument("--max-qobject-growth", type=float, default=0.02)
+    parser.add_argument("--max-latency-growth", type=float, default=0.50)
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtWidgets import QApplication
+    app = QApplication([])
+    from MDMain import MDMain
+    session = createSoakSession() if args.session is None else \
+        MDMain.loadSessionFromFile(args.session)
+    if session is None:
+        print("Could not read {}".format(args.session))
+        return 1
+    window = MDMain(session)
+    window.sceneList.updateList(session.getScenes())
+    window.show()
+
+    print("{:>8} {:>10} {:>9} {:>9} {:>8} {:>9}".format(
+        "step", "rss MB", "objects", "qobjects", "widgets", "worst ms"))
+    samples = runSoak(window, args.steps, args.sample_every, args.seed,
+                      lambda s: print(formatSample(s), flush=True))
+    failures = checkSamples(samples, {
+        "rss": args.max_rss_growth,
+        "objects": args.max_object_growth,
+        "qobjects": args.max_qobject_growth,
+        "widgets": args.max_qobject_growth,
+        "latency": args.max_latency_growth}, args.warmup)
+    # Images stay packed into the token atlases only while a token in the
+    # session uses them, so placing and taking back tokens frees cells
+    from MDTokens import MDTokenAtlas
+    unused = set(path for path, cellSize in MDTokenAtlas.entries) - \
+        set(MDTokenAtlas.users)
+
+    window.closeDisplay()
+    window.close()
+    app.quit()
+    for metric, trend in failures:
+        print("FAIL {} grew {:.1%} over the run".format(metric, trend))
+    if len(unused) > 0:
+        print("FAIL {} images are kept in the token atlases with no token "
+              "using them".format(len(unused)))
+    if len(failures) == 0 and len(unused) == 0:
+        print("OK no upward trends")
+    return 1 if len(failures) or len(unused) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,91 @@
+"""
+Map Displayer is a scene-based toolset for displaying Encounter Maps on a
+second screen for Tabletop RPGs
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Map Displayer.
+
+Map Displayer is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Map Displayer is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Map Displayer.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import builtins
+import sys
+import time
+
+
+# Startup timing for --profile-startup. MDMain imports this before anything
+# else, so the flag is read here instead of waiting for argparse, which
+# only runs once every import is done.
+enabled = "--profile-startup" in sys.argv
+startTime = time.perf_counter()
+lastMark = startTime
+# (depth, module, seconds) in the order the imports started
+imports = []
+phases = []
+importDepth = 0
+originalImport = builtins.__import__
+
+
+def timedImport(name, globals=None, locals=None, fromlist=(), level=0):
+    global importDepth
+    if level > 0 or name in sys.modules:
+        return originalImport(name, globals, locals, fromlist, level)
+    entry = [importDepth, name, 0]
+    imports.append(entry)
+    importDepth += 1
+    start = time.perf_counter()
+    try:
+        return originalImport(name, globals, locals, fromlist, level)
+    finally:
+        importDepth -= 1
+        entry[2] = time.perf_counter() - start
+
+
+if enabled:
+    builtins.__import__ = timedImport
+
+
+def mark(name, seconds=None):
+    # Records the time since the last mark as phase name, or seconds
+    # measured elsewhere, e.g. on another thread
+    global lastMark
+    if not enabled:
+        return
+    if seconds is None:
+        now = time.perf_counter()
+        seconds = now - lastMark
+        lastMark = now
+    phases.append((name, seconds))
+
+
+def printReport(maxDepth=3, minTime=0.001):
+    # Prints what was recorded since the last report. Imports are only
+    # timed up to the first report, later ones happen on other threads.
+    if not enabled:
+        return
+    builtins.__import__ = originalImport
+    if len(imports) > 0:
+        print("imports {:>8.1f} ms".format(
+            sum(e[2] for e in imports if e[0] == 0) * 1000))
+        for depth, name, seconds in imports:
+            if depth < maxDepth and seconds >= minTime:
+                print("  {:<30} {:>8.1f} ms".format(
+                    "  " * depth + name, seconds * 1000))
+        imports.clear()
+    for name, seconds in phases:
+        print("{:<32} {:>8.1f} ms".format(name, seconds * 1000))
+    phases.clear()
+    print("{:<32} {:>8.1f} ms".format(
+        "since start", (time.perf_counter() - startTime) * 1000), flush=True)
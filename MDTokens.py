@@ -0,0 +1,239 @@
+"""
+Map Displayer is a scene-based toolset for displaying Encounter Maps on a
+second screen for Tabletop RPGs
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Map Displayer.
+
+Map Displayer is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Map Displayer is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Map Displayer.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from PyQt5.QtGui import QPixmap, QPainter, QImageReader
+from PyQt5.QtCore import QPointF, QRectF, QSize, Qt
+import time
+import weakref
+
+from MDCommon import CommonValues, getImageBytes
+from MDImageCache import imageCache
+
+
+# Token images packed side by side into a few large pixmaps, one set per
+# size in pixels they are drawn at. Every token of a scene is then drawn
+# with one drawPixmapFragments call per atlas, and since the cells already
+# have the size they are drawn at, each fragment is a plain copy instead
+# of a scaled drawPixmap.
+class MDTokenAtlas:
+    maxSize = 2048
+    # Atlases of a cell size nothing has drawn from for this many seconds
+    # are dropped, e.g. those of zoom levels the preview has moved off
+    maxIdle = 60
+    # Lists of atlases by cell size, (atlas, source rect) by
+    # (filePath, cell size), and the tokens in scenes using each image
+    atlases = {}
+    entries = {}
+    users = {}
+    # When each cell size was last drawn, and when idle ones were last
+    # looked for
+    lastDrawn = {}
+    lastPrune = 0
+
+    def __init__(self, cellSize):
+        self.cellSize = cellSize
+        self.columns = max(1, self.maxSize // cellSize)
+        self.rows = max(1, self.maxSize // cellSize)
+        self.count = 0
+        self.pixmap = None
+        # Cells of images no token uses any more, reused before new ones
+        self.freeCells = []
+
+    def isFull(self):
+        return len(self.freeCells) == 0 and \
+            self.count == self.columns * self.rows
+
+    def add(self, img):
+        if len(self.freeCells) > 0:
+            rect = self.freeCells.pop()
+            self.drawCell(rect, img)
+            return rect
+        # The pixmap grows as rows are used, so a session with a handful of
+        # tokens doesn't hold a whole atlas
+        row, column = divmod(self.count, self.columns)
+        height = (row + 1) * self.cellSize
+        if self.pixmap is None or self.pixmap.height() < height:
+            oldHeight = 0 if self.pixmap is None else self.pixmap.height()
+            grown = QPixmap(self.columns * self.cellSize,
+                            min(self.rows * self.cellSize,
+                                max(height, 2 * oldHeight)))
+            grown.fill(Qt.transparent)
+            if self.pixmap is not None:
+                painter = QPainter(grown)
+                painter.drawPixmap(0, 0, self.pixmap)
+                painter.end()
+            self.pixmap = grown
+        rect = QRectF(column * self.cellSize, row * self.cellSize,
+                      self.cellSize, self.cellSize)
+        self.drawCell(rect, img)
+        self.count += 1
+        return rect
+
+    def drawCell(self, rect, img):
+        painter = QPainter(self.pixmap)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        painter.fillRect(rect, Qt.transparent)
+        painter.setCompositionMode(QPainter.CompositionMode_SourceOver)
+        painter.drawImage(int(rect.x()) + (self.cellSize - img.width()) // 2,
+                          int(rect.y()) + (self.cellSize - img.height()) // 2,
+                          img)
+        painter.end()
+
+    @classmethod
+    def getEntry(cls, filePath, cellSize):
+        # Packs the image the first time it is asked for at this size, None
+        # if the file can't be read
+        key = (filePath, cellSize)
+        cls.lastDrawn[cellSize] = time.monotonic()
+        if key not in cls.entries:
+            cls.entries[key] = cls.pack(filePath, cellSize)
+        return cls.entries[key]
+
+    @staticmethod
+    def getImageSize(filePath, cellSize):
+        # Size of the image once fitted into a cell, None if the file
+        # can't be read
+        size = QImageReader(filePath).size()
+        if not size.isValid():
+            return None
+        size.scale(cellSize, cellSize, Qt.KeepAspectRatio)
+        return QSize(max(1, size.width()), max(1, size.height()))
+
+    @classmethod
+    def loadCellImage(cls, filePath, cellSize):
+        size = cls.getImageSize(filePath, cellSize)
+        return None if size is None else imageCache.loadImage(filePath, size)
+
+    @classmethod
+    def pack(cls, filePath, cellSize):
+        img = cls.loadCellImage(filePath, cellSize)
+        if img is None or img.isNull():
+            return None
+        atlases = cls.atlases.setdefault(cellSize, [])
+        atlas = next((a for a in atlases if not a.isFull()), None)
+        if atlas is None:
+            atlas = cls(cellSize)
+            atlases.append(atlas)
+        return (atlas, atlas.add(img))
+
+    @classmethod
+    def getCellSizes(cls, filePath):
+        return [cellSize for path, cellSize in cls.entries if path == filePath]
+
+    @classmethod
+    def reload(cls, filePath):
+        # Repaints the cells of an image that changed on disk in place, so
+        # its tokens keep their atlas and draw order
+        for cellSize in cls.getCellSizes(filePath):
+            entry = cls.entries[(filePath, cellSize)]
+            if entry is None:
+                cls.entries[(filePath, cellSize)] = cls.pack(filePath,
+                                                             cellSize)
+                continue
+            img = cls.loadCellImage(filePath, cellSize)
+            if img is not None and not img.isNull():
+                entry[0].drawCell(entry[1], img)
+
+    @classmethod
+    def addUser(cls, token):
+        cls.users.setdefault(token.getFilepath(), weakref.WeakSet()).add(
+            token)
+
+    @classmethod
+    def removeUser(cls, token):
+        # The cells of an image are freed with the last token using it.
+        # A token put back (undo) packs its image again when drawn.
+        users = cls.users.get(token.getFilepath())
+        if users is None:
+            return
+        users.discard(token)
+        if len(users) == 0:
+            del cls.users[token.getFilepath()]
+            cls.release(token.getFilepath())
+
+    @classmethod
+    def release(cls, filePath):
+        # An atlas left with only free cells is dropped with its pixmap
+        for cellSize in cls.getCellSizes(filePath):
+            entry = cls.entries.pop((filePath, cellSize))
+            if entry is None:
+                continue
+            atlas = entry[0]
+            atlas.freeCells.append(entry[1])
+            if len(atlas.freeCells) == atlas.count:
+                atlases = cls.atlases[cellSize]
+                atlases.remove(atlas)
+                if len(atlases) == 0:
+                    del cls.atlases[cellSize]
+
+    @classmethod
+    def prune(cls):
+        now = time.monotonic()
+        if now - cls.lastPrune < cls.maxIdle / 4:
+            return
+        cls.lastPrune = now
+        idle = set(cellSize for cellSize, drawn in cls.lastDrawn.items()
+                   if now - drawn > cls.maxIdle)
+        if len(idle) == 0:
+            return
+        for cellSize in idle:
+            del cls.lastDrawn[cellSize]
+            cls.atlases.pop(cellSize, None)
+        cls.entries = {key: entry for key, entry in cls.entries.items()
+                       if key[1] not in idle}
+
+    @classmethod
+    def getMemoryUsage(cls):
+        return sum(getImageBytes(atlas.pixmap)
+                   for atlases in cls.atlases.values() for atlas in atlases)
+
+
+def getTokenCellSize(token, scale=1):
+    return max(1, round(token.getSize() * CommonValues.PPI * scale))
+
+
+def drawTokens(painter, tokens, scale=1, opacity=1):
+    # Tokens are placed by the centre of their cell, with the top left on
+    # a whole pixel so the copies stay sharp
+    MDTokenAtlas.prune()
+    step = CommonValues.PPI * scale
+    fragments = []
+    for token in tokens:
+        cellSize = getTokenCellSize(token, scale)
+        entry = MDTokenAtlas.getEntry(token.getFilepath(), cellSize)
+        if entry is None:
+            continue
+        atlas, source = entry
+        fragments.append((cellSize, atlas, QPainter.PixmapFragment.create(
+            QPointF(round(token.getX() * step) + cellSize / 2,
+                    round(token.getY() * step) + cellSize / 2),
+            source, 1, 1, 0, opacity)))
+    # Overlapping tokens stack the same however much of the scene is
+    # drawn: bigger tokens over smaller ones, otherwise in scene order.
+    # Each run of tokens from one atlas is one call.
+    fragments.sort(key=lambda f: f[0])
+    start = 0
+    for i in range(1, len(fragments) + 1):
+        if i == len(fragments) or fragments[i][1] is not fragments[start][1]:
+            painter.drawPixmapFragments([f[2] for f in fragments[start:i]],
+                                        fragments[start][1].pixmap)
+            start = i
@@ -0,0 +1,125 @@
+"""
+Map Displayer is a scene-based toolset for displaying Encounter Maps on a
+second screen for Tabletop RPGs
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Map Displayer.
+
+Map Displayer is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Map Displayer is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Map Displayer.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from PyQt5.QtCore import QObject, pyqtSignal
+from collections import deque
+import numpy as np
+
+from MDOperations import (operationListeners, operationStartListeners,
+                          operationTime)
+
+
+def isSameState(a, b):
+    if isinstance(a, np.ndarray):
+        return a is b or np.array_equal(a, b)
+    return a == b
+
+
+# Undo and redo for every operation on the model. A step is the object the
+# operation was made on with its undo state (getUndoState) from before and
+# after it. States are a few numbers for objects, the object lists for a
+# scene and the shared cells for fog, so undoing only touches that one
+# object and only what it covers is redrawn.
+class MDUndoHistory(QObject):
+    historyChanged = pyqtSignal()
+
+    maxSteps = 5000
+    # Repeats of an operation on the same object within this many ms are
+    # one step, e.g. holding down a spinbox arrow. Timed on the operation
+    # clock, so a replay merges the same steps the recorded session did.
+    mergeTime = 500
+
+    def __init__(self):
+        super(MDUndoHistory, self).__init__()
+        self.undoSteps = deque(maxlen=self.maxSteps)
+        self.redoSteps = []
+        self.pending = None
+        self.lastStep = None
+        operationStartListeners.append(self.startOperation)
+        operationListeners.append(self.finishOperation)
+
+    def stop(self):
+        if self.startOperation in operationStartListeners:
+            operationStartListeners.remove(self.startOperation)
+            operationListeners.remove(self.finishOperation)
+        self.clear()
+
+    def setMaxSteps(self, maxSteps):
+        self.maxSteps = maxSteps
+        self.undoSteps = deque(self.undoSteps, maxlen=maxSteps)
+
+    def clear(self):
+        self.undoSteps.clear()
+        self.redoSteps = []
+        self.pending = None
+        self.lastStep = None
+        self.historyChanged.emit()
+
+    def startOperation(self, target, name, args):
+        if hasattr(target, "getUndoState"):
+            self.pending = (target, target.getUndoState())
+
+    def finishOperation(self, target, name, args):
+        if self.pending is None or self.pending[0] is not target:
+            return
+        before = self.pending[1]
+        self.pending = None
+        now = operationTime[0]
+        if self.lastStep is not None and \
+                self.lastStep[:2] == (target, name) and \
+                now - self.lastStep[2] < self.mergeTime:
+            before = self.undoSteps.pop()[1]
+        after = target.getUndoState()
+        if isSameState(before, after):
+            self.lastStep = None
+        else:
+            self.undoSteps.append((target, before, after))
+            self.redoSteps = []
+            self.lastStep = (target, name, now)
+        self.historyChanged.emit()
+
+    def canUndo(self):
+        return len(self.undoSteps) > 0
+
+    def canRedo(self):
+        return len(self.redoSteps) > 0
+
+    def undo(self):
+        # Returns what was changed back, None with nothing to undo
+        if not self.canUndo():
+            return None
+        step = self.undoSteps.pop()
+        step[0].restoreUndoState(step[1])
+        self.redoSteps.append(step)
+        self.lastStep = None
+        self.historyChanged.emit()
+        return step[0]
+
+    def redo(self):
+        if not self.canRedo():
+            return None
+        step = self.redoSteps.pop()
+        step[0].restoreUndoState(step[2])
+        self.undoSteps.append(step)
+        self.lastStep = None
+        self.historyChanged.emit()
+        return step[0]
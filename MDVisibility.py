@@ -0,0 +1,346 @@
+"""
+Map Displayer is a scene-based toolset for displaying Encounter Maps on a
+second screen for Tabletop RPGs
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Map Displayer.
+
+Map Displayer is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Map Displayer is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Map Displayer.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from PyQt5.QtGui import QPainterPath, QPolygonF
+from PyQt5.QtCore import QPointF
+import math
+
+from MDCommon import CommonValues
+
+
+# Segments are (x1, y1, x2, y2) in grid units
+
+def getCrossing(a, b):
+    # Where b cuts a, as a fraction of a, or None. Touching a's ends
+    # doesn't count, b's ends touching a's middle does.
+    ax1, ay1, ax2, ay2 = a
+    bx1, by1, bx2, by2 = b
+    dax, day = ax2 - ax1, ay2 - ay1
+    dbx, dby = bx2 - bx1, by2 - by1
+    denom = dax * dby - day * dbx
+    if abs(denom) < 1e-12:
+        return None
+    t = ((bx1 - ax1) * dby - (by1 - ay1) * dbx) / denom
+    u = ((bx1 - ax1) * day - (by1 - ay1) * dax) / denom
+    if 1e-9 < t < 1 - 1e-9 and -1e-9 <= u <= 1 + 1e-9:
+        return t
+    return None
+
+
+def getDistance(segment, px, py):
+    # Distance from (px, py) to the closest point of segment
+    x1, y1, x2, y2 = segment
+    dx, dy = x2 - x1, y2 - y1
+    length = dx * dx + dy * dy
+    t = 0 if length == 0 else \
+        max(0, min(1, ((px - x1) * dx + (py - y1) * dy) / length))
+    return math.hypot(x1 + t * dx - px, y1 + t * dy - py)
+
+
+def clipSegment(segment, x1, y1, x2, y2):
+    # The part of segment inside the rect, or None (Liang-Barsky)
+    sx, sy, ex, ey = segment
+    dx, dy = ex - sx, ey - sy
+    t0, t1 = 0, 1
+    for p, q in ((-dx, sx - x1), (dx, x2 - sx), (-dy, sy - y1),
+                 (dy, y2 - sy)):
+        if p == 0:
+            if q < 0:
+                return None
+        elif p < 0:
+            t0 = max(t0, q / p)
+        else:
+            t1 = min(t1, q / p)
+    if t0 >= t1:
+        return None
+    return (sx + t0 * dx, sy + t0 * dy, sx + t1 * dx, sy + t1 * dy)
+
+
+def getRayDistance(ox, oy, dx, dy, segment):
+    # How far along the ray from (ox, oy) in direction (dx, dy) the line
+    # through segment is, used to order the segments the ray crosses
+    x1, y1, x2, y2 = segment
+    ex, ey = x2 - x1, y2 - y1
+    denom = dx * ey - dy * ex
+    if abs(denom) < 1e-12:
+        return min(math.hypot(x1 - ox, y1 - oy), math.hypot(x2 - ox, y2 - oy))
+    return ((x1 - ox) * ey - (y1 - oy) * ex) / denom
+
+
+def getRayHit(ox, oy, angle, segment):
+    # Where the ray from (ox, oy) at angle meets the line through segment
+    dx, dy = math.cos(angle), math.sin(angle)
+    t = getRayDistance(ox, oy, dx, dy, segment)
+    return (ox + dx * t, oy + dy * t)
+
+
+# Binary heap of the segments a sweep ray is crossing, the nearest on top.
+# Where each segment sits is tracked so it can be taken out from anywhere
+# in O(log n). Segments are compared along the ray given to push and
+# remove, which must cross all of them. None of them cross each other, so
+# the order is the same along any ray that does.
+class MDSegmentHeap:
+    def __init__(self, ox, oy, segments):
+        self.ox = ox
+        self.oy = oy
+        self.segments = segments
+        self.heap = []
+        self.positions = {}
+        self.ray = (1, 0)
+
+    def __contains__(self, i):
+        return i in self.positions
+
+    def getNearest(self):
+        return self.heap[0] if len(self.heap) > 0 else -1
+
+    def isNearer(self, a, b):
+        dx, dy = self.ray
+        return getRayDistance(self.ox, self.oy, dx, dy, self.segments[a]) < \
+            getRayDistance(self.ox, self.oy, dx, dy, self.segments[b])
+
+    def push(self, i, ray):
+        self.ray = ray
+        self.heap.append(i)
+        self.positions[i] = len(self.heap) - 1
+        self.siftUp(len(self.heap) - 1)
+
+    def remove(self, i, ray):
+        self.ray = ray
+        pos = self.positions.pop(i)
+        last = self.heap.pop()
+        if pos < len(self.heap):
+            self.heap[pos] = last
+            self.positions[last] = pos
+            self.siftUp(pos)
+            self.siftDown(self.positions[last])
+
+    def swap(self, a, b):
+        heap = self.heap
+        heap[a], heap[b] = heap[b], heap[a]
+        self.positions[heap[a]] = a
+        self.positions[heap[b]] = b
+
+    def siftUp(self, pos):
+        while pos > 0:
+            parent = (pos - 1) // 2
+            if not self.isNearer(self.heap[pos], self.heap[parent]):
+                break
+            self.swap(pos, parent)
+            pos = parent
+
+    def siftDown(self, pos):
+        heap = self.heap
+        while True:
+            nearest = pos
+            for child in (2 * pos + 1, 2 * pos + 2):
+                if child < len(heap) and \
+                        self.isNearer(heap[child], heap[nearest]):
+                    nearest = child
+            if nearest == pos:
+                break
+            self.swap(pos, nearest)
+            pos = nearest
+
+
+def getVisibilityPolygon(ox, oy, segments, radius):
+    # Points of the area seen from (ox, oy) out to a square of radius,
+    # walled in by segments, which must not cross each other. An angular
+    # sweep: segment ends are sorted by angle and the segments the sweep
+    # ray is crossing are kept in a heap, so the visible one is always on
+    # top. O(n log n) in the number of segments.
+    r = radius + 1
+    left, top, right, bottom = ox - r, oy - r, ox + r, oy + r
+    segments = [s for s in (clipSegment(s, left, top, right, bottom)
+                            for s in segments) if s is not None]
+    segments += [(left, top, right, top), (right, top, right, bottom),
+                 (right, bottom, left, bottom), (left, bottom, left, top)]
+
+    events = []
+    for i, (x1, y1, x2, y2) in enumerate(segments):
+        a1 = math.atan2(y1 - oy, x1 - ox)
+        a2 = math.atan2(y2 - oy, x2 - ox)
+        span = (a2 - a1 + math.pi) % (2 * math.pi) - math.pi
+        if span == 0:
+            # Seen edge on
+            continue
+        begin, end = (a1, a2) if span > 0 else (a2, a1)
+        # Ends sort before begins at the same angle
+        events.append((begin, 1, i))
+        events.append((end, 0, i))
+    events.sort()
+    angles = sorted(set(e[0] for e in events))
+    # Segments that begin at an angle are put in order along a ray halfway
+    # to the next angle, ones that end there along a ray halfway from the
+    # one before. Every segment in the heap at that point crosses it.
+    nextAngles = angles[1:] + [angles[0] + 2 * math.pi]
+    midRays = [(math.cos((a + b) / 2), math.sin((a + b) / 2))
+               for a, b in zip(angles, nextAngles)]
+    beginRays = dict(zip(angles, midRays))
+    endRays = dict(zip(angles, midRays[-1:] + midRays[:-1]))
+
+    # The first pass only finds the segments crossing the ray at -pi,
+    # the second records the polygon
+    active = MDSegmentHeap(ox, oy, segments)
+    points = []
+    beginAngle = 0
+    for sweep in (0, 1):
+        for angle, kind, i in events:
+            nearest = active.getNearest()
+            if kind == 1:
+                active.push(i, beginRays[angle])
+            elif i in active:
+                active.remove(i, endRays[angle])
+            newNearest = active.getNearest()
+            if nearest != newNearest:
+                if sweep == 1 and nearest != -1:
+                    points.append(getRayHit(ox, oy, beginAngle,
+                                            segments[nearest]))
+                    points.append(getRayHit(ox, oy, angle,
+                                            segments[nearest]))
+                beginAngle = angle
+    return points
+
+
+# Walls of one scene in a grid of cells for finding the ones near a light,
+# and the lit area of each light cached until it or a wall near it changes
+class MDVisibility:
+    cellSize = 4
+    # Lights sit on grid corners like walls do, which would put them on
+    # the lines of walls and make rays graze wall ends
+    nudge = (0.0013, 0.0007)
+
+    def __init__(self):
+        # wall: segment while it blocks light, None when it doesn't
+        self.walls = {}
+        self.wallCells = {}
+        self.cells = {}
+        # wall: its segment cut where other walls cross it
+        self.pieces = {}
+        # light: (key, bounds, bright path, dim path)
+        self.lights = {}
+
+    def getCells(self, x1, y1, x2, y2):
+        size = self.cellSize
+        return [(cx, cy)
+                for cx in range(int(math.floor(min(x1, x2) / size)),
+                                int(math.floor(max(x1, x2) / size)) + 1)
+                for cy in range(int(math.floor(min(y1, y2) / size)),
+                                int(math.floor(max(y1, y2) / size)) + 1)]
+
+    def getWallsNear(self, cells):
+        walls = set()
+        for cell in cells:
+            walls.update(self.cells.get(cell, ()))
+        return walls
+
+    def updateWall(self, wall):
+        # Re-indexes a wall that was added, moved, opened or hidden. Walls
+        # it crossed before or crosses now have to be cut again.
+        self.removeWall(wall)
+        segment = wall.getSegment() if wall.isBlocking() else None
+        self.walls[wall] = segment
+        if segment is None:
+            return
+        cells = self.getCells(*segment)
+        self.wallCells[wall] = cells
+        for cell in cells:
+            self.cells.setdefault(cell, set()).add(wall)
+        for other in self.getWallsNear(cells):
+            self.pieces.pop(other, None)
+
+    def removeWall(self, wall):
+        self.walls.pop(wall, None)
+        self.pieces.pop(wall, None)
+        cells = self.wallCells.pop(wall, ())
+        for other in self.getWallsNear(cells):
+            self.pieces.pop(other, None)
+        for cell in cells:
+            self.cells[cell].discard(wall)
+            if len(self.cells[cell]) == 0:
+                del self.cells[cell]
+
+    def getPieces(self, wall):
+        pieces = self.pieces.get(wall)
+        if pieces is None:
+            segment = self.walls[wall]
+            cuts = [0, 1]
+            for other in self.getWallsNear(self.wallCells[wall]):
+                if other is not wall:
+                    t = getCrossing(segment, self.walls[other])
+                    if t is not None:
+                        cuts.append(t)
+            cuts.sort()
+            x1, y1, x2, y2 = segment
+            dx, dy = x2 - x1, y2 - y1
+            pieces = [(x1 + t0 * dx, y1 + t0 * dy, x1 + t1 * dx, y1 + t1 * dy)
+                      for t0, t1 in zip(cuts, cuts[1:]) if t1 - t0 > 1e-9]
+            self.pieces[wall] = pieces
+        return pieces
+
+    def invalidate(self, rect):
+        # Walls changed inside rect (display pixels), lights reaching into
+        # it are worked out again the next time they are drawn
+        for light in [light for light, cached in self.lights.items()
+                      if cached[1].intersects(rect)]:
+            del self.lights[light]
+
+    def removeLight(self, light):
+        self.lights.pop(light, None)
+
+    def getVisibleArea(self, x, y, radius):
+        # Polygon in grid units of what (x, y) sees within radius
+        ox, oy = x + self.nudge[0], y + self.nudge[1]
+        segments = []
+        for wall in self.getWallsNear(self.getCells(
+                ox - radius, oy - radius, ox + radius, oy + radius)):
+            for piece in self.getPieces(wall):
+                if getDistance(piece, ox, oy) < radius:
+                    segments.append(piece)
+        return getVisibilityPolygon(ox, oy, segments, radius)
+
+    def getLitPaths(self, light):
+        # (bright, dim) areas of a light in display pixels, dim being the
+        # ring around bright. Both stop at the walls the light can't see
+        # past.
+        x, y = light.getPos()
+        br = max(light.getBrightRadius(), 0)
+        dr = max(light.getDimRadus(), 0)
+        key = (x, y, br, dr)
+        cached = self.lights.get(light)
+        if cached is not None and cached[0] == key:
+            return cached[2], cached[3]
+        ppi = CommonValues.PPI
+        visible = QPainterPath()
+        visible.addPolygon(QPolygonF(
+            [QPointF(px * ppi, py * ppi)
+             for px, py in self.getVisibleArea(x, y, br + dr)]))
+        visible.closeSubpath()
+        paths = []
+        for r in (br, br + dr):
+            circle = QPainterPath()
+            if r > 0:
+                circle.addEllipse(QPointF(x * ppi, y * ppi), r * ppi, r * ppi)
+            paths.append(circle.intersected(visible))
+        paths[1] = paths[1].subtracted(paths[0])
+        self.lights[light] = (key, light.getBounds(), paths[0], paths[1])
+        return paths[0], paths[1]
@@ -0,0 +1,420 @@
+"""
+Map Displayer is a scene-based toolset for displaying Encounter Maps on a
+second screen for Tabletop RPGs
+Copyright 2019, 2020 Eric Symmank
+
+This file is part of Map Displayer.
+
+Map Displayer is free software: you can redistribute it
+and/or modify it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the License,
+or (at your option) any later version.
+
+Map Displayer is distributed in the hope that it will be
+useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Map Displayer.
+If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+from PyQt5.QtCore import (QObject, QRunnable, QThreadPool, QTimer, QRect,
+                          QBuffer, QIODevice, pyqtSignal)
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import base64
+import hashlib
+import json
+import queue
+import socket
+import struct
+import threading
+
+
+websocketGUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+pageHTML = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>Map Displayer</title>
+<style>
+html, body { margin: 0; height: 100%; background: black; overflow: hidden; }
+canvas { width: 100%; height: 100%; object-fit: contain; display: block; }
+</style>
+</head>
+<body>
+<canvas id="display"></canvas>
+<script>
+const canvas = document.getElementById("display");
+const ctx = canvas.getContext("2d");
+let pending = Promise.resolve();
+
+async function drawTiles(data) {
+    const view = new DataView(data);
+    const count = view.getUint16(0);
+    let offset = 2;
+    for (let i = 0; i < count; i++) {
+        const x = view.getUint16(offset);
+        const y = view.getUint16(offset + 2);
+        const length = view.getUint32(offset + 4);
+        offset += 8;
+        const blob = new Blob([new Uint8Array(data, offset, length)],
+                              {type: "image/jpeg"});
+        ctx.drawImage(await createImageBitmap(blob), x, y);
+        offset += length;
+    }
+}
+
+function connect() {
+    const ws = new WebSocket("ws://" + location.host + "/ws");
+    ws.binaryType = "arraybuffer";
+    ws.onmessage = (ev) => {
+        if (typeof ev.data === "string") {
+            const hello = JSON.parse(ev.data);
+            canvas.width = hello.width;
+            canvas.height = hello.height;
+        } else {
+            // Messages are drawn strictly in the order they arrived, one
+            // that fails to decode doesn't stop the ones after it
+            pending = pending.then(() => drawTiles(ev.data))
+                .catch((err) => console.error(err));
+        }
+    };
+    ws.onclose = () => setTimeout(connect, 1000);
+}
+connect();
+</script>
+</body>
+</html>
+"""
+
+
+def makeWebSocketFrame(payload, opcode=0x2):
+    n = len(payload)
+    if n < 126:
+        header = struct.pack("!BB", 0x80 | opcode, n)
+    elif n < 65536:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, n)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, n)
+    return header + payload
+
+
+def makeTileMessage(tiles):
+    # count, then x, y, length and the encoded bytes of every tile
+    parts = [struct.pack("!H", len(tiles))]
+    for pos, data in tiles:
+        parts.append(struct.pack("!HHI", pos[0], pos[1], len(data)))
+        parts.append(data)
+    return makeWebSocketFrame(b"".join(parts))
+
+
+# Mirrors a display compositor to any number of browsers. Changed areas of the
+# frame are cut into tiles, tiles that really changed are encoded once on
+# the thread pool, and the same message bytes go to every viewer.
+class MDWebDisplay(QObject):
+    # Tiles could not be encoded or sent
+    displayError = pyqtSignal(str)
+
+    tileSize = 256
+    quality = 85
+    interval = 100
+    defaultPort = 8765
+
+    def __init__(self, compositor, port=defaultPort, host=""):
+        super(MDWebDisplay, self).__init__()
+        self.compositor = compositor
+        self.host = host
+        self.port = port
+        self.server = None
+        self.dirtyTiles = set()
+        # Hashes of the tiles last sent, only touched on the GUI thread.
+        # The encode task gets a copy and hands back what it sent.
+        self.tileHashes = {}
+        self.encoding = False
+        self.encodeTask = None
+        # Bumped on every start, results of older encodes are dropped
+        self.generation = 0
+
+        self.flushTimer = QTimer()
+        self.flushTimer.setSingleShot(True)
+        self.flushTimer.setInterval(self.interval)
+        self.flushTimer.timeout.connect(self.flush)
+        compositor.frameUpdated.connect(self.markDirty)
+
+    def start(self):
+        if self.server is None:
+            frame = self.compositor.getFrame()
+            self.server = MDWebServer((self.host, self.port), frame.width(),
+                                      frame.height())
+            self.port = self.server.server_address[1]
+            threading.Thread(target=self.server.serve_forever,
+                             daemon=True).start()
+            self.tileHashes = {}
+            self.generation += 1
+            self.markDirty(frame.rect())
+
+    def stop(self):
+        if self.server is not None:
+            self.server.closeClients()
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def isRunning(self):
+        return self.server is not None
+
+    def getURL(self):
+        # Connecting a UDP socket sends nothing, it only picks the address
+        # of the interface the LAN is reached through
+        host = "localhost"
+        try:
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.connect(("10.255.255.255", 1))
+            host = s.getsockname()[0]
+            s.close()
+        except OSError:
+            pass
+        return "http://{}:{}/".format(host, self.port)
+
+    def getClientCount(self):
+        return 0 if self.server is None else len(self.server.clients)
+
+    def markDirty(self, rect):
+        if self.server is None:
+            return
+        ts = self.tileSize
+        for ty in range(rect.top() // ts, rect.bottom() // ts + 1):
+            for tx in range(rect.left() // ts, rect.right() // ts + 1):
+                self.dirtyTiles.add((tx * ts, ty * ts))
+        if not self.flushTimer.isActive():
+            self.flushTimer.start()
+
+    def flush(self):
+        if self.server is None or len(self.dirtyTiles) == 0:
+            return
+        if self.encoding:
+            # Still sending the last batch, newer changes go out after it
+            self.flushTimer.start()
+            return
+        frame = self.compositor.getFrame()
+        tiles = []
+        for pos in sorted(self.dirtyTiles):
+            rect = QRect(pos[0], pos[1], self.tileSize, self.tileSize)
+            tiles.append((pos, frame.copy(rect.intersected(
+                frame.rect())).toImage()))
+        self.dirtyTiles = set()
+        self.encoding = True
+        self.encodeTask = MDTileEncodeTask(
+            self.server, tiles, {pos: self.tileHashes.get(pos)
+                                 for pos, img in tiles},
+            self.quality, self.generation)
+        self.encodeTask.signals.finished.connect(self.finishEncode)
+        QThreadPool.globalInstance().start(self.encodeTask)
+
+    def finishEncode(self, generation, hashes, error):
+        if generation == self.generation:
+            self.tileHashes.update(hashes)
+        self.encoding = False
+        if error:
+            self.displayError.emit(
+                "Could not send display tiles: {}".format(error))
+
+
+class MDTileEncodeSignals(QObject):
+    # generation, hashes of the tiles sent, error message (empty on
+    # success)
+    finished = pyqtSignal(int, dict, str)
+
+
+class MDTileEncodeTask(QRunnable):
+    # Encodes the tiles that changed since they were last sent and sends
+    # them to every viewer. The hashes of what was sent go back to the GUI
+    # thread through finished, which is emitted even if encoding failed so
+    # the display never waits on a task that is gone.
+    def __init__(self, server, tiles, knownHashes, quality, generation):
+        super(MDTileEncodeTask, self).__init__()
+        self.setAutoDelete(False)
+        self.server = server
+        self.tiles = tiles
+        self.knownHashes = knownHashes
+        self.quality = quality
+        self.generation = generation
+        self.signals = MDTileEncodeSignals()
+
+    def run(self):
+        hashes = {}
+        error = ""
+        try:
+            changed = []
+            digests = {}
+            for pos, img in self.tiles:
+                digest = hashlib.sha1(
+                    img.constBits().asstring(img.sizeInBytes())).digest()
+                if self.knownHashes.get(pos) == digest:
+                    continue
+                digests[pos] = digest
+                buf = QBuffer()
+                buf.open(QIODevice.WriteOnly)
+                img.save(buf, "JPG", self.quality)
+                changed.append((pos, bytes(buf.data())))
+            if len(changed) > 0:
+                self.server.publish(changed)
+            hashes = digests
+        except Exception as e:
+            error = str(e) or type(e).__name__
+        finally:
+            self.signals.finished.emit(self.generation, hashes, error)
+
+
+class MDWebServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, width, height):
+        super(MDWebServer, self).__init__(address, MDWebHandler)
+        self.lock = threading.Lock()
+        self.clients = set()
+        self.tiles = {}
+        self.hello = makeWebSocketFrame(json.dumps(
+            {"width": width, "height": height}).encode("utf-8"), 0x1)
+
+    def publish(self, tiles):
+        with self.lock:
+            self.tiles.update(tiles)
+            message = makeTileMessage(tiles)
+            for client in self.clients:
+                client.send(message)
+
+    def getKeyframe(self):
+        with self.lock:
+            return makeTileMessage(list(self.tiles.items()))
+
+    def addClient(self, client):
+        # Under the lock, so no published tiles fall between the keyframe
+        # and the first diff this client sees
+        with self.lock:
+            client.send(self.hello)
+            client.send(makeTileMessage(list(self.tiles.items())))
+            self.clients.add(client)
+
+    def removeClient(self, client):
+        with self.lock:
+            self.clients.discard(client)
+
+    def closeClients(self):
+        with self.lock:
+            for client in self.clients:
+                client.close()
+
+
+class MDWebClient:
+    maxQueued = 8
+
+    def __init__(self, server, connection, rfile):
+        self.server = server
+        self.connection = connection
+        self.rfile = rfile
+        self.queue = queue.Queue()
+        self.needsKeyframe = False
+        self.closed = False
+
+    def send(self, message):
+        # A viewer that falls behind skips the queued diffs and gets one
+        # keyframe of the latest tiles instead
+        if self.queue.qsize() >= self.maxQueued:
+            self.needsKeyframe = True
+            try:
+                while True:
+                    self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.queue.put(b"")
+        else:
+            self.queue.put(message)
+
+    def close(self):
+        self.closed = True
+        self.queue.put(None)
+
+    def writeLoop(self):
+        while not self.closed:
+            message = self.queue.get()
+            if message is None:
+                break
+            if self.needsKeyframe:
+                self.needsKeyframe = False
+                message = self.server.getKeyframe()
+            try:
+                if len(message) > 0:
+                    self.connection.sendall(message)
+            except OSError:
+                break
+        self.closed = True
+        try:
+            self.connection.sendall(makeWebSocketFrame(b"", 0x8))
+        except OSError:
+            pass
+
+    def readLoop(self):
+        # Viewers never send anything but pings and close frames
+        try:
+            while not self.closed:
+                header = self.rfile.read(2)
+                if len(header) < 2:
+                    break
+                opcode = header[0] & 0x0F
+                length = header[1] & 0x7F
+                if length == 126:
+                    length = struct.unpack("!H", self.rfile.read(2))[0]
+                elif length == 127:
+                    length = struct.unpack("!Q", self.rfile.read(8))[0]
+                mask = self.rfile.read(4) if header[1] & 0x80 else b"\0" * 4
+                payload = bytes(b ^ mask[i % 4] for i, b in
+                                enumerate(self.rfile.read(length)))
+                if opcode == 0x8:
+                    break
+                elif opcode == 0x9:
+                    self.queue.put(makeWebSocketFrame(payload, 0xA))
+        except (OSError, struct.error):
+            pass
+        self.close()
+
+
+class MDWebHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/ws" and \
+                self.headers.get("Upgrade", "").lower() == "websocket":
+            self.serveWebSocket()
+        elif self.path in ("/", "/index.html"):
+            body = pageHTML.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_error(404)
+
+    def serveWebSocket(self):
+        key = self.headers.get("Sec-WebSocket-Key", "")
+        accept = base64.b64encode(hashlib.sha1(
+            (key + websocketGUID).encode("ascii")).digest()).decode("ascii")
+        self.send_response(101, "Switching Protocols")
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.close_connection = True
+
+        client = MDWebClient(self.server, self.connection, self.rfile)
+        threading.Thread(target=client.readLoop, daemon=True).start()
+        self.server.addClient(client)
+        client.writeLoop()
+        self.server.removeClient(client)
+
+    def log_message(self, format, *args):
+        pass